@@ -0,0 +1,71 @@
+# Compares the batched logistic fit used by calc_rel_growth_rates against
+# fitting each bootstrap resample with scipy's curve_fit.
+#
+#   python benchmarks/bench_growth.py [--lineages 5] [--nboots 1000]
+import argparse
+import time
+
+import numpy as np
+from scipy.optimize import curve_fit
+
+from freyja.utils import logistic_growth, fit_logistic_growth
+
+
+def simulate(rng, nDays=56):
+    days = np.arange(0, nDays, 3)
+    b = np.exp(rng.uniform(0, 6))
+    r = rng.uniform(-0.15, 0.15)
+    noise = rng.normal(0, 0.03, len(days))
+    return days, np.clip(logistic_growth(days, b, r) + noise, 0, 1)
+
+
+def fit_loop(days, data, bootInds):
+    fit, _ = curve_fit(logistic_growth, days, data, p0=[100, 0.1],
+                       bounds=([0, -10], [1000, 10]))
+    coef_ests = []
+    for inds in bootInds:
+        try:
+            fitBoot, _ = curve_fit(logistic_growth, days[inds], data[inds],
+                                   p0=[100, 0.1],
+                                   bounds=([0, -10], [1000, 10]))
+        except RuntimeError:
+            # resamples curve_fit gives up on are left out
+            continue
+        coef_ests.append(fitBoot[1])
+    return fit[1], np.percentile(coef_ests, [2.5, 97.5])
+
+
+def fit_batched(days, data, bootInds):
+    fits = fit_logistic_growth(np.vstack([days, days[bootInds]]),
+                               np.vstack([data, data[bootInds]]))
+    return fits[0, 1], np.percentile(fits[1:, 1], [2.5, 97.5])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lineages', type=int, default=5)
+    parser.add_argument('--nboots', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    tLoop = tBatched = 0.
+    for k in range(args.lineages):
+        days, data = simulate(rng)
+        bootInds = rng.integers(0, len(days), (args.nboots, len(days)))
+        t0 = time.perf_counter()
+        rate0, ci0 = fit_loop(days, data, bootInds)
+        t1 = time.perf_counter()
+        rate1, ci1 = fit_batched(days, data, bootInds)
+        t2 = time.perf_counter()
+        tLoop += t1 - t0
+        tBatched += t2 - t1
+        print(f'lineage {k}: rate {rate0:.5f} / {rate1:.5f}, '
+              f'95% interval [{ci0[0]:.5f}, {ci0[1]:.5f}] / '
+              f'[{ci1[0]:.5f}, {ci1[1]:.5f}]')
+    print(f'curve_fit loop: {tLoop:.2f}s, batched: {tBatched:.2f}s '
+          f'({tLoop / tBatched:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
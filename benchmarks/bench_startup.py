@@ -0,0 +1,54 @@
+# Wall time of short freyja invocations, each in a fresh interpreter, so the
+# numbers include the import cost every call of a scripted workflow pays.
+#
+#   python benchmarks/bench_startup.py [--repeats 10]
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                    'freyja', 'data')
+
+
+def wall_times(cmd, repeats):
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeats', type=int, default=10)
+    args = parser.parse_args()
+
+    tmpDir = tempfile.mkdtemp()
+    results = os.path.join(tmpDir, 'results')
+    shutil.copytree(os.path.join(DATA, 'outputs'), results)
+    freyja = [sys.executable, '-c', 'from freyja._cli import cli; cli()']
+    cmds = {
+        'python -c pass': [sys.executable, '-c', 'pass'],
+        'freyja --help': freyja + ['--help'],
+        'freyja demix --help': freyja + ['demix', '--help'],
+        'freyja aggregate': freyja + ['aggregate', results + os.sep,
+                                      '--output',
+                                      os.path.join(tmpDir, 'agg.tsv')],
+    }
+    try:
+        for name, cmd in cmds.items():
+            times = wall_times(cmd, args.repeats)
+            print(f'{name:24s} median {statistics.median(times):.3f}s, '
+                  f'min {min(times):.3f}s')
+    finally:
+        shutil.rmtree(tmpDir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,9 @@
+# Session is imported on first use, so that importing the package (e.g. for
+# the command line) doesn't load the solver.
+
+
+def __getattr__(name):
+    if name == 'Session':
+        from freyja.session import Session
+        return Session
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,22 +1,11 @@
 import click
-import pandas as pd
-from freyja.convert_paths2barcodes import parse_tree_paths,\
-    convert_to_barcodes, reversion_checking, check_mutation_chain
-from freyja.read_analysis_tools import extract as _extract, filter as _filter,\
-    covariants as _covariants, plot_covariants as _plot_covariants
-from freyja.sample_deconv import buildLineageMap, build_mix_and_depth_arrays,\
-    reindex_dfs, map_to_constellation, solve_demixing_problem,\
-    perform_bootstrap
-from freyja.updates import download_tree, convert_tree,\
-    get_curated_lineage_data, get_cl_lineages,\
-    download_barcodes, download_barcodes_wgisaid
-from freyja.utils import agg, makePlot_simple, makePlot_time,\
-    make_dashboard, checkConfig, get_abundance, calc_rel_growth_rates
 import os
 import glob
 import subprocess
 import sys
-import yaml
+
+# Subcommands import what they need when they run, so that e.g. `freyja
+# aggregate` doesn't pay for importing cvxpy, plotly or pysam.
 
 locDir = os.path.abspath(os.path.join(os.path.realpath(__file__), os.pardir))
 
@@ -38,9 +27,19 @@ def print_barcode_version(ctx, param, value):
     ctx.exit()
 
 
+def check_sample_inputs(variants, depths, server):
+    # variants/depth files may be '-' (stdin), compressed or FIFOs
+    if variants == '-' and depths == '-':
+        raise click.UsageError('only one of variants and depths can be read '
+                               'from stdin')
+    if server is not None and '-' in (variants, depths):
+        raise click.UsageError('--server needs variants and depths files '
+                               'the server can read, not stdin')
+
+
 @cli.command()
-@click.argument('variants', type=click.Path(exists=True))
-@click.argument('depths', type=click.Path(exists=True))
+@click.argument('variants', type=click.Path(exists=True, allow_dash=True))
+@click.argument('depths', type=click.Path(exists=True, allow_dash=True))
 @click.option('--eps', default=1e-3, help='minimum abundance to include')
 @click.option('--barcodes', default='-1', help='custom barcode file')
 @click.option('--meta', default='-1', help='custom lineage metadata file')
@@ -53,69 +52,102 @@ def print_barcode_version(ctx, param, value):
               help='larger library with non-public lineages')
 @click.option('--version', is_flag=True, callback=print_barcode_version,
               expose_value=False, is_eager=True)
+@click.option('--sitecache', default=None, type=click.Path(),
+              help='directory to cache the site table for redemix')
+@click.option('--outformat', default='tsv',
+              type=click.Choice(['tsv', 'jsonl']),
+              help='tsv, or structured json lines output')
+@click.option('--server', default=None,
+              help='send to a running `freyja serve` (port or socket path)')
 def demix(variants, depths, output, eps, barcodes, meta,
-          covcut, confirmedonly, wgisaid):
-    locDir = os.path.abspath(os.path.join(os.path.realpath(__file__),
-                             os.pardir))
-    # option for custom barcodes
-    if barcodes != '-1':
-        df_barcodes = pd.read_csv(barcodes, index_col=0)
-    else:
-        if not wgisaid:
-            df_barcodes = pd.read_csv(os.path.join(locDir,
-                                      'data/usher_barcodes.csv'), index_col=0)
-        else:
-            df_barcodes = pd.read_csv(os.path.join(locDir,
-                                      'data/usher_barcodes_with_gisaid.csv'),
-                                      index_col=0)
-    if confirmedonly:
-        confirmed = [dfi for dfi in df_barcodes.index
-                     if 'proposed' not in dfi and 'misc' not in dfi]
-        df_barcodes = df_barcodes.loc[confirmed, :]
-
-    # drop intra-lineage diversity naming (keeps separate barcodes)
-    indexSimplified = [dfi.split('_')[0] for dfi in df_barcodes.index]
-    df_barcodes = df_barcodes.loc[indexSimplified, :]
-
-    muts = list(df_barcodes.columns)
-    mapDict = buildLineageMap(meta)
+          covcut, confirmedonly, wgisaid, sitecache, outformat, server):
+    check_sample_inputs(variants, depths, server)
+    if server is not None:
+        from freyja.server import reference_config, request
+        req = {'variants': os.path.abspath(variants),
+               'depths': os.path.abspath(depths),
+               'name': variants, 'output': os.path.abspath(output),
+               'eps': eps, 'covcut': covcut, 'outformat': outformat,
+               'sitecache': (None if sitecache is None
+                             else os.path.abspath(sitecache)),
+               'reference': reference_config(barcodes, meta, confirmedonly,
+                                             wgisaid)}
+        try:
+            request(server, '/demix', req)
+        except (OSError, RuntimeError) as e:
+            raise click.ClickException(f'demix on {server} failed: {e}')
+        return
+    from freyja.redemix import save_site_table
+    from freyja.sample_deconv import build_output_series, write_output
+    from freyja.session import Session
+
+    session = Session(barcodes, meta, confirmedonly, wgisaid)
     print('building mix/depth matrices')
     # assemble data from (possibly) mixed samples
-    mix, depths_, cov = build_mix_and_depth_arrays(variants, depths, muts,
-                                                   covcut)
+    freqs, siteDepths, cov = session.site_table((variants, depths), covcut)
     print('demixing')
-    df_barcodes, mix, depths_ = reindex_dfs(df_barcodes, mix, depths_)
-    sample_strains, abundances, error = solve_demixing_problem(df_barcodes,
-                                                               mix,
-                                                               depths_,
-                                                               eps)
-    # merge intra-lineage diversity if multiple hits.
-    if len(set(sample_strains)) < len(sample_strains):
-        localDict = {}
-        for jj, lin in enumerate(sample_strains):
-            if lin not in localDict.keys():
-                localDict[lin] = abundances[jj]
-            else:
-                localDict[lin] += abundances[jj]
-        # ensure descending order
-        localDict = dict(sorted(localDict.items(),
-                                key=lambda x: x[1],
-                                reverse=True))
-        sample_strains = list(localDict.keys())
-        abundances = list(localDict.values())
-
-    localDict = map_to_constellation(sample_strains, abundances, mapDict)
-    # assemble into series and write.
-    sols_df = pd.Series(data=(localDict, sample_strains, abundances,
-                              error, cov),
-                        index=['summarized', 'lineages',
-                        'abundances', 'resid', 'coverage'],
-                        name=mix.name)
-    # convert lineage/abundance readouts to single line strings
-    sols_df['lineages'] = ' '.join(sols_df['lineages'])
-    sols_df['abundances'] = ['%.8f' % ab for ab in sols_df['abundances']]
-    sols_df['abundances'] = ' '.join(sols_df['abundances'])
-    sols_df.to_csv(output, sep='\t')
+    sample_strains, abundances, error = session.solve(freqs, siteDepths,
+                                                      variants, eps)
+    sols_df = build_output_series(sample_strains, abundances, error, cov,
+                                  session.mapDict, variants,
+                                  structured=(outformat == 'jsonl'))
+    write_output(sols_df, output, outformat)
+    if sitecache is not None:
+        # keep the site table around so `freyja redemix` can re-solve
+        # this sample after a barcode update without the raw inputs
+        save_site_table(sitecache, freqs, siteDepths, sample_strains,
+                        abundances, error, cov, eps, session.barcodes,
+                        output, variants, session.mapDict, outformat)
+
+
+@cli.command()
+@click.option('--socket', 'socket_path', default=None, type=click.Path(),
+              help='listen on a UNIX socket instead of a localhost port')
+@click.option('--port', default=8765, help='localhost port to listen on')
+@click.option('--nt', default=1, help='number of worker processes')
+@click.option('--barcodes', default='-1', help='custom barcode file')
+@click.option('--meta', default='-1', help='custom lineage metadata file')
+@click.option('--confirmedonly', is_flag=True, default=False)
+@click.option('--wgisaid', is_flag=True, default=False,
+              help='larger library with non-public lineages')
+@click.option('--outdir', default='.', type=click.Path(file_okay=False),
+              help='directory requests may write their outputs below')
+def serve(socket_path, port, nt, barcodes, meta, confirmedonly, wgisaid,
+          outdir):
+    from freyja.server import reference_config, serve as _serve
+    from freyja.session import Session
+
+    print('loading barcodes and lineage map')
+    session = Session(barcodes, meta, confirmedonly, wgisaid)
+    _serve(session, reference_config(barcodes, meta, confirmedonly, wgisaid),
+           socketPath=socket_path, port=port, n_jobs=nt, outdir=outdir)
+
+
+@cli.command()
+@click.argument('sitecache', type=click.Path(exists=True))
+@click.option('--eps', default=1e-3, help='minimum abundance to include')
+@click.option('--barcodes', default='-1', help='custom barcode file')
+@click.option('--meta', default='-1', help='custom lineage metadata file')
+@click.option('--outdir', default='-1',
+              help='directory for outputs (default: overwrite originals)')
+@click.option('--nt', default=1, help='max number of cpus to use')
+@click.option('--full', is_flag=True, default=False,
+              help='re-solve every cached sample')
+@click.option('--confirmedonly', is_flag=True, default=False)
+@click.option('--wgisaid', is_flag=True, default=False,
+              help='larger library with non-public lineages')
+def redemix(sitecache, eps, barcodes, meta, outdir, nt, full,
+            confirmedonly, wgisaid):
+    from freyja.redemix import redemix as _redemix
+    from freyja.sample_deconv import buildLineageMap, load_barcodes
+
+    df_barcodes = load_barcodes(barcodes, confirmedonly, wgisaid)
+    mapDict = buildLineageMap(meta)
+    if outdir == '-1':
+        outdir = None
+    nSolved, nTotal = _redemix(sitecache, df_barcodes, eps, mapDict,
+                               outdir=outdir, n_jobs=nt, full=full)
+    print(f'redemix: re-solved {nSolved} of {nTotal} cached samples')
 
 
 @cli.command()
@@ -128,6 +160,14 @@ def demix(variants, depths, output, eps, barcodes, meta,
 @click.option('--buildlocal', is_flag=True, default=False,
               help='Perform barcode building locally')
 def update(outdir, noncl, wgisaid, buildlocal):
+    import pandas as pd
+    from freyja.convert_paths2barcodes import parse_tree_paths,\
+        convert_to_barcodes, reversion_checking, check_mutation_chain
+    from freyja.updates import download_tree, convert_tree,\
+        get_curated_lineage_data, get_cl_lineages,\
+        download_barcodes, download_barcodes_wgisaid
+    from freyja.utils import load_lineage_index, write_lineage_index
+
     locDir = os.path.abspath(os.path.join(os.path.realpath(__file__),
                                           os.pardir))
     if outdir != '-1':
@@ -139,6 +179,7 @@ def update(outdir, noncl, wgisaid, buildlocal):
     print('Getting outbreak data')
     get_curated_lineage_data(locDir)
     get_cl_lineages(locDir)
+    write_lineage_index(os.path.join(locDir, 'lineages.yml'))
     # # get data from UShER
     if buildlocal:
         print('Downloading a new global tree')
@@ -158,13 +199,8 @@ def update(outdir, noncl, wgisaid, buildlocal):
         # since usher tree can be ahead of cov-lineages,
         # we drop lineages not in cov-lineages
         if noncl:
-            # read linages.yml file
-            with open(os.path.join(locDir, 'lineages.yml'), 'r') as f:
-                try:
-                    lineages_yml = yaml.safe_load(f)
-                except yaml.YAMLError as exc:
-                    raise ValueError('Error in lineages.yml file: ' + str(exc))
-            lineageNames = [lineage['name'] for lineage in lineages_yml]
+            lineageNames = load_lineage_index(
+                os.path.join(locDir, 'lineages.yml'))['names']
             df_barcodes = df_barcodes.loc[df_barcodes.index.isin(lineageNames)]
         else:
             print("Including lineages not yet in cov-lineages.")
@@ -195,14 +231,11 @@ def update(outdir, noncl, wgisaid, buildlocal):
 @click.option('--minq', help='Minimum base quality score',
               default=20)
 def variants(bamfile, ref, variants, depths, refname, minq):
-    if len(refname) == 0:
-        bashCmd = f"samtools mpileup -aa -A -d 600000 -Q {minq} -q 0 -B -f "\
-                  f"{ref} {bamfile} | tee >(cut -f1-4 > {depths}) |"\
-                  f" ivar variants -p {variants} -q {minq} -t 0.0 -r {ref}"
-    else:
-        bashCmd = f"samtools mpileup -aa -A -d 600000 -Q {minq} -q 0 -B -f "\
-                  f"{ref} {bamfile} -r {refname} | tee >(cut -f1-4 > {depths}"\
-                  f") | ivar variants -p {variants} -q {minq} -t 0.0 -r {ref}"
+    import shlex
+    from freyja.pipeline import pileup_command
+
+    bashCmd = pileup_command(bamfile, ref, variants, shlex.quote(depths),
+                             refname, minq)
     sys.stdout.flush()  # force python to flush
     completed = subprocess.run(bashCmd, shell=True, executable="/bin/bash",
                                stdout=subprocess.PIPE)
@@ -210,8 +243,65 @@ def variants(bamfile, ref, variants, depths, refname, minq):
 
 
 @cli.command()
-@click.argument('variants', type=click.Path(exists=True))
-@click.argument('depths', type=click.Path(exists=True))
+@click.option('--manifest', required=True, type=click.Path(exists=True),
+              help='tab separated sample list, with sample and bam columns')
+@click.option('--outdir', default='.', type=click.Path(),
+              help='directory for the demix outputs')
+@click.option('--ref', help='Reference',
+              default=os.path.join(locDir,
+                                   'data/NC_045512_Hu-1.fasta'),
+              type=click.Path())
+@click.option('--refname', help='Ref name (for bams with multiple sequences)',
+              default='')
+@click.option('--minq', help='Minimum base quality score',
+              default=20)
+@click.option('--eps', default=1e-3, help='minimum abundance to include')
+@click.option('--covcut', default=10, help='depth cutoff for\
+                                            coverage estimate')
+@click.option('--barcodes', default='-1', help='custom barcode file')
+@click.option('--meta', default='-1', help='custom lineage metadata file')
+@click.option('--confirmedonly', is_flag=True, default=False)
+@click.option('--wgisaid', is_flag=True, default=False,
+              help='larger library with non-public lineages')
+@click.option('--outformat', default='tsv',
+              type=click.Choice(['tsv', 'jsonl']),
+              help='tsv, or structured json lines output')
+@click.option('--nb', default=0,
+              help='number of bootstraps per sample (0: no bootstrap)')
+@click.option('--boxplot', default='',
+              help='file format of boxplot output (e.g. pdf or png)')
+@click.option('--nt', default=1, help='number of solver processes')
+@click.option('--pileups', default=2,
+              help='number of pileups running at the same time')
+@click.option('--keep-intermediates', 'keep_intermediates', is_flag=True,
+              default=False,
+              help='also write variants/depth files, to outdir/variants')
+def run(manifest, outdir, ref, refname, minq, eps, covcut, barcodes, meta,
+        confirmedonly, wgisaid, outformat, nb, boxplot, nt, pileups,
+        keep_intermediates):
+    from freyja.pipeline import read_manifest, run_manifest
+    from freyja.session import Session
+
+    try:
+        samples = read_manifest(manifest)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    session = Session(barcodes, meta, confirmedonly, wgisaid)
+    failed = run_manifest(samples, session, outdir, ref, refname, minq,
+                          covcut, eps, outformat, nb, boxplot, n_jobs=nt,
+                          pileups=pileups,
+                          keep_intermediates=keep_intermediates)
+    print(f'run: {len(samples) - len(failed)} of {len(samples)} samples '
+          'demixed')
+    for name, e in failed.items():
+        print(f'{name}: {e}', file=sys.stderr)
+    if len(failed) > 0:
+        sys.exit(1)
+
+
+@cli.command()
+@click.argument('variants', type=click.Path(exists=True, allow_dash=True))
+@click.argument('depths', type=click.Path(exists=True, allow_dash=True))
 @click.option('--nb', default=100, help='number of bootstraps')
 @click.option('--nt', default=1, help='max number of cpus to use')
 @click.option('--eps', default=1e-3, help='minimum abundance to include')
@@ -224,42 +314,30 @@ def variants(bamfile, ref, variants, depths, refname, minq):
 @click.option('--confirmedonly', is_flag=True, default=False)
 @click.option('--wgisaid', is_flag=True, default=False,
               help='larger library with non-public lineages')
+@click.option('--server', default=None,
+              help='send to a running `freyja serve` (port or socket path)')
 def boot(variants, depths, output_base, eps, barcodes, meta,
-         nb, nt, boxplot, confirmedonly, wgisaid):
-    locDir = os.path.abspath(os.path.join(os.path.realpath(__file__),
-                             os.pardir))
-    # option for custom barcodes
-    if barcodes != '-1':
-        df_barcodes = pd.read_csv(barcodes, index_col=0)
-    else:
-        if not wgisaid:
-            df_barcodes = pd.read_csv(os.path.join(locDir,
-                                      'data/usher_barcodes.csv'), index_col=0)
-        else:
-            df_barcodes = pd.read_csv(os.path.join(locDir,
-                                      'data/usher_barcodes_with_gisaid.csv'),
-                                      index_col=0)
-    if confirmedonly:
-        confirmed = [dfi for dfi in df_barcodes.index
-                     if 'proposed' not in dfi and 'misc' not in dfi]
-        df_barcodes = df_barcodes.loc[confirmed, :]
-
-    # drop intra-lineage diversity naming (keeps separate barcodes)
-    indexSimplified = [dfi.split('_')[0] for dfi in df_barcodes.index]
-    df_barcodes = df_barcodes.loc[indexSimplified, :]
-
-    muts = list(df_barcodes.columns)
-    mapDict = buildLineageMap(meta)
-    print('building mix/depth matrices')
-    # assemble data from (possibly) mixed samples
-    covcut = 10  # set value, coverage estimate not returned to user from boot
-    mix, depths_, cov = build_mix_and_depth_arrays(variants, depths, muts,
-                                                   covcut)
+         nb, nt, boxplot, confirmedonly, wgisaid, server):
+    check_sample_inputs(variants, depths, server)
+    if server is not None:
+        from freyja.server import reference_config, request
+        req = {'variants': os.path.abspath(variants),
+               'depths': os.path.abspath(depths),
+               'output_base': os.path.abspath(output_base),
+               'nb': nb, 'eps': eps, 'boxplot': boxplot,
+               'reference': reference_config(barcodes, meta, confirmedonly,
+                                             wgisaid)}
+        try:
+            request(server, '/boot', req)
+        except (OSError, RuntimeError) as e:
+            raise click.ClickException(f'boot on {server} failed: {e}')
+        return
+    from freyja.session import Session
+
+    session = Session(barcodes, meta, confirmedonly, wgisaid)
     print('demixing')
-    df_barcodes, mix, depths_ = reindex_dfs(df_barcodes, mix, depths_)
-    lin_out, constell_out = perform_bootstrap(df_barcodes, mix, depths_,
-                                              nb, eps, nt, mapDict, muts,
-                                              boxplot, output_base)
+    lin_out, constell_out = session.boot((variants, depths), nb, eps, nt,
+                                         boxplot, output_base)
     lin_out.to_csv(output_base + '_lineages.csv')
     constell_out.to_csv(output_base + '_summarized.csv')
 
@@ -269,28 +347,67 @@ def boot(variants, depths, output_base, eps, barcodes, meta,
 @click.option('--ext', default='-1', help='file extension option')
 @click.option('--output', default='aggregated_result.tsv', help='Output file',
               type=click.Path(exists=False))
-def aggregate(results, ext, output):
+@click.option('--recursive', is_flag=True, default=False,
+              help='include results in subdirectories')
+@click.option('--nt', default=1, help='max number of threads to use')
+@click.option('--incremental', is_flag=True, default=False,
+              help='only add new or changed results to an existing output')
+@click.option('--outformat', default='tsv',
+              type=click.Choice(['tsv', 'jsonl']),
+              help='tsv, or structured json lines output')
+def aggregate(results, ext, output, recursive, nt, incremental, outformat):
+    from freyja.utils import agg, agg_incremental, write_agg
+
     if ext != '-1':
-        results_ = [fn for fn in glob.glob(results + '*' + ext)]
+        pattern = '*' + ext
     else:
-        results_ = [results + fn for fn in os.listdir(results)]
-    df_demix = agg(results_)
-    df_demix.to_csv(output, sep='\t')
+        pattern = '*'
+    if recursive:
+        results_ = glob.glob(os.path.join(results, '**', pattern),
+                             recursive=True)
+    else:
+        results_ = glob.glob(os.path.join(results, pattern))
+    results_ = sorted(fn for fn in results_ if os.path.isfile(fn))
+    if incremental:
+        df_demix, nParsed = agg_incremental(results_, output, n_jobs=nt,
+                                            outformat=outformat)
+        print(f'aggregate: parsed {nParsed} new or changed result files')
+    else:
+        df_demix = agg(results_, n_jobs=nt)
+        write_agg(df_demix, output, outformat)
 
 
 @cli.command()
 @click.argument('agg_results', type=click.Path(exists=True))
-@click.option('--lineages', is_flag=True)
+@click.option('--lineages/--summarized', 'lineages', multiple=True,
+              help='plot lineages, or summarized constellations (default)')
 @click.option('--times', default='-1')
-@click.option('--interval', default='MS')
+@click.option('--interval', default=['MS'], multiple=True)
 @click.option('--config', default=None, help='path to yaml file')
 @click.option('--mincov', default=60., help='min genome coverage included')
-@click.option('--output', default='mix_plot.pdf', help='Output file')
+@click.option('--output', default=['mix_plot.pdf'], multiple=True,
+              help='Output file')
 @click.option('--windowsize', default=14)
+@click.option('--nt', default=1, help='max number of cpus to use')
 def plot(agg_results, lineages, times, interval, output, windowsize,
-         config, mincov):
-    agg_df = pd.read_csv(agg_results, skipinitialspace=True, sep='\t',
-                         index_col=0)
+         config, mincov, nt):
+    import pandas as pd
+    import yaml
+    from freyja.utils import read_agg, drop_empty_samples, make_plots,\
+        checkConfig, load_lineage_info
+
+    # --output, --interval and --lineages/--summarized can be repeated, the
+    # k-th plot uses the k-th value of each (or its only value)
+    lineages = lineages if len(lineages) > 0 else (False,)
+    nPlots = len(output)
+    for name, vals in [('--interval', interval),
+                       ('--lineages/--summarized', lineages)]:
+        if len(vals) not in (1, nPlots):
+            raise click.UsageError(f'{name} must be given once or once per '
+                                   '--output')
+    plots = [(output[k], interval[min(k, len(interval) - 1)],
+              lineages[min(k, len(lineages) - 1)]) for k in range(nPlots)]
+    agg_df = read_agg(agg_results)
     # drop poor quality samples
     if 'coverage' in agg_df.columns:
         agg_df = agg_df[agg_df['coverage'] > mincov]
@@ -304,36 +421,24 @@ to include coverage estimates.')
             except yaml.YAMLError as exc:
                 raise ValueError('Error in config file: ' + str(exc))
 
-    with open(os.path.join(locDir, 'data/lineages.yml'), 'r') as f:
-        try:
-            lineages_yml = yaml.safe_load(f)
-        except yaml.YAMLError as exc:
-            raise ValueError('lineages.yml error, run update: ' + str(exc))
-
-    # converts lineages_yml to a dictionary where the lineage names are the
-    # keys.
-    lineage_info = {}
-    for lineage in lineages_yml:
-        lineage_info[lineage['name']] = {'name': lineage['name'],
-                                         'children': lineage['children']}
+    lineage_info = load_lineage_info(os.path.join(locDir,
+                                                  'data/lineages.yml'))
     if config is not None:
         config = checkConfig(config)
     else:
         config = {}
-    agg_df['abundances'] = agg_df['abundances'].astype(str)
-    agg_df['summarized'] = agg_df['summarized'].astype(str)
-    agg_df = agg_df[agg_df['summarized'] != '[]']
+    agg_df = drop_empty_samples(agg_df)
     if times == '-1':
-        # make basic plot, without time info
-        makePlot_simple(agg_df, lineages, output, config, lineage_info)
+        # make basic plots, without time info
+        times_df = None
     else:
-        # make time aware plot
+        # make time aware plots
         times_df = pd.read_csv(times, skipinitialspace=True,
                                index_col=0)
         times_df['sample_collection_datetime'] = \
             pd.to_datetime(times_df['sample_collection_datetime'])
-        makePlot_time(agg_df, lineages, times_df, interval, output,
-                      windowsize, config, lineage_info)
+    make_plots(agg_df, plots, config, lineage_info, times_df=times_df,
+               windowSize=windowsize, n_jobs=nt)
 
 
 @cli.command()
@@ -353,20 +458,44 @@ to include coverage estimates.')
 @click.option('--output', default='mydashboard.html', help='Output html file')
 @click.option('--days', default=56, help='N Days used for growth calc')
 @click.option('--grthresh', default=0.05, help='min avg prev. for growth')
+@click.option('--method', default='logistic',
+              type=click.Choice(['logistic', 'multinomial']),
+              help='per-lineage logistic fits with bootstrap CIs, or a ' +
+              'single multinomial fit across lineages')
+@click.option('--nt', default=1, help='max number of cpus to use')
+@click.option('--seed', default=None, type=int,
+              help='seed for reproducible bootstrap intervals')
+@click.option('--cache', default=None, type=click.Path(),
+              help='json file caching per-lineage growth fits between runs')
+@click.option('--datafile', default=None, type=click.Path(),
+              help='write the plot data to a json file loaded by the page')
+@click.option('--offline', is_flag=True, default=False,
+              help='include plotly.js in the page (~4.7 MB), so it ' +
+              'displays without internet access')
+@click.option('--site_column', '--site-column', default=None,
+              help='metadata column naming the site of each sample, ' +
+              'to make one dashboard per site')
+@click.option('--outdir', default='dashboards', type=click.Path(),
+              help='output directory for per-site dashboards')
 @click.argument('hierarchy', type=click.Path(),
                 default=os.path.join(locDir, 'data/lineages.yml'))
 def dash(agg_results, metadata, title, intro, thresh, headercolor, bodycolor,
          scale_by_viral_load, nboots, serial_interval, config, mincov, output,
-         days, grthresh, hierarchy):
-    agg_df = pd.read_csv(agg_results, skipinitialspace=True, sep='\t',
-                         index_col=0)
+         days, grthresh, method, nt, seed, cache, datafile, offline,
+         site_column, outdir, hierarchy):
+    import pandas as pd
+    import yaml
+    from freyja.utils import read_agg, drop_empty_samples, make_dashboard,\
+        make_site_dashboards, checkConfig, load_lineage_info
+
+    agg_df = read_agg(agg_results)
     # drop poor quality samples
     if 'coverage' in agg_df.columns:
         agg_df = agg_df[agg_df['coverage'] > mincov]
     else:
         print('WARNING: Freyja should be updated ' +
               'to include coverage estimates.')
-    agg_df = agg_df[agg_df['summarized'] != '[]']
+    agg_df = drop_empty_samples(agg_df)
 
     meta_df = pd.read_csv(metadata, index_col=0)
     meta_df['sample_collection_datetime'] = \
@@ -383,25 +512,25 @@ def dash(agg_results, metadata, title, intro, thresh, headercolor, bodycolor,
             except yaml.YAMLError as exc:
                 raise ValueError('Error in config file: ' + str(exc))
 
-    with open(hierarchy, 'r') as f:
-        try:
-            lineages_yml = yaml.safe_load(f)
-        except yaml.YAMLError as exc:
-            raise ValueError('lineages.yml error, run update: ' + str(exc))
-
-    # converts lineages_yml to a dictionary where the lineage names are the
-    # keys.
-    lineage_info = {}
-    for lineage in lineages_yml:
-        lineage_info[lineage['name']] = {'name': lineage['name'],
-                                         'children': lineage['children']}
+    lineage_info = load_lineage_info(hierarchy)
     if config is not None:
         config = checkConfig(config)
     else:
         config = {}
-    make_dashboard(agg_df, meta_df, thresh, titleText, introText,
-                   output, headercolor, bodycolor, scale_by_viral_load, config,
-                   lineage_info, nboots, serial_interval, days, grthresh)
+    if site_column is not None:
+        make_site_dashboards(agg_df, meta_df, site_column, outdir, thresh,
+                             titleText, introText, headercolor, bodycolor,
+                             scale_by_viral_load, config, lineage_info,
+                             nboots, serial_interval, days, grthresh,
+                             method=method, seed=seed, n_jobs=nt,
+                             cacheFn=cache, dataFn=datafile,
+                             offline=offline)
+    else:
+        make_dashboard(agg_df, meta_df, thresh, titleText, introText,
+                       output, headercolor, bodycolor, scale_by_viral_load,
+                       config, lineage_info, nboots, serial_interval, days,
+                       grthresh, method, seed=seed, n_jobs=nt, cacheFn=cache,
+                       dataFn=datafile, offline=offline)
 
 
 @cli.command()
@@ -418,17 +547,31 @@ def dash(agg_results, metadata, title, intro, thresh, headercolor, bodycolor,
               help='Output html file')
 @click.option('--days', default=56, help='N Days used for growth calc')
 @click.option('--grthresh', default=0.05, help='min avg prev. for growth')
+@click.option('--method', default='logistic',
+              type=click.Choice(['logistic', 'multinomial']),
+              help='per-lineage logistic fits with bootstrap CIs, or a ' +
+              'single multinomial fit across lineages')
+@click.option('--nt', default=1, help='max number of cpus to use')
+@click.option('--seed', default=None, type=int,
+              help='seed for reproducible bootstrap intervals')
+@click.option('--cache', default=None, type=click.Path(),
+              help='json file caching per-lineage growth fits between runs')
 def relgrowthrate(agg_results, metadata, thresh, scale_by_viral_load, nboots,
-                  serial_interval, config, mincov, output, days, grthresh):
-    agg_df = pd.read_csv(agg_results, skipinitialspace=True, sep='\t',
-                         index_col=0)
+                  serial_interval, config, mincov, output, days, grthresh,
+                  method, nt, seed, cache):
+    import pandas as pd
+    import yaml
+    from freyja.utils import read_agg, drop_empty_samples, checkConfig,\
+        get_abundance, calc_rel_growth_rates, load_lineage_info
+
+    agg_df = read_agg(agg_results)
     # drop poor quality samples
     if 'coverage' in agg_df.columns:
         agg_df = agg_df[agg_df['coverage'] > mincov]
     else:
         print('WARNING: Freyja should be updated ' +
               'to include coverage estimates.')
-    agg_df = agg_df[agg_df['summarized'] != '[]']
+    agg_df = drop_empty_samples(agg_df)
 
     meta_df = pd.read_csv(metadata, index_col=0)
     meta_df['sample_collection_datetime'] = \
@@ -440,18 +583,8 @@ def relgrowthrate(agg_results, metadata, thresh, scale_by_viral_load, nboots,
             except yaml.YAMLError as exc:
                 raise ValueError('Error in config file: ' + str(exc))
 
-    with open(os.path.join(locDir, 'data/lineages.yml'), 'r') as f:
-        try:
-            lineages_yml = yaml.safe_load(f)
-        except yaml.YAMLError as exc:
-            raise ValueError('lineages.yml error, run update: ' + str(exc))
-
-    # converts lineages_yml to a dictionary where the lineage names are the
-    # keys.
-    lineage_info = {}
-    for lineage in lineages_yml:
-        lineage_info[lineage['name']] = {'name': lineage['name'],
-                                         'children': lineage['children']}
+    lineage_info = load_lineage_info(os.path.join(locDir,
+                                                  'data/lineages.yml'))
     if config is not None:
         config = checkConfig(config)
     else:
@@ -462,7 +595,8 @@ def relgrowthrate(agg_results, metadata, thresh, scale_by_viral_load, nboots,
                                                         config, lineage_info)
     calc_rel_growth_rates(df_ab_lin.copy(deep=True), nboots,
                           serial_interval, output, daysIncluded=days,
-                          grThresh=grthresh)
+                          grThresh=grthresh, method=method, seed=seed,
+                          n_jobs=nt, cacheFn=cache)
 
 
 @cli.command()
@@ -475,6 +609,7 @@ def relgrowthrate(agg_results, metadata, thresh, scale_by_viral_load, nboots,
                     same read')
 @click.option('--refname', default='NC_045512.2')
 def extract(query_mutations, input_bam, output, refname, same_read):
+    from freyja.read_analysis_tools import extract as _extract
     _extract(query_mutations, input_bam, output, refname, same_read)
 
 
@@ -487,6 +622,7 @@ def extract(query_mutations, input_bam, output, refname, same_read):
               help='path to save filtered reads')
 @click.option('--refname', default='NC_045512.2')
 def filter(query_mutations, input_bam, min_site, max_site, output, refname):
+    from freyja.read_analysis_tools import filter as _filter
     _filter(query_mutations, input_bam, min_site, max_site, output, refname)
 
 
@@ -515,6 +651,7 @@ def filter(query_mutations, input_bam, min_site, max_site, output, refname):
 def covariants(input_bam, min_site, max_site, output, refname,
                ref_fasta, gff_file, min_quality, min_count, spans_region,
                sort_by):
+    from freyja.read_analysis_tools import covariants as _covariants
     _covariants(input_bam, min_site, max_site, output, refname,
                 ref_fasta, gff_file, min_quality, min_count, spans_region,
                 sort_by)
@@ -529,6 +666,7 @@ def covariants(input_bam, min_site, max_site, output, refname,
               help=('if included, include nucleotide mutations in mut labels'
                     ))
 def plot_covariants(covar_file, output, min_mutations, nt_muts):
+    from freyja.read_analysis_tools import plot_covariants as _plot_covariants
     _plot_covariants(covar_file, output, min_mutations, nt_muts)
 
 
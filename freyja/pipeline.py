@@ -0,0 +1,190 @@
+import csv
+import io
+import multiprocessing
+import os
+import queue
+import shlex
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# `freyja run`: BAM -> pileup -> site table -> demix (-> boot) for every
+# sample of a manifest in one process tree. Pileups run in a few threads
+# (each waiting on its samtools/ivar subprocess) and hand their site tables
+# over a bounded queue to a pool of solver processes holding a Session, so
+# pileups of the next samples overlap with solving the previous ones. The
+# variants/depth outputs are streamed back (ivar through a FIFO) and only
+# written to disk when asked for.
+
+_session = None
+
+
+def pileup_command(bamfile, ref, variants, depths, refname='', minq=20):
+    # the samtools/ivar pipeline behind `freyja variants`
+    q = shlex.quote
+    region = '' if len(refname) == 0 else f' -r {q(refname)}'
+    return f"samtools mpileup -aa -A -d 600000 -Q {minq} -q 0 -B -f "\
+           f"{q(ref)} {q(bamfile)}{region} | tee >(cut -f1-4 > {depths}) |"\
+           f" ivar variants -p {q(variants)} -q {minq} -t 0.0 -r {q(ref)}"
+
+
+def read_manifest(fn):
+    # tab separated with a header: a `sample` column, and either `bam` or
+    # `variants` and `depths` (samples that were already called). Relative
+    # paths are taken from the manifest's directory.
+    baseDir = os.path.dirname(os.path.abspath(fn))
+    with open(fn, newline='') as f:
+        rows = list(csv.DictReader(f, delimiter='\t'))
+    samples = []
+    for row in rows:
+        if 'sample' not in row or not ({'bam'} <= row.keys() or
+                                       {'variants', 'depths'} <= row.keys()):
+            raise ValueError(fn + ' needs a sample column, and a bam or '
+                             'variants and depths columns')
+        sample = {'sample': row['sample']}
+        for col in ['bam', 'variants', 'depths']:
+            if row.get(col):
+                sample[col] = os.path.join(baseDir, row[col])
+        samples.append(sample)
+    names = [s['sample'] for s in samples]
+    if len(set(names)) < len(names):
+        raise ValueError(fn + ' lists some samples more than once')
+    return samples
+
+
+def _hold_fifo(path):
+    # Open a FIFO for reading, together with a write end of our own. The
+    # reader only sees the end of the data once that write end is closed
+    # too, so it can't block forever, nor stop early, whatever the writing
+    # subprocess does.
+    import fcntl
+    rfd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    wfd = os.open(path, os.O_WRONLY)
+    fcntl.fcntl(rfd, fcntl.F_SETFL,
+                fcntl.fcntl(rfd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+    return os.fdopen(rfd, 'rb'), wfd
+
+
+def _pileup(bamfile, ref, refname, minq):
+    # runs the pileup of one bam, returning the ivar and depth outputs.
+    # ivar writes into a FIFO, the depths come back on stdout.
+    with tempfile.TemporaryDirectory() as tmpDir:
+        fifo = os.path.join(tmpDir, 'variants.tsv')
+        os.mkfifo(fifo)
+        varFile, holder = _hold_fifo(fifo)
+        cmd = 'set -o pipefail; { ' +\
+            pileup_command(bamfile, ref, fifo, '/dev/fd/3', refname, minq) +\
+            '; } 3>&1 1>/dev/null'
+        proc = subprocess.Popen(cmd, shell=True, executable='/bin/bash',
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        with varFile, ThreadPoolExecutor(max_workers=2) as ex:
+            varData = ex.submit(varFile.read)
+            errors = ex.submit(proc.stderr.read)
+            try:
+                depthData = proc.stdout.read()
+                proc.wait()
+            finally:
+                os.close(holder)
+            varData = varData.result()
+    if proc.returncode != 0:
+        raise RuntimeError(bamfile + ': ' +
+                           errors.result().decode().strip())
+    return varData, depthData
+
+
+def site_table(sample, ref, refname='', minq=20, covcut=10, keepDir=None):
+    from freyja.sample_deconv import read_site_table, read_depths,\
+        read_snv_frequencies_ivar, site_table_from_frames
+
+    if 'bam' not in sample:
+        return read_site_table(sample['variants'], sample['depths'], covcut)
+    varData, depthData = _pileup(sample['bam'], ref, refname, minq)
+    if keepDir is not None:
+        for data, ext in [(varData, '.variants.tsv'), (depthData, '.depth')]:
+            with open(os.path.join(keepDir, sample['sample'] + ext),
+                      'wb') as f:
+                f.write(data)
+    df = read_snv_frequencies_ivar(io.BytesIO(varData), None, None)
+    return site_table_from_frames(df, read_depths(io.BytesIO(depthData)),
+                                  covcut)
+
+
+def _init_worker(session):
+    global _session
+    _session = session
+
+
+def _solve(name, freqs, siteDepths, cov, output, eps, outformat, nb,
+           bootBase, boxplot):
+    from freyja.sample_deconv import build_output_series, write_output
+
+    sample_strains, abundances, error = _session.solve(freqs, siteDepths,
+                                                       name, eps)
+    sols_df = build_output_series(sample_strains, abundances, error, cov,
+                                  _session.mapDict, name,
+                                  structured=(outformat == 'jsonl'))
+    write_output(sols_df, output, outformat)
+    if nb > 0:
+        lin_out, constell_out = _session.boot((freqs, siteDepths), nb, eps,
+                                              1, boxplot, bootBase)
+        lin_out.to_csv(bootBase + '_lineages.csv')
+        constell_out.to_csv(bootBase + '_summarized.csv')
+    return name
+
+
+def run_manifest(samples, session, outdir, ref, refname='', minq=20,
+                 covcut=10, eps=1e-3, outformat='tsv', nb=0, boxplot='',
+                 n_jobs=1, pileups=2, keep_intermediates=False):
+    # Returns the names of the samples that failed, with the error. Demix
+    # outputs go to outdir/<sample>.<outformat>, bootstrap percentiles to
+    # outdir/boot and kept variants/depth files to outdir/variants.
+    os.makedirs(outdir, exist_ok=True)
+    keepDir = None
+    if keep_intermediates:
+        keepDir = os.path.join(outdir, 'variants')
+        os.makedirs(keepDir, exist_ok=True)
+    if nb > 0:
+        os.makedirs(os.path.join(outdir, 'boot'), exist_ok=True)
+
+    # site tables wait here for a free solver, pileups stall when it's full
+    tables = queue.Queue(maxsize=n_jobs)
+    solvers = threading.Semaphore(n_jobs)
+    failed = {}
+
+    def produce(sample):
+        try:
+            item = site_table(sample, ref, refname, minq, covcut, keepDir)
+        except Exception as e:
+            item = e
+        tables.put((sample['sample'], item))
+
+    def solved(name, fut):
+        solvers.release()
+        if fut.exception() is not None:
+            failed[name] = fut.exception()
+
+    # the solvers are started clean rather than forked from a process
+    # whose pileup threads may hold locks
+    ctx = multiprocessing.get_context('spawn')
+    with ThreadPoolExecutor(max_workers=pileups) as producers,\
+            ProcessPoolExecutor(max_workers=n_jobs, mp_context=ctx,
+                                initializer=_init_worker,
+                                initargs=(session,)) as pool:
+        for sample in samples:
+            producers.submit(produce, sample)
+        for _ in range(len(samples)):
+            solvers.acquire()
+            name, item = tables.get()
+            if isinstance(item, Exception):
+                solvers.release()
+                failed[name] = item
+                continue
+            freqs, siteDepths, cov = item
+            output = os.path.join(outdir, name + '.' + outformat)
+            bootBase = os.path.join(outdir, 'boot', name)
+            fut = pool.submit(_solve, name, freqs, siteDepths, cov, output,
+                              eps, outformat, nb, bootBase, boxplot)
+            fut.add_done_callback(lambda f, name=name: solved(name, f))
+    return failed
@@ -1,4 +1,5 @@
-import re
+import bisect
+import numpy as np
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
@@ -7,6 +8,7 @@ import pysam
 from Bio.Seq import MutableSeq
 from Bio import SeqIO
 from matplotlib.patches import Patch
+from freyja.read_events import ReadEvents, as_bases
 
 
 def nt_position(x):
@@ -15,8 +17,9 @@ def nt_position(x):
     return int(x.split('(')[0][1:-1])
 
 
-def extract(query_mutations, input_bam, output, refname, same_read):
-    # Load data
+def _read_query(query_mutations):
+    # snps as {site: alt base}, insertions as {(site, bases)} and deletions
+    # as {(site, length)}, with 0 based reference sites
     with open(query_mutations) as infile:
         lines = infile.read().splitlines()
         snps = []
@@ -32,30 +35,78 @@ def extract(query_mutations, input_bam, output, refname, same_read):
             elif ':' in line[0]:
                 deletions = line
 
+    # parse tuples from indel strings
+    insertions = {(int(s.split(':')[0][1:]),
+                   s.split(':')[1][1:-2].strip('\''))
+                  for s in insertions}
+    deletions = {(int(s.split(':')[0][1:]), int(s.split(':')[1][:-1]))
+                 for s in deletions}
+    snps = {int(m[1:len(m)-1])-1: m[-1] for m in snps if m}
+    return snps, insertions, deletions
+
+
+def _snp_arrays(snps):
+    # query snp sites in order, with their alt bases
+    sites = sorted(snps)
+    alts = ''.join(snps[s] for s in sites)
+    return np.array(sites, dtype=np.int64), as_bases(alts)
+
+
+def _has_any(events, snpSites, snpAlts, insertions, deletions):
+    if any(ins in insertions for ins in events.insertions) or\
+            any(d in deletions for d in events.deletions):
+        return True
+    lo, hi = np.searchsorted(snpSites, [events.start, events.end])
+    return bool((events.bases_at(snpSites[lo:hi]) == snpAlts[lo:hi]).any())
+
+
+def _has_all(events, snpSites, snpAlts, insertions, deletions):
+    if not (insertions <= set(events.insertions) and
+            deletions <= set(events.deletions)):
+        return False
+    if len(snpSites) > 0 and (snpSites[0] < events.start or
+                              snpSites[-1] >= events.end):
+        return False
+    return bool((events.bases_at(snpSites) == snpAlts).all())
+
+
+def _site_reads(samfile, refname, sites, gap=500):
+    # Every read overlapping any of the query sites, once and in coordinate
+    # order. Sites closer than gap are fetched as one region (skipping the
+    # reads falling between them), and reads reaching back into the
+    # previous region were already returned from it.
+    sites = sorted(set(sites))
+    regions = [[sites[0]]]
+    for site in sites[1:]:
+        if site - regions[-1][-1] < gap:
+            regions[-1].append(site)
+        else:
+            regions.append([site])
+    regionEnd = -1
+    for region in regions:
+        for x in samfile.fetch(refname, region[0], region[-1]+1):
+            if x.reference_start < regionEnd or x.reference_end is None:
+                continue
+            k = bisect.bisect_left(region, x.reference_start)
+            if k < len(region) and region[k] < x.reference_end:
+                yield x
+        regionEnd = region[-1] + 1
+
+
+def extract(query_mutations, input_bam, output, refname, same_read):
+    # Load data
     try:
-        # parse tuples from indel strings
-        if len(insertions) > 0:
-            insertions = [
-                (int(s.split(':')[0][1:]), s.split(':')[1][1:-2].strip('\''))
-                for s in insertions
-            ]
-
-        if len(deletions) > 0:
-            deletions = [
-                (int(s.split(':')[0][1:]), int(s.split(':')[1][:-1]))
-                for s in deletions
-            ]
-
-        # get loci for all mutations
-        snp_sites = [int(m[1:len(m)-1])-1 for m in snps if m]
-        indel_sites = [s[0] for s in insertions if s] +\
-            [s[0] for s in deletions if s]
+        snps, insertions, deletions = _read_query(query_mutations)
     except Exception:
         print('extract: Error parsing', query_mutations)
         print('extract: See README for formatting requirements.')
         return -1
 
-    snp_dict = {int(mut[1:len(mut)-1])-1: mut[-1] for mut in snps if mut}
+    # get loci for all mutations
+    snpSites, snpAlts = _snp_arrays(snps)
+    all_sites = sorted(list(snps) + [s[0] for s in insertions] +
+                       [s[0] for s in deletions])
+
     print("extract: Extracting read pairs with specified mutations")
     try:
         samfile = pysam.AlignmentFile(input_bam, 'rb')
@@ -64,140 +115,23 @@ def extract(query_mutations, input_bam, output, refname, same_read):
               input_bam)
         return -1
 
-    reads_considered = []
-
-    all_sites = snp_sites + indel_sites
-    all_sites.sort()
-
-    for site in all_sites:
-        itr = samfile.fetch(refname, site, site+1)
-
-        for x in itr:
-            ref_pos = set(x.get_reference_positions())
-            start = x.reference_start
-            sites_in = list(ref_pos & set(snp_sites))
+    # reads with any of the query mutations, or all of them with same_read
+    matches = _has_all if same_read else _has_any
+    query_names = set()
 
-            seq = x.query_alignment_sequence
-
-            if x.cigarstring is None:
-                # checks for a possible fail case
-                continue
-            cigar = re.findall(r'(\d+)([A-Z]{1})', x.cigarstring)
-
-            # note: inserts add to read length, but not alignment coordinate
-            if 'I' in x.cigarstring:
-                i = 0
-                del_spacing = 0
-                ins_spacing = 0
-                ranges = []
-                insert_found = False
-                for m in cigar:
-                    if m[1] == 'I':
-                        if (start+i+del_spacing-ins_spacing,
-                                seq[i:i+int(m[0])]) in insertions:
-                            reads_considered.append(x)
-                            insert_found = True
-                            break
-                        i += int(m[0])
-                        ins_spacing += int(m[0])
-                    elif m[1] == 'D':
-                        del_spacing += int(m[0])
-                        continue
-                    elif m[1] == 'M':
-                        ranges.append([i, i+int(m[0])])
-                        i += int(m[0])
-
-                seq = ''.join([seq[r[0]:r[1]] for r in ranges])
-
-                if insert_found:
-                    continue
-
-            if 'D' in x.cigarstring:
-                i = x.reference_start
-                for m in cigar:
-                    if m[1] == 'M':
-                        i += int(m[0])
-                    elif m[1] == 'D':
-                        if (i, int(m[0])) in deletions:
-                            reads_considered.append(x)
-                            continue
-                        i += int(m[0])
-
-            c_dict = dict(zip(x.get_reference_positions(), seq))
-            for s in sites_in:
-                if snp_dict[s] == c_dict[s]:
-                    reads_considered.append(x)
-                    break
+    # one pass over the reads at the query sites, decoding each read once
+    for x in _site_reads(samfile, refname, all_sites):
+        if x.cigartuples is None:
+            # checks for a possible fail case
+            continue
+        if matches(ReadEvents(x), snpSites, snpAlts, insertions, deletions):
+            query_names.add(x.query_name[:-1])
     samfile.close()
 
-    # Same process, this time removing reads that don't contain all
-    # query mutations.
-
-    if same_read:
-        temp = reads_considered
-        reads_considered = []
-
-        for x in temp:
-            ref_pos = set(x.get_reference_positions())
-            start = x.reference_start
-            sites_in = list(ref_pos & set(snp_sites))
-            seq = x.query_alignment_sequence
-            cigar = re.findall(r'(\d+)([A-Z]{1})', x.cigarstring)
-
-            for ins in insertions:
-                i = 0
-                del_spacing = 0
-                ins_spacing = 0
-                insert_found = False
-                for m in cigar:
-                    if m[1] == 'I':
-                        if (start+i+del_spacing-ins_spacing,
-                                seq[i:i+int(m[0])]) == ins:
-                            insert_found = True
-                            break
-                        i += int(m[0])
-                        ins_spacing += int(m[0])
-                    elif m[1] == 'D':
-                        del_spacing += int(m[0])
-                    elif m[1] == 'M':
-                        i += int(m[0])
-                if not insert_found:
-                    break
-            if len(insertions) > 0 and not insert_found:
-                continue
-
-            for _del in deletions:
-                deletion_found = False
-                i = x.reference_start
-                for m in cigar:
-                    if m[1] == 'M':
-                        i += int(m[0])
-                    elif m[1] == 'D':
-                        if (i, int(m[0])) == _del:
-                            deletion_found = True
-                            break
-                        i += int(m[0])
-                if not deletion_found:
-                    break
-            if len(deletions) > 0 and not deletion_found:
-                continue
-
-            all_snps_found = True
-            c_dict = dict(zip(x.get_reference_positions(), seq))
-            for s in snp_sites:
-                if s not in sites_in or snp_dict[s] != c_dict[s]:
-                    all_snps_found = False
-                    break
-            if not all_snps_found:
-                continue
-
-            reads_considered.append(x)
-
     # Run again, this time also getting the paired read
     samfile = pysam.AlignmentFile(input_bam, 'rb')
     outfile = pysam.AlignmentFile(output, 'wb', template=samfile)
     final_reads = []
-    query_names = [x.query_name[:-1] for x in reads_considered]
 
     itr = samfile.fetch(refname, min(all_sites), max(all_sites)+1)
     for x in itr:
@@ -217,41 +151,18 @@ def extract(query_mutations, input_bam, output, refname, same_read):
 def filter(query_mutations, input_bam, min_site, max_site, output, refname):
 
     # Load data
-    with open(query_mutations) as infile:
-        lines = infile.read().splitlines()
-        snps = []
-        insertions = []
-        deletions = []
-        for line in lines:
-            line = [s.strip() for s in line.split(',')]
-            if any(n in line[0] for n in 'ACGT'):
-                if ':' in line[0]:
-                    insertions = line
-                elif len(line) > 0:
-                    snps = line
-            elif ':' in line[0]:
-                deletions = line
     try:
-        # parse tuples from indels
-        if len(insertions) > 0:
-            insertions = [(int(s.split(':')[0][1:]),
-                           s.split(':')[1][1:-2].strip('\''))
-                          for s in insertions]
-        if len(deletions) > 0:
-            deletions = [(int(s.split(':')[0][1:]), int(s.split(':')[1][:-1]))
-                         for s in deletions]
-
-        # get loci for all mutations
-        snp_sites = [int(m[1:len(m)-1])-1 for m in snps if m]
-        indel_sites = [s[0] for s in insertions if s] +\
-            [s[0] for s in deletions if s]
+        snps, insertions, deletions = _read_query(query_mutations)
     except ValueError:
         print('filter: Error parsing', query_mutations)
         print('filter: See README for formatting requirements.')
         return -1
 
-    snp_dict = {int(mut[1:len(mut)-1])-1: mut[-1] for mut in snps if mut}
-    reads_considered = []
+    # get loci for all mutations
+    snpSites, snpAlts = _snp_arrays(snps)
+    all_sites = sorted(list(snps) + [s[0] for s in insertions] +
+                       [s[0] for s in deletions])
+    reads_considered = set()
 
     try:
         samfile = pysam.AlignmentFile(input_bam, 'rb')
@@ -261,129 +172,14 @@ def filter(query_mutations, input_bam, min_site, max_site, output, refname):
         return -1
     print("filter: Filtering out reads with specified mutations")
 
-    all_sites = snp_sites + indel_sites
-    all_sites.sort()
-
-    for site in all_sites:
-        itr = samfile.fetch(refname, site, site+1)
-
-        for x in itr:
-            ref_pos = set(x.get_reference_positions())
-            start = x.reference_start
-            sites_in = list(ref_pos & set(snp_sites))
-
-            seq = x.query_alignment_sequence
-
-            if x.cigarstring is None:
-                # checks for a possible fail case
-                continue
-            cigar = re.findall(r'(\d+)([A-Z]{1})', x.cigarstring)
-
-            # note: inserts add to read length, but not alignment coordinate
-            if 'I' in x.cigarstring:
-                i = 0
-                del_spacing = 0
-                ins_spacing = 0
-                ranges = []
-                insert_found = False
-                for m in cigar:
-                    if m[1] == 'I':
-                        if (start+i+del_spacing-ins_spacing,
-                                seq[i:i+int(m[0])]) in insertions:
-                            reads_considered.append(x.query_name)
-                            insert_found = True
-                            break
-                        i += int(m[0])
-                        ins_spacing += int(m[0])
-                    elif m[1] == 'D':
-                        del_spacing += int(m[0])
-                        continue
-                    elif m[1] == 'M':
-                        ranges.append([i, i+int(m[0])])
-                        i += int(m[0])
-
-                seq = ''.join([seq[r[0]:r[1]] for r in ranges])
-
-                if insert_found:
-                    continue
-
-            if 'D' in x.cigarstring:
-                i = x.reference_start
-                for m in cigar:
-                    if m[1] == 'M':
-                        i += int(m[0])
-                    elif m[1] == 'D':
-                        if (i, int(m[0])) in deletions:
-                            reads_considered.append(x.query_name)
-                            continue
-                        i += int(m[0])
-            c_dict = dict(zip(x.get_reference_positions(), seq))
-            for s in sites_in:
-                if snp_dict[s] == c_dict[s]:
-                    reads_considered.append(x.query_name)
-                    break
+    for x in _site_reads(samfile, refname, all_sites):
+        if x.cigartuples is None:
+            # checks for a possible fail case
+            continue
+        if _has_any(ReadEvents(x), snpSites, snpAlts, insertions, deletions):
+            reads_considered.add(x.query_name)
     samfile.close()
 
-    # performance-wise since we have to look at ALL reads.
-    # Probably better to use a similar approach to extract
-    # itr = samfile.fetch(refname, int(min_site), int(max_site)+1)
-
-    # for x in itr:
-    #     ref_pos = set(x.get_reference_positions())
-    #     start = x.reference_start
-    #     sites_in = list(ref_pos & set(snp_sites))
-    #     if x.cigarstring is None:
-    #         #checks for a possible fail case
-    #         continue
-    #     seq = x.query_alignment_sequence
-    #     cigar = re.findall(r'(\d+)([A-Z]{1})', x.cigarstring)
-
-    #     # note: inserts add to read length, but not alignment coordinate
-    #     if 'I' in x.cigarstring:
-    #         i = 0
-    #         del_spacing = 0
-    #         ins_spacing = 0
-    #         ranges = []
-    #         insert_found = False
-    #         for m in cigar:
-    #             if m[1] == 'I':
-    #                 if (start+i+del_spacing-ins_spacing,
-    #                         seq[i:i+int(m[0])]) in insertions:
-    #                     reads_considered.append(x.query_name)
-    #                     insert_found = True
-    #                     break
-    #                 i += int(m[0])
-    #                 ins_spacing += int(m[0])
-    #             elif m[1] == 'D':
-    #                 del_spacing += int(m[0])
-    #                 continue
-    #             elif m[1] == 'M':
-    #                 ranges.append([i, i+int(m[0])])
-    #                 i += int(m[0])
-
-    #         seq = ''.join([seq[r[0]:r[1]] for r in ranges])
-
-    #         if insert_found:
-    #             continue
-
-    #     if 'D' in x.cigarstring:
-    #         i = x.reference_start
-    #         for m in cigar:
-    #             if m[1] == 'M':
-    #                 i += int(m[0])
-    #             elif m[1] == 'D':
-    #                 if (i, int(m[0])) in deletions:
-    #                     reads_considered.append(x.query_name)
-    #                     continue
-    #                 i += int(m[0])
-    #     else:
-    #         c_dict = dict(zip(x.get_reference_positions(), seq))
-    #         for s in sites_in:
-    #             if snp_dict[s] == c_dict[s]:
-    #                 reads_considered.append(x.query_name)
-    #                 break
-    # samfile.close()
-
     # Run again, this time also getting the paired read
     samfile = pysam.AlignmentFile(input_bam, 'rb')
     outfile = pysam.AlignmentFile(output, 'wb', template=samfile)
@@ -461,7 +257,8 @@ def covariants(input_bam, min_site, max_site, output, refname,
             gene_positions['orf1b'] = (13468, 21555)
 
     # Load reference genome
-    ref_genome = MutableSeq(next(SeqIO.parse(ref_fasta, 'fasta')).seq)
+    ref_genome = str(next(SeqIO.parse(ref_fasta, 'fasta')).seq)
+    ref_bases = as_bases(ref_genome)
 
     # Open input bam file for reading
     try:
@@ -483,94 +280,24 @@ def covariants(input_bam, min_site, max_site, output, refname,
             if x is None:
                 break
 
-            start = x.reference_start
-            seq = x.query_alignment_sequence
-            quals = x.query_alignment_qualities
-            seq = ''.join(
-                [seq[i] if quals[i] >= min_quality else 'N'
-                 for i in range(len(seq))])
-
-            insertions_found = []
-            ins_offsets = {}
-            ins_offset = 0
-            last_ins_site = 0
-
-            deletions_found = []
-            del_offsets = {}
-            del_offset = 0
-            last_del_site = 0
-
-            snps_found = []
-
-            if x.cigarstring is None:
+            if x.cigartuples is None:
                 # checks for a possible fail case
                 continue
 
-            cigar = re.findall(r'(\d+)([A-Z]{1})', x.cigarstring)
-            if 'I' in x.cigarstring:
-                i = 0
-                del_spacing = 0
-                ins_spacing = 0
-
-                for m in cigar:
-                    if m[1] == 'I':
-                        insertion_site = start+i+del_spacing-ins_spacing
-                        ins_offsets[(last_ins_site, insertion_site)
-                                    ] = ins_offset
-                        last_ins_site = insertion_site
-                        ins_offset += int(m[0])
-                        if 'N' in seq[i:i+int(m[0])]:
-                            continue
-                        insertions_found.append(
-                            (insertion_site,
-                             seq[i:i+int(m[0])])
-                        )
-                        i += int(m[0])
-                        ins_spacing += int(m[0])
-                    elif m[1] == 'D':
-                        del_spacing += int(m[0])
-                    elif m[1] == 'M':
-                        i += int(m[0])
-
-                current_ins_site = start+i+del_spacing-ins_spacing
-                ins_offsets[(last_ins_site, current_ins_site)] = ins_offset
-                last_ins_site = current_ins_site
-
-            if 'D' in x.cigarstring:
-                i = 0
-                for m in cigar:
-                    if m[1] == 'M':
-                        i += int(m[0])
-                    elif m[1] == 'D':
-                        deletions_found.append((start+i, int(m[0])))
-                        del_offsets[(last_del_site, start+i)] = del_offset
-                        last_del_site = start+i
-                        del_offset += int(m[0])
-
-                        i += int(m[0])
-                del_offsets[(last_del_site, start+i)] = del_offset
-                last_del_site = start+i
-
-            # Find SNPs
-            if 'S' not in x.cigarstring:
-
-                pairs = x.get_aligned_pairs(matches_only=True)
-
-                for tup in pairs:
-                    read_site, ref_site = tup
-                    ref_base = ref_genome[ref_site]
-                    if seq[read_site] != 'N' and ref_base != seq[read_site]:
-                        snps_found.append(
-                            f'{ref_base.upper()}{ref_site+1}{seq[read_site]}'
-                        )
-
-            elif 'S' in x.cigarstring and 'D' not in x.cigarstring\
-                    and 'I' not in x.cigarstring:
-                for i in enumerate(ref_genome[start:start+len(seq)]):
-                    if seq[i[0]] != 'N' and seq[i[0]] != i[1]:
-                        snps_found.append(
-                            f'{i[1].upper()}{start+i[0]+1}{seq[i[0]]}'
-                        )
+            events = ReadEvents(x, min_quality)
+            start = events.start
+            seq = events.seq
+
+            # insertions with low quality bases are left out
+            insertions_found = [ins for ins in events.insertions
+                                if 'N' not in ins[1]]
+            deletions_found = events.deletions
+
+            # Find SNPs (not in soft clipped reads with indels)
+            if events.clipped and (events.insertions or events.deletions):
+                snp_sites = snp_bases = []
+            else:
+                snp_sites, snp_bases = events.mismatches(ref_bases)
 
             # Get corresponding amino acid mutations
             for ins in insertions_found:
@@ -608,10 +335,11 @@ def covariants(input_bam, min_site, max_site, output, refname,
                     aa_mut = f'{deletion}({gene}:DEL{aa_locus})'
                 muts_final.append(aa_mut)
 
-            for snp in snps_found:
+            for ref_site, base in zip(snp_sites, snp_bases):
 
                 # Translate nucleotide muts to amino acid muts
-                locus = int(snp[1:-1])
+                locus = int(ref_site) + 1
+                snp = f'{ref_genome[locus-1].upper()}{locus}{chr(base)}'
 
                 gene_info = get_gene(locus)
                 if gene_info is None:
@@ -621,28 +349,23 @@ def covariants(input_bam, min_site, max_site, output, refname,
                 codon_position = (locus - start_site) % 3
                 aa_locus = ((locus - codon_position - start_site) // 3) + 1
 
-                ref_codon = ref_genome[locus - codon_position - 1:
-                                       locus - codon_position + 2]
+                ref_codon = MutableSeq(ref_genome[locus - codon_position - 1:
+                                                  locus - codon_position + 2])
                 ref_aa = ref_codon.translate()
 
                 # Adjust for indels
-                ins_offset = 0
-                if 'I' in x.cigarstring:
-                    for r in ins_offsets:
-                        if locus in range(r[0], r[1]) or locus == r[1]:
-                            ins_offset = ins_offsets[r]
-                del_offset = 0
-                if 'D' in x.cigarstring:
-                    for r in del_offsets:
-                        if locus in range(r[0], r[1]) or locus == r[1]:
-                            del_offset = del_offsets[r]
+                ins_offset = sum(len(ins[1]) for ins in events.insertions
+                                 if ins[0] <= locus)
+                del_offset = sum(d[1] for d in events.deletions
+                                 if d[0] <= locus)
 
                 read_start = (locus - start) - codon_position + \
                     ins_offset - del_offset - 1
                 read_end = (locus - start) - codon_position + \
                     ins_offset - del_offset + 2
 
-                alt_codon = MutableSeq(seq[read_start:read_end])
+                alt_codon = MutableSeq(seq[read_start:read_end].tobytes()
+                                       .decode())
 
                 if len(alt_codon) % 3 != 0 or len(alt_codon) == 0:
                     continue  # Possible fail case: codon spans multiple reads
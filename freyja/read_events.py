@@ -0,0 +1,98 @@
+import numpy as np
+
+# Decoding of aligned reads for extract, filter and covariants. A read is
+# walked once through its cigar tuples, giving its aligned blocks,
+# insertions and deletions in reference coordinates, with the aligned part
+# of the query sequence as a uint8 array (optionally masked to N below a
+# base quality). Bases at reference sites and mismatches against the
+# reference are then looked up on those arrays, rather than re-parsing the
+# cigar string and building per-position dicts for every query.
+
+# pysam cigar operations
+_ALIGNED = (0, 7, 8)  # M, =, X
+_INS = 1
+_DEL = 2
+_REF_SKIP = 3
+_SOFT_CLIP = 4
+
+N = ord('N')
+
+
+def as_bases(seq):
+    # uint8 view of a nucleotide string
+    return np.frombuffer(seq.encode('ascii'), dtype=np.uint8)
+
+
+class ReadEvents:
+    # start/end: reference span of the alignment (0 based, end exclusive)
+    # seq: aligned query bases (soft clips removed, insertions included)
+    # blocks: (reference start, seq start, length) of each aligned block
+    # insertions: (reference site, inserted bases); the bases come before
+    #   the reference base at that site
+    # deletions: (reference site, length)
+    # clipped: whether the read has soft clips
+    __slots__ = ['start', 'end', 'seq', 'blocks', 'insertions', 'deletions',
+                 'clipped']
+
+    def __init__(self, read, min_quality=0):
+        self.start = read.reference_start
+        seq = read.query_alignment_sequence
+        self.seq = as_bases(seq) if seq else np.empty(0, dtype=np.uint8)
+        if min_quality > 0 and len(self.seq) > 0:
+            quals = read.query_alignment_qualities
+            if quals is not None:
+                self.seq = np.where(np.asarray(quals) < min_quality, N,
+                                    self.seq).astype(np.uint8)
+
+        blocks = []
+        self.insertions = []
+        self.deletions = []
+        self.clipped = False
+        refPos = self.start
+        seqPos = 0
+        for op, n in read.cigartuples or ():
+            if op in _ALIGNED:
+                blocks.append((refPos, seqPos, n))
+                refPos += n
+                seqPos += n
+            elif op == _INS:
+                self.insertions.append(
+                    (refPos, self.seq[seqPos:seqPos+n].tobytes().decode()))
+                seqPos += n
+            elif op == _DEL:
+                self.deletions.append((refPos, n))
+                refPos += n
+            elif op == _REF_SKIP:
+                refPos += n
+            elif op == _SOFT_CLIP:
+                self.clipped = True
+        self.end = refPos
+        self.blocks = np.array(blocks, dtype=np.int64).reshape(-1, 3)
+
+    def bases_at(self, sites):
+        # aligned base at each reference site, 0 where the read has none
+        sites = np.asarray(sites, dtype=np.int64)
+        bases = np.zeros(len(sites), dtype=np.uint8)
+        if len(self.blocks) == 0:
+            return bases
+        k = np.searchsorted(self.blocks[:, 0], sites, side='right') - 1
+        k[k < 0] = 0
+        offset = sites - self.blocks[k, 0]
+        found = (offset >= 0) & (offset < self.blocks[k, 2])
+        bases[found] = self.seq[self.blocks[k[found], 1] + offset[found]]
+        return bases
+
+    def mismatches(self, ref):
+        # reference sites and read bases where an aligned base (other than
+        # N) differs from the reference, given as a uint8 array
+        sites = []
+        bases = []
+        for refStart, seqStart, n in self.blocks:
+            read = self.seq[seqStart:seqStart+n]
+            diff = np.flatnonzero((read != ref[refStart:refStart+n]) &
+                                  (read != N))
+            sites.append(diff + refStart)
+            bases.append(read[diff])
+        if len(sites) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint8)
+        return np.concatenate(sites), np.concatenate(bases)
@@ -0,0 +1,256 @@
+import glob
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from tqdm import tqdm
+
+from freyja.sample_deconv import reindex_dfs, site_table_to_arrays,\
+    solve_demixing_problem, merge_intra_lineage, build_output_series,\
+    write_output
+
+
+def _clean_barcodes(df_barcodes):
+    # same lineage/mutation cleanup demix applies before solving
+    df_barcodes, _, _ = reindex_dfs(df_barcodes, pd.Series(dtype=float),
+                                    pd.Series(dtype=float))
+    return df_barcodes[~df_barcodes.index.duplicated(keep='first')]
+
+
+def _sparse_barcodes(df_barcodes):
+    rows, cols = np.nonzero(df_barcodes.to_numpy())
+    vals = df_barcodes.to_numpy()[rows, cols].astype(float)
+    return (np.array(df_barcodes.index, dtype=str),
+            np.array(df_barcodes.columns, dtype=str), rows, cols, vals)
+
+
+def barcode_hash(df_barcodes):
+    # content hash identifying a barcode version
+    h = hashlib.sha1()
+    for arr in _sparse_barcodes(df_barcodes):
+        h.update(np.ascontiguousarray(arr).tobytes())
+    return h.hexdigest()[:16]
+
+
+def map_hash(mapDict):
+    # content hash of a lineage map, to tell when summaries need redoing
+    if mapDict is None:
+        return ''
+    data = json.dumps(sorted(mapDict.items())).encode()
+    return hashlib.sha1(data).hexdigest()[:16]
+
+
+def save_barcode_snapshot(cacheDir, df_barcodes, bcHash=None):
+    if bcHash is None:
+        bcHash = barcode_hash(df_barcodes)
+    fn = os.path.join(cacheDir, 'barcodes_' + bcHash + '.npz')
+    if not os.path.exists(fn):
+        index, columns, rows, cols, vals = _sparse_barcodes(df_barcodes)
+        # write then rename, several demix runs may share a cache
+        tmp = fn + '.' + str(os.getpid()) + '.tmp.npz'
+        np.savez_compressed(tmp, index=index, columns=columns, rows=rows,
+                            cols=cols, vals=vals)
+        os.replace(tmp, fn)
+    return bcHash
+
+
+def load_barcode_snapshot(cacheDir, bcHash):
+    fn = os.path.join(cacheDir, 'barcodes_' + bcHash + '.npz')
+    if not os.path.exists(fn):
+        return None
+    with np.load(fn) as dat:
+        arr = np.zeros((len(dat['index']), len(dat['columns'])))
+        arr[dat['rows'], dat['cols']] = dat['vals']
+        return pd.DataFrame(arr, index=dat['index'], columns=dat['columns'])
+
+
+def _write_site_table(fn, name, output, freqs, siteDepths, cov,
+                      sample_strains, abundances, error, eps, bcHash,
+                      mapHash, outformat='tsv'):
+    np.savez_compressed(fn,
+                        name=np.array(name),
+                        output=np.array(output),
+                        outformat=np.array(outformat),
+                        muts=np.array(freqs.index, dtype=str),
+                        freqs=freqs.to_numpy(dtype=float),
+                        depth_pos=siteDepths.index.to_numpy(dtype=np.int64),
+                        depth=siteDepths.to_numpy(dtype=float),
+                        coverage=np.array(cov),
+                        lineages=np.array(sample_strains, dtype=str),
+                        abundances=np.array(abundances, dtype=float),
+                        resid=np.array(error),
+                        eps=np.array(eps),
+                        barcodes=np.array(bcHash),
+                        map=np.array(mapHash))
+
+
+def save_site_table(cacheDir, freqs, siteDepths, sample_strains, abundances,
+                    error, cov, eps, df_barcodes, output, name,
+                    mapDict=None, outformat='tsv'):
+    os.makedirs(cacheDir, exist_ok=True)
+    bcHash = save_barcode_snapshot(cacheDir, _clean_barcodes(df_barcodes))
+    # keyed on the output too, samples of the same name from different runs
+    # get separate entries while a re-run of a sample replaces its own
+    output = os.path.abspath(output)
+    key = hashlib.sha1(output.encode()).hexdigest()[:12]
+    fn = os.path.join(cacheDir, f'{os.path.basename(name)}_{key}.npz')
+    _write_site_table(fn, name, output, freqs, siteDepths, cov,
+                      sample_strains, abundances, error, eps, bcHash,
+                      map_hash(mapDict), outformat)
+    return fn
+
+
+def load_site_table(fn):
+    with np.load(fn) as dat:
+        entry = {k: dat[k] for k in dat.files}
+    # caches written before the map hash was kept get their summaries redone
+    entry['map'] = entry.get('map', '')
+    # and those from before the output format was kept were all tsv
+    entry['outformat'] = entry.get('outformat', 'tsv')
+    for k in ['name', 'output', 'barcodes', 'map', 'outformat']:
+        entry[k] = str(entry[k])
+    for k in ['coverage', 'resid', 'eps']:
+        entry[k] = float(entry[k])
+    entry['freqs'] = pd.Series(entry['freqs'], index=entry['muts'])
+    entry['depth'] = pd.Series(entry['depth'], index=entry['depth_pos'])
+    return entry
+
+
+def diff_barcodes(old, new):
+    # Returns the mutations whose observation in a sample can move the
+    # solution, and the lineages whose previous use forces a re-solve.
+    addedMuts = new.columns.difference(old.columns)
+    removedMuts = old.columns.difference(new.columns)
+    common = old.columns.intersection(new.columns)
+    sensitive = set(addedMuts[new[addedMuts].to_numpy().any(axis=0)]) |\
+        set(removedMuts[old[removedMuts].to_numpy().any(axis=0)])
+    touched = set(old.index.difference(new.index))
+
+    # lineages whose barcode changed
+    shared = old.index.intersection(new.index)
+    oldC = old.loc[shared, common].to_numpy() > 0
+    newC = new.loc[shared, common].to_numpy() > 0
+    changed = oldC != newC
+    rowChanged = changed.any(axis=1) |\
+        new.loc[shared, addedMuts].to_numpy().any(axis=1) |\
+        old.loc[shared, removedMuts].to_numpy().any(axis=1)
+    touched |= set(shared[rowChanged])
+    sensitive |= set(common[changed.any(axis=0)])
+
+    # new lineages only matter where they differ from the closest lineage
+    # already in the old barcodes
+    added = new.index.difference(old.index)
+    if len(added) > 0 and old.shape[0] > 0:
+        oldB = old[common].to_numpy() > 0
+        addB = new.loc[added, common].to_numpy() > 0
+        hamming = addB.astype(np.float32) @ (~oldB).T.astype(np.float32) +\
+            (~addB).astype(np.float32) @ oldB.T.astype(np.float32)
+        nearest = np.argmin(hamming, axis=1)
+        for j in range(len(added)):
+            touched.add(old.index[nearest[j]])
+            sensitive |= set(common[addB[j] != oldB[nearest[j]]])
+            sensitive |= set(addedMuts[new.loc[added[j], addedMuts]
+                                       .to_numpy() > 0])
+    elif len(added) > 0:
+        sensitive |= set(new.columns)
+    return sensitive, touched
+
+
+def needs_resolve(entry, diff):
+    if diff is None:
+        return True
+    sensitive, touched = diff
+    if len(touched & set(entry['lineages'])) > 0:
+        return True
+    # a covered site weighs in on the solution even where the sample shows
+    # no mutation, so look at every position with depth
+    covered = set(entry['depth'].index[entry['depth'].to_numpy() > 0])
+    return any(int(re.search(r'\d+', mut).group()) in covered
+               for mut in sensitive)
+
+
+def _redemix_chunk(fns, df_barcodes, bcHash, diffs, eps, mapDict, mapHash,
+                   outdir, full):
+    # Only samples that are re-solved, or whose summary changes with the
+    # lineage map, get their output and cache entry rewritten (all outputs
+    # are written when they go to a new directory). Entries left alone keep
+    # the hash of the barcodes they were solved with, which the next update
+    # is diffed against.
+    muts = list(df_barcodes.columns)
+    nSolved = 0
+    for fn in fns:
+        entry = load_site_table(fn)
+        sample_strains = list(entry['lineages'])
+        abundances = list(entry['abundances'])
+        error = entry['resid']
+        entryHash = entry['barcodes']
+        solved = full or entry['eps'] != eps or \
+            (entry['barcodes'] != bcHash and
+             needs_resolve(entry, diffs.get(entry['barcodes'])))
+        if solved:
+            mix, depths_ = site_table_to_arrays(entry['freqs'],
+                                                entry['depth'], muts,
+                                                entry['name'])
+            df_bc, mix, depths_ = reindex_dfs(df_barcodes, mix, depths_)
+            sample_strains, abundances, error = \
+                solve_demixing_problem(df_bc, mix, depths_, eps)
+            sample_strains, abundances = merge_intra_lineage(sample_strains,
+                                                             abundances)
+            entryHash = bcHash
+            nSolved += 1
+        changed = solved or entry['map'] != mapHash
+        if not changed and outdir is None:
+            continue
+        # summarization is cheap, so always redo it with the current map
+        sols_df = build_output_series(sample_strains, abundances, error,
+                                      entry['coverage'], mapDict,
+                                      entry['name'],
+                                      structured=(entry['outformat'] ==
+                                                  'jsonl'))
+        if outdir is None:
+            output = entry['output']
+        else:
+            output = os.path.join(outdir, os.path.basename(entry['output']))
+        write_output(sols_df, output, entry['outformat'])
+        if changed:
+            _write_site_table(fn, entry['name'], entry['output'],
+                              entry['freqs'], entry['depth'],
+                              entry['coverage'], sample_strains, abundances,
+                              error, eps, entryHash, mapHash,
+                              entry['outformat'])
+    return nSolved
+
+
+def redemix(cacheDir, df_barcodes, eps, mapDict, outdir=None, n_jobs=1,
+            full=False):
+    df_barcodes = _clean_barcodes(df_barcodes)
+    bcHash = save_barcode_snapshot(cacheDir, df_barcodes)
+    fns = sorted(fn for fn in glob.glob(os.path.join(cacheDir, '*.npz'))
+                 if not os.path.basename(fn).startswith('barcodes_'))
+    # diff each barcode version found in the cache against the new one
+    diffs = {}
+    if not full:
+        oldHashes = set()
+        for fn in fns:
+            with np.load(fn) as dat:
+                oldHashes.add(str(dat['barcodes']))
+        for oldHash in oldHashes - {bcHash}:
+            old = load_barcode_snapshot(cacheDir, oldHash)
+            if old is not None:
+                diffs[oldHash] = diff_barcodes(old, df_barcodes)
+    if outdir is not None:
+        os.makedirs(outdir, exist_ok=True)
+    # one chunk of samples per task, to ship the barcodes once per worker
+    nChunks = max(1, min(len(fns), 4 * n_jobs))
+    chunks = [fns[k::nChunks] for k in range(nChunks)]
+    mapHash = map_hash(mapDict)
+    out = Parallel(n_jobs=n_jobs)(delayed(_redemix_chunk)(chunk, df_barcodes,
+                                                          bcHash, diffs, eps,
+                                                          mapDict, mapHash,
+                                                          outdir, full)
+                                  for chunk in tqdm(chunks))
+    return sum(out), len(fns)
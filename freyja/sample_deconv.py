@@ -2,28 +2,22 @@ import pandas as pd
 import numpy as np
 import json
 import sys
-import re
 import cvxpy as cp
 import os
 import matplotlib.pyplot as plt
 from joblib import Parallel, delayed
 from tqdm import tqdm
 import matplotlib
+import gzip
+import io
+from contextlib import contextmanager
+from functools import lru_cache
 
 
-def buildLineageMap(locDir):
-    # Parsing curated lineage data from outbreak.info
-    if locDir == '-1':
-        locDir = os.path.abspath(os.path.join(os.path.realpath(__file__),
-                                 os.pardir))
-        f0 = open(os.path.join(locDir, 'data/curated_lineages.json'))
+@lru_cache(maxsize=4)
+def _read_lineage_map(fn, mtime):
+    with open(fn) as f0:
         dat = json.load(f0)
-        f0.close()
-    else:
-        f0 = open(locDir)
-        dat = json.load(f0)
-        f0.close()
-
     mapDict = {}
     for ind in range(len(dat)):
         if 'who_name' in dat[ind].keys():
@@ -33,24 +27,136 @@ def buildLineageMap(locDir):
     return mapDict
 
 
-def build_mix_and_depth_arrays(fn, depthFn, muts, covcut):
-    input_is_vcf = fn.lower().endswith('vcf')
-    if input_is_vcf:
-        df = read_snv_frequencies_vcf(fn, depthFn, muts)
+def buildLineageMap(locDir):
+    # Parsing curated lineage data from outbreak.info. The map is cached
+    # on path and modification time, callers should not modify it.
+    if locDir == '-1':
+        locDir = os.path.abspath(os.path.join(os.path.realpath(__file__),
+                                 os.pardir))
+        fn = os.path.join(locDir, 'data/curated_lineages.json')
+    else:
+        fn = os.path.abspath(locDir)
+    return _read_lineage_map(fn, os.stat(fn).st_mtime_ns)
+
+
+def load_barcodes(barcodes, confirmedonly=False, wgisaid=False):
+    locDir = os.path.abspath(os.path.join(os.path.realpath(__file__),
+                             os.pardir))
+    # option for custom barcodes, as a file or an already loaded frame
+    if isinstance(barcodes, pd.DataFrame):
+        df_barcodes = barcodes
+    elif barcodes != '-1':
+        df_barcodes = pd.read_csv(barcodes, index_col=0)
     else:
-        df = read_snv_frequencies_ivar(fn, depthFn, muts)
+        if not wgisaid:
+            df_barcodes = pd.read_csv(os.path.join(locDir,
+                                      'data/usher_barcodes.csv'), index_col=0)
+        else:
+            df_barcodes = pd.read_csv(os.path.join(locDir,
+                                      'data/usher_barcodes_with_gisaid.csv'),
+                                      index_col=0)
+    if confirmedonly:
+        confirmed = [dfi for dfi in df_barcodes.index
+                     if 'proposed' not in dfi and 'misc' not in dfi]
+        df_barcodes = df_barcodes.loc[confirmed, :]
+
+    # drop intra-lineage diversity naming (keeps separate barcodes)
+    indexSimplified = [dfi.split('_')[0] for dfi in df_barcodes.index]
+    df_barcodes = df_barcodes.loc[indexSimplified, :]
+    return df_barcodes
+
+
+def read_site_table(fn, depthFn, covcut):
+    # per-sample site table: frequencies of every observed mutation (keyed
+    # by mutation name) and sequencing depth at every genome position
+    return site_table_from_frames(read_variants(fn), read_depths(depthFn),
+                                  covcut)
+
+
+@contextmanager
+def open_input(fn):
+    # Binary stream of a variants/depth file, of stdin for '-' or of an
+    # already open binary file object (left open). Gzip and bgzip compressed
+    # inputs are recognized from their first bytes, so pipes and FIFOs work
+    # too: everything is read once, front to back.
+    owned = not (fn == '-' or hasattr(fn, 'read'))
+    if fn == '-':
+        f = sys.stdin.buffer
+    elif owned:
+        f = open(fn, 'rb')
+    elif hasattr(fn, 'peek'):
+        f = fn
+    else:
+        f = io.BufferedReader(fn)
+    try:
+        if f.peek(2)[:2] == b'\x1f\x8b':
+            with gzip.GzipFile(fileobj=f) as gz:
+                yield gz
+        else:
+            yield f
+    finally:
+        if owned:
+            f.close()
+        elif f is not fn and f is not sys.stdin.buffer:
+            # don't close the caller's stream along with the wrapper
+            f.detach()
+
+
+def _is_vcf(fn, f):
+    name = str(getattr(fn, 'name', fn)).lower()
+    for ext in ['.gz', '.bgz']:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    # vcf headers start with ##fileformat, ivar's with REGION
+    return name.endswith('vcf') or f.peek(1)[:1] == b'#'
+
+
+def read_variants(fn):
+    with open_input(fn) as f:
+        if _is_vcf(fn, f):
+            return read_snv_frequencies_vcf(f, None, None)
+        return read_snv_frequencies_ivar(f, None, None)
+
 
+def read_depths(depthFn):
+    with open_input(depthFn) as f:
+        return pd.read_csv(f, sep='\t', header=None, index_col=1)
+
+
+def site_table_from_frames(df, df_depth, covcut):
+    # site table of a variants frame (ivar columns, or a vcf with ALT_FREQ)
+    # and a depth frame indexed by position, with the depths in column 3
+    # as `freyja variants` writes them.
     # only works for substitutions, but that's what we get from usher tree
-    df_depth = pd.read_csv(depthFn, sep='\t', header=None, index_col=1)
-    df['mutName'] = df['REF'] + df['POS'].astype(str) + df['ALT']
+    df = df.assign(mutName=df['REF'] + df['POS'].astype(str) + df['ALT'])
     df = df.drop_duplicates(subset='mutName')
-    df.set_index('mutName', inplace=True)
-    keptInds = set(muts) & set(df.index)
-    mix = df.loc[list(keptInds), 'ALT_FREQ'].astype(float)
-    mix.name = fn
-    depths = pd.Series({kI: df_depth.loc[int(re.findall(r'\d+', kI)[0]), 3]
-                        .astype(float) for kI in muts}, name=fn)
-    coverage = 100.*np.sum(df_depth.loc[:, 3] >= covcut)/df_depth.shape[0]
+    freqs = df.set_index('mutName')['ALT_FREQ'].astype(float)
+    siteDepths, coverage = depth_table(df_depth, covcut)
+    return freqs, siteDepths, coverage
+
+
+def depth_table(df_depth, covcut):
+    siteDepths = df_depth.loc[:, 3].astype(float)
+    coverage = 100.*np.sum(siteDepths >= covcut)/df_depth.shape[0]
+    siteDepths = siteDepths[~siteDepths.index.duplicated(keep='first')]
+    return siteDepths, coverage
+
+
+def site_table_to_arrays(freqs, siteDepths, muts, name):
+    # look up the barcode mutations in a site table
+    keptInds = set(muts) & set(freqs.index)
+    mix = freqs.loc[list(keptInds)]
+    mix.name = name
+    positions = pd.Series(muts, dtype=str).str.extract(r'(\d+)')[0]\
+        .astype(int)
+    depths = pd.Series(siteDepths.reindex(positions).to_numpy(),
+                       index=muts, name=name)
+    return mix, depths
+
+
+def build_mix_and_depth_arrays(fn, depthFn, muts, covcut):
+    freqs, siteDepths, coverage = read_site_table(fn, depthFn, covcut)
+    mix, depths = site_table_to_arrays(freqs, siteDepths, muts, fn)
     return mix, depths, coverage
 
 
@@ -60,17 +166,22 @@ def read_snv_frequencies_ivar(fn, depthFn, muts):
 
 
 def read_snv_frequencies_vcf(fn, depthFn, muts):
+    # fn is a path or a binary stream, read in a single pass
+    if isinstance(fn, str) or not hasattr(fn, 'peek'):
+        with open_input(fn) as f:
+            return read_snv_frequencies_vcf(f, depthFn, muts)
+    file = io.TextIOWrapper(fn)
     vcfnames = []
-    with open(fn, "r") as file:
-        for line in file:
-            if line.startswith("#CHROM"):
-                vcfnames = [x for x in line.strip("\n").split('\t')]
-                break
-    file.close()
-
-    df = pd.read_csv(fn, comment='#', delim_whitespace=True,
+    for line in file:
+        if line.startswith("#CHROM"):
+            vcfnames = [x for x in line.strip("\n").split('\t')]
+            break
+
+    df = pd.read_csv(file, comment='#', delim_whitespace=True,
                      header=None,
                      names=vcfnames)
+    # the caller closes the stream
+    file.detach()
     vcf_info = df['INFO'].str.split(';', expand=True)
     for j in range(vcf_info.shape[1]):
         if vcf_info[j].str.split('=')[0] is not None:
@@ -89,38 +200,53 @@ def reindex_dfs(df_barcodes, mix, depths):
     df_barcodes = df_barcodes.drop(index=nxNames)
     # reindex everything to match across the dfs
     df_barcodes = df_barcodes.reindex(sorted(df_barcodes.columns), axis=1)
-    mix = mix.reindex(df_barcodes.columns).fillna(0.)
+    mix, depths = reindex_sample(df_barcodes.columns, mix, depths)
+    return df_barcodes, mix, depths
+
 
-    mix_as_set = set(mix.index)
+def reindex_sample(muts, mix, depths):
+    # align one sample with barcodes that already went through reindex_dfs,
+    # without copying the barcode matrix again
+    mix = mix.reindex(muts).fillna(0.)
     # dropping extra sequencing depth info we don't need
-    depths = depths.drop(labels=[m0 for m0 in df_barcodes.columns
-                                 if m0 not in mix_as_set])
-    depths = depths.reindex(df_barcodes.columns).fillna(0.)
-    return df_barcodes, mix, depths
+    depths = depths.reindex(muts).fillna(0.)
+    return mix, depths
+
+
+def constellation_codes(lineages, mapDict):
+    # integer constellation id of each lineage, lineages missing from the
+    # map fall in 'A' (A lineages) or 'Other'. Ids follow first appearance.
+    names = {}
+    codes = np.empty(len(lineages), dtype=np.int64)
+    for jj, lin in enumerate(lineages):
+        if lin in mapDict:
+            name = mapDict[lin]
+        elif lin.startswith('A.') or lin == 'A':
+            name = 'A'
+        else:
+            name = 'Other'
+        codes[jj] = names.setdefault(name, len(names))
+    return codes, list(names)
+
+
+def summarize_constellations(codes, names, vals):
+    # sums abundances by constellation, for a single abundance vector or a
+    # replicate x lineage matrix (one row per replicate)
+    vals = np.asarray(vals, dtype=float)
+    if vals.ndim == 1:
+        return np.bincount(codes, weights=vals, minlength=len(names))
+    indicator = np.zeros((len(codes), len(names)))
+    indicator[np.arange(len(codes)), codes] = 1.
+    return vals @ indicator
 
 
 def map_to_constellation(sample_strains, vals, mapDict):
     # maps lineage names to constellations
-    localDict = {}
-    for jj, lin in enumerate(sample_strains):
-        if lin in mapDict.keys():
-            if mapDict[lin] not in localDict.keys():
-                localDict[mapDict[lin]] = vals[jj]
-            else:
-                localDict[mapDict[lin]] += vals[jj]
-        elif lin.startswith('A.') or lin == 'A':
-            if 'A' not in localDict.keys():
-                localDict['A'] = vals[jj]
-            else:
-                localDict['A'] += vals[jj]
-        else:
-            if 'Other' not in localDict.keys():
-                localDict['Other'] = vals[jj]
-            else:
-                localDict['Other'] += vals[jj]
+    codes, names = constellation_codes(sample_strains, mapDict)
+    sums = summarize_constellations(codes, names, vals)
     # convert to descending order
-    localDict = sorted(localDict.items(), key=lambda x: x[1], reverse=True)
-    return localDict
+    order = np.argsort(-sums, kind='stable')
+    return [(names[k], sums[k]) for k in order]
 
 
 def solve_demixing_problem(df_barcodes, mix, depths, eps):
@@ -149,8 +275,59 @@ def solve_demixing_problem(df_barcodes, mix, depths, eps):
     return sample_strains[indSort], abundances[indSort], rnorm
 
 
+def merge_intra_lineage(sample_strains, abundances):
+    # merge intra-lineage diversity if multiple hits.
+    if len(set(sample_strains)) < len(sample_strains):
+        localDict = {}
+        for jj, lin in enumerate(sample_strains):
+            if lin not in localDict.keys():
+                localDict[lin] = abundances[jj]
+            else:
+                localDict[lin] += abundances[jj]
+        # ensure descending order
+        localDict = dict(sorted(localDict.items(),
+                                key=lambda x: x[1],
+                                reverse=True))
+        sample_strains = list(localDict.keys())
+        abundances = list(localDict.values())
+    return sample_strains, abundances
+
+
+def build_output_series(sample_strains, abundances, error, cov, mapDict,
+                        name, structured=False):
+    localDict = map_to_constellation(sample_strains, abundances, mapDict)
+    # assemble into series and write.
+    sols_df = pd.Series(data=(localDict, sample_strains, abundances,
+                              error, cov),
+                        index=['summarized', 'lineages',
+                        'abundances', 'resid', 'coverage'],
+                        name=name)
+    if structured:
+        sols_df['summarized'] = dict(localDict)
+        sols_df['lineages'] = [str(lin) for lin in sample_strains]
+        sols_df['abundances'] = [float(ab) for ab in abundances]
+        return sols_df
+    # convert lineage/abundance readouts to single line strings
+    sols_df['lineages'] = ' '.join(sols_df['lineages'])
+    sols_df['abundances'] = ['%.8f' % ab for ab in sols_df['abundances']]
+    sols_df['abundances'] = ' '.join(sols_df['abundances'])
+    return sols_df
+
+
+def write_output(sols_df, output, outformat='tsv'):
+    if outformat == 'jsonl':
+        # one json record, readable by aggregate/plot/dash without parsing
+        record = {'sample': sols_df.name}
+        record.update({k: float(v) if isinstance(v, np.floating) else v
+                       for k, v in sols_df.items()})
+        with open(output, 'w') as f:
+            f.write(json.dumps(record) + '\n')
+    else:
+        sols_df.to_csv(output, sep='\t')
+
+
 def bootstrap_parallel(jj, samplesDefining, fracDepths_adj, mix_grp,
-                       mix, df_barcodes, eps0, muts, mapDict):
+                       mix, df_barcodes, eps0, muts):
     # helper function for fast bootstrap and solve
     # get sequencing depth at the position of all defining mutations
     mix_boot = mix.copy()
@@ -190,8 +367,15 @@ def bootstrap_parallel(jj, samplesDefining, fracDepths_adj, mix_grp,
     sample_strains, abundances, error = solve_demixing_problem(df_barcodes,
                                                                mix_boot_,
                                                                dps_, eps0)
-    localDict = map_to_constellation(sample_strains, abundances, mapDict)
-    return sample_strains, abundances, localDict
+    return sample_strains, abundances
+
+
+def _first_seen(mat):
+    # column order of an outer concat of the rows, with the nonzero entries
+    # of each row in decreasing order
+    order = np.argsort(-mat, axis=1, kind='stable')
+    rowPresent = np.take_along_axis(mat > 0, order, axis=1)
+    return list(dict.fromkeys(order[rowPresent].tolist()))
 
 
 def perform_bootstrap(df_barcodes, mix, depths_,
@@ -216,8 +400,6 @@ def perform_bootstrap(df_barcodes, mix, depths_,
                                       .apply(lambda x:
                                              int(x[1: len(x)-1])))
     mix_grp = mixPos.groupby(level=0).apply(list)
-    lin_df = pd.DataFrame()
-    constellation_df = pd.DataFrame()
     out = Parallel(n_jobs=n_jobs)(delayed(bootstrap_parallel)(jj0,
                                                               samplesDefining,
                                                               fracDepths_adj,
@@ -225,42 +407,23 @@ def perform_bootstrap(df_barcodes, mix, depths_,
                                                               mix,
                                                               df_barcodes,
                                                               eps0,
-                                                              muts,
-                                                              mapDict)
+                                                              muts)
                                   for jj0 in tqdm(range(numBootstraps)))
-    for i in range(len(out)):
-        sample_lins, abundances, localDict = out[i]
-
-        # merge intra-lineage diversity if multiple hits.
-        if len(set(sample_lins)) < len(sample_lins):
-            localDict = {}
-            for jj, lin in enumerate(sample_lins):
-                if lin not in localDict.keys():
-                    localDict[lin] = abundances[jj]
-                else:
-                    localDict[lin] += abundances[jj]
-            # ensure descending order
-            localDict = dict(sorted(localDict.items(),
-                                    key=lambda x: x[1],
-                                    reverse=True))
-            sample_lins = list(localDict.keys())
-            abundances = list(localDict.values())
-
-        lin_df = pd.concat([lin_df,
-                           pd.DataFrame({sample_lins[j]:
-                                         abundances[j]
-                                        for j in range(len(sample_lins))},
-                                        index=[0])], axis=0, join='outer',
-                           ignore_index=True)
-        constellation_df = pd.concat([constellation_df,
-                                     pd.DataFrame({localDict[j][0]:
-                                                   localDict[j][1]
-                                                   for j in range(
-                                                   len(localDict))},
-                                                  index=[0])], axis=0,
-                                     join='outer', ignore_index=True)
-    lin_df = lin_df.fillna(0)
-    constellation_df = constellation_df.fillna(0)
+    # replicate x lineage matrix, summing intra-lineage hits
+    lineages = df_barcodes.index.unique()
+    boots = np.zeros((len(out), len(lineages)))
+    for i, (sample_lins, abundances) in enumerate(out):
+        np.add.at(boots[i], lineages.get_indexer(sample_lins), abundances)
+    codes, names = constellation_codes(lineages, mapDict)
+    constellations = summarize_constellations(codes, names, boots)
+
+    # columns in the order lineages/constellations first show up in the
+    # replicates, each replicate sorted by decreasing abundance
+    lin_cols = _first_seen(boots)
+    con_cols = _first_seen(constellations)
+    lin_df = pd.DataFrame(boots[:, lin_cols], columns=lineages[lin_cols])
+    constellation_df = pd.DataFrame(constellations[:, con_cols],
+                                    columns=[names[k] for k in con_cols])
     lin_out = lin_df.quantile([0.025, 0.05, 0.25, 0.5, 0.75, 0.95, 0.975])
     constell_out = constellation_df.quantile([0.025, 0.05, 0.25, 0.5,
                                               0.75, 0.95, 0.975])
@@ -0,0 +1,315 @@
+import http.client
+import json
+import os
+import signal
+import socket
+import socketserver
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# `freyja serve` keeps a Session (barcodes, lineage map and solver imports)
+# loaded in a pool of worker processes, and answers demix/boot requests as
+# JSON over HTTP, either on a localhost port or on a UNIX socket (only open
+# to its owner). `freyja demix --server` is the client side. Requests only
+# get to write below the server's output directory. This module only imports
+# the standard library at the top, so the client starts as fast as the bare
+# CLI.
+
+HOST = '127.0.0.1'
+# per endpoint latencies kept for the stats
+STATS_WINDOW = 1000
+
+_session = None
+
+
+def reference_config(barcodes, meta, confirmedonly, wgisaid):
+    # identifies the reference data, so clients asking for different
+    # barcodes than the server holds are turned away
+    def _path(fn):
+        return fn if fn == '-1' else os.path.abspath(fn)
+    return {'barcodes': _path(barcodes), 'meta': _path(meta),
+            'confirmedonly': bool(confirmedonly), 'wgisaid': bool(wgisaid)}
+
+
+def _init_worker(session):
+    global _session
+    _session = session
+    # ctrl-c stops the server, which then shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _ready():
+    return os.getpid()
+
+
+def run_demix(req):
+    from freyja.redemix import save_site_table
+    from freyja.sample_deconv import build_output_series, write_output
+
+    freqs, siteDepths, cov = _session.site_table((req['variants'],
+                                                  req['depths']),
+                                                 req['covcut'])
+    sample_strains, abundances, error = _session.solve(freqs, siteDepths,
+                                                       req['name'],
+                                                       req['eps'])
+    outformat = req['outformat']
+    sols_df = build_output_series(sample_strains, abundances, error, cov,
+                                  _session.mapDict, req['name'],
+                                  structured=(outformat == 'jsonl'))
+    write_output(sols_df, req['output'], outformat)
+    if req.get('sitecache') is not None:
+        save_site_table(req['sitecache'], freqs, siteDepths, sample_strains,
+                        abundances, error, cov, req['eps'], _session.barcodes,
+                        req['output'], req['name'], _session.mapDict,
+                        outformat)
+    return {'output': req['output']}
+
+
+def run_boot(req):
+    output_base = req['output_base']
+    # bootstraps of a request run in its worker, concurrency comes from
+    # the pool
+    lin_out, constell_out = _session.boot((req['variants'], req['depths']),
+                                          req['nb'], req['eps'], 1,
+                                          req['boxplot'], output_base)
+    lin_out.to_csv(output_base + '_lineages.csv')
+    constell_out.to_csv(output_base + '_summarized.csv')
+    return {'output': [output_base + '_lineages.csv',
+                       output_base + '_summarized.csv']}
+
+
+TASKS = {'/demix': run_demix, '/boot': run_boot}
+# request fields naming files or directories the task writes to
+OUTPUT_FIELDS = {'/demix': ['output', 'sitecache'],
+                 '/boot': ['output_base']}
+
+
+def _outside(root, path):
+    path = os.path.realpath(path)
+    return os.path.commonpath([root, path]) != root
+
+
+class LatencyStats:
+    def __init__(self, window=STATS_WINDOW):
+        self.window = window
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._errors = {}
+        self._times = {}
+
+    def record(self, endpoint, seconds, ok=True):
+        with self._lock:
+            self._counts[endpoint] = self._counts.get(endpoint, 0) + 1
+            if not ok:
+                self._errors[endpoint] = self._errors.get(endpoint, 0) + 1
+            self._times.setdefault(endpoint,
+                                   deque(maxlen=self.window)).append(seconds)
+
+    def summary(self):
+        with self._lock:
+            out = {'uptime': time.time() - self.started, 'endpoints': {}}
+            for endpoint, times in self._times.items():
+                ts = sorted(times)
+                out['endpoints'][endpoint] = {
+                    'requests': self._counts[endpoint],
+                    'errors': self._errors.get(endpoint, 0),
+                    'mean': sum(ts) / len(ts),
+                    'p50': ts[(len(ts) - 1) // 2],
+                    'p95': ts[int(0.95 * (len(ts) - 1))],
+                    'max': ts[-1]}
+            return out
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def _reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            stats = self.server.stats.summary()
+            stats['workers'] = self.server.workers
+            stats['reference'] = self.server.reference_config
+            self._reply(200, stats)
+        else:
+            self._reply(404, {'error': 'unknown endpoint ' + self.path})
+
+    def do_POST(self):
+        t0 = time.perf_counter()
+        task = TASKS.get(self.path)
+        if task is None:
+            self._reply(404, {'error': 'unknown endpoint ' + self.path})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            req = json.loads(self.rfile.read(length))
+        except ValueError:
+            self._reply(400, {'error': 'request body is not valid json'})
+            return
+        # requests that don't say which reference data they expect are
+        # refused too, rather than solved against whatever the server holds
+        if req.get('reference') != self.server.reference_config:
+            self.server.stats.record(self.path, time.perf_counter() - t0,
+                                     ok=False)
+            self._reply(409, {'error': 'server holds different reference '
+                                       'data: ' +
+                                       json.dumps(self.server.
+                                                  reference_config)})
+            return
+        outputs = [req.get(field) for field in OUTPUT_FIELDS[self.path]]
+        if any(not isinstance(fn, str) or _outside(self.server.outdir, fn)
+               for fn in outputs if fn is not None):
+            self.server.stats.record(self.path, time.perf_counter() - t0,
+                                     ok=False)
+            self._reply(403, {'error': 'outputs must be written below ' +
+                                       self.server.outdir})
+            return
+        pool = self.server.pool
+        try:
+            body = pool.submit(task, req).result()
+            code = 200
+        except BrokenProcessPool as e:
+            # a worker died (e.g. killed for memory), start a fresh pool
+            # for the next requests
+            _restart_pool(self.server, pool)
+            body = {'error': 'worker crashed: ' + str(e)}
+            code = 500
+        except Exception as e:
+            body = {'error': type(e).__name__ + ': ' + str(e)}
+            code = 500
+        seconds = time.perf_counter() - t0
+        self.server.stats.record(self.path, seconds, ok=(code == 200))
+        body['seconds'] = seconds
+        self._reply(code, body)
+
+    def log_message(self, format, *args):
+        # stats replace the per request access log
+        pass
+
+
+class _TCPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _start_pool(session, n_jobs):
+    pool = ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                               initargs=(session,))
+    # start every worker now rather than on the first requests
+    for ready in [pool.submit(_ready) for _ in range(n_jobs)]:
+        ready.result()
+    return pool
+
+
+def _restart_pool(server, broken):
+    # several requests can find the same pool broken, only replace it once
+    with server.poolLock:
+        if server.pool is broken:
+            broken.shutdown(wait=False)
+            server.pool = _start_pool(server.session, server.workers)
+
+
+def make_server(session, config, socketPath=None, port=8765, n_jobs=1,
+                outdir='.'):
+    # serving socket plus a worker pool holding a freyja Session. Every
+    # worker gets its copy of the session once, when it starts. config is
+    # the reference_config the session was loaded with, outdir the
+    # directory requests may write outputs (and site caches) below.
+    if socketPath is not None:
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+        # bind with the socket already closed to other users
+        umask = os.umask(0o177)
+        try:
+            server = _UnixServer(socketPath, _Handler)
+        finally:
+            os.umask(umask)
+    else:
+        server = _TCPServer((HOST, port), _Handler)
+    server.session = session
+    server.pool = _start_pool(session, n_jobs)
+    server.poolLock = threading.Lock()
+    server.outdir = os.path.realpath(outdir)
+    server.workers = n_jobs
+    server.stats = LatencyStats()
+    server.reference_config = config
+    server.socketPath = socketPath
+    return server
+
+
+def close_server(server):
+    server.server_close()
+    server.pool.shutdown()
+    if server.socketPath is not None and os.path.exists(server.socketPath):
+        os.remove(server.socketPath)
+
+
+def _terminate(signum, frame):
+    raise KeyboardInterrupt
+
+
+def serve(session, config, socketPath=None, port=8765, n_jobs=1,
+          outdir='.'):
+    server = make_server(session, config, socketPath, port, n_jobs, outdir)
+    where = socketPath if socketPath is not None else f'{HOST}:{port}'
+    print(f'freyja serve: {server.workers} workers listening on {where}, '
+          f'writing below {server.outdir}', flush=True)
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stats = server.stats.summary()
+        close_server(server)
+    for endpoint, s in stats['endpoints'].items():
+        print(f"{endpoint}: {s['requests']} requests, {s['errors']} errors, "
+              f"p50 {s['p50']:.3f}s, p95 {s['p95']:.3f}s")
+
+
+class _UnixConnection(http.client.HTTPConnection):
+    def __init__(self, socketPath, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socketPath = socketPath
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socketPath)
+
+
+def connect(address, timeout=None):
+    # a port number (on localhost) or the path of a UNIX socket
+    if str(address).isdigit():
+        return http.client.HTTPConnection(HOST, int(address),
+                                          timeout=timeout)
+    return _UnixConnection(address, timeout=timeout)
+
+
+def request(address, endpoint, payload=None, timeout=None):
+    conn = connect(address, timeout)
+    try:
+        if payload is None:
+            conn.request('GET', endpoint)
+        else:
+            conn.request('POST', endpoint, body=json.dumps(payload),
+                         headers={'Content-Type': 'application/json'})
+        resp = conn.getresponse()
+        body = json.loads(resp.read())
+    finally:
+        conn.close()
+    if resp.status != 200:
+        raise RuntimeError(body.get('error', f'HTTP {resp.status}'))
+    return body
@@ -0,0 +1,127 @@
+import os
+
+import pandas as pd
+from joblib import Parallel, delayed
+
+from freyja.sample_deconv import buildLineageMap, load_barcodes,\
+    reindex_dfs, reindex_sample, read_variants, read_depths,\
+    site_table_from_frames, depth_table, site_table_to_arrays,\
+    solve_demixing_problem, merge_intra_lineage, build_output_series,\
+    perform_bootstrap
+
+
+def _is_path(obj):
+    return isinstance(obj, (str, os.PathLike))
+
+
+class Session:
+    # Barcodes and lineage map loaded once, for demixing many samples.
+    # The options match those of `freyja demix`: barcodes and meta are file
+    # paths ('-1' for the bundled files), or an already loaded barcode frame
+    # and lineage -> constellation dict.
+    #
+    # A sample is a (variants, depths) pair, each either a file path as
+    # passed to `freyja demix` or in memory data. Variants can be a frame
+    # with ivar columns (REF, POS, ALT, ALT_FREQ) or a series of frequencies
+    # indexed by mutation name (e.g. 'C241T'), depths a frame laid out like
+    # the depth file read with header=None (position in column 1, depth in
+    # column 3) or a series of depths indexed by genome position.
+
+    def __init__(self, barcodes='-1', meta='-1', confirmedonly=False,
+                 wgisaid=False):
+        df_barcodes = load_barcodes(barcodes, confirmedonly, wgisaid)
+        # drop/sort the barcode columns once instead of per sample
+        self.barcodes, _, _ = reindex_dfs(df_barcodes,
+                                          pd.Series(dtype=float),
+                                          pd.Series(dtype=float))
+        self.muts = list(self.barcodes.columns)
+        if isinstance(meta, dict):
+            self.mapDict = meta
+        else:
+            self.mapDict = dict(buildLineageMap(meta))
+
+    def site_table(self, sample, covcut=10):
+        # observed mutation frequencies, depth per position and coverage
+        variants, depths = sample
+        if _is_path(depths):
+            df_depth = read_depths(os.fspath(depths))
+        elif isinstance(depths, pd.DataFrame):
+            df_depth = depths.set_index(1)
+        else:
+            df_depth = pd.DataFrame({3: depths})
+        if _is_path(variants):
+            variants = read_variants(os.fspath(variants))
+        if isinstance(variants, pd.DataFrame):
+            return site_table_from_frames(variants, df_depth, covcut)
+        freqs = variants.astype(float)
+        freqs = freqs[~freqs.index.duplicated(keep='first')]
+        siteDepths, coverage = depth_table(df_depth, covcut)
+        return freqs, siteDepths, coverage
+
+    def solve(self, freqs, siteDepths, name=None, eps=1e-3):
+        # lineages, abundances and residual of one site table
+        mix, depths_ = site_table_to_arrays(freqs, siteDepths, self.muts,
+                                            name)
+        mix, depths_ = reindex_sample(self.muts, mix, depths_)
+        sample_strains, abundances, error = \
+            solve_demixing_problem(self.barcodes, mix, depths_, eps)
+        sample_strains, abundances = merge_intra_lineage(sample_strains,
+                                                         abundances)
+        return sample_strains, abundances, error
+
+    def demix(self, sample, name=None, eps=1e-3, covcut=10, structured=True):
+        # same series `freyja demix` writes, with lists and a dict of
+        # constellations rather than strings unless structured is False
+        if name is None:
+            name = _sample_name(sample)
+        freqs, siteDepths, cov = self.site_table(sample, covcut)
+        sample_strains, abundances, error = self.solve(freqs, siteDepths,
+                                                       name, eps)
+        return build_output_series(sample_strains, abundances, error, cov,
+                                   self.mapDict, name, structured=structured)
+
+    def demix_many(self, samples, eps=1e-3, covcut=10, n_jobs=1):
+        # one row per sample, as in an aggregated file. samples is a list
+        # of samples, or a dict of them keyed by name.
+        if isinstance(samples, dict):
+            names, samples = list(samples), list(samples.values())
+        else:
+            samples = list(samples)
+            names = [_sample_name(s) for s in samples]
+        # one chunk of samples per task, to ship the barcodes once per worker
+        nChunks = max(1, min(len(samples), 4 * n_jobs))
+        chunks = [list(range(k, len(samples), nChunks))
+                  for k in range(nChunks)]
+        out = Parallel(n_jobs=n_jobs)(
+            delayed(self._demix_chunk)([samples[i] for i in chunk],
+                                       [names[i] for i in chunk], eps, covcut)
+            for chunk in chunks)
+        rows = {}
+        for chunk, sols in zip(chunks, out):
+            rows.update(zip(chunk, sols))
+        return pd.DataFrame([rows[i] for i in range(len(samples))],
+                            index=names,
+                            columns=['summarized', 'lineages', 'abundances',
+                                     'resid', 'coverage'])
+
+    def _demix_chunk(self, samples, names, eps, covcut):
+        return [self.demix(sample, name, eps, covcut)
+                for sample, name in zip(samples, names)]
+
+    def boot(self, sample, nb=100, eps=1e-3, n_jobs=1, boxplot='',
+             basename='test'):
+        # bootstrap percentiles of the lineage and constellation abundances
+        freqs, siteDepths, cov = self.site_table(sample)
+        mix, depths_ = site_table_to_arrays(freqs, siteDepths, self.muts,
+                                            _sample_name(sample))
+        mix, depths_ = reindex_sample(self.muts, mix, depths_)
+        return perform_bootstrap(self.barcodes, mix, depths_, nb, eps,
+                                 n_jobs, self.mapDict, self.muts, boxplot,
+                                 basename)
+
+
+def _sample_name(sample):
+    variants = sample[0]
+    if _is_path(variants):
+        return os.fspath(variants)
+    return getattr(variants, 'name', None)
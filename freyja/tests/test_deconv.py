@@ -1,8 +1,13 @@
 import unittest
+import gzip
+import os
+import shutil
+import tempfile
 import pandas as pd
 from freyja.sample_deconv import buildLineageMap, build_mix_and_depth_arrays,\
     reindex_dfs, map_to_constellation, solve_demixing_problem,\
-    perform_bootstrap
+    perform_bootstrap, constellation_codes, summarize_constellations,\
+    read_site_table, read_variants
 import pandas.testing as pdt
 import pandas.api.types as ptypes
 from numpy.random import negative_binomial
@@ -42,6 +47,19 @@ class DeconvTests(unittest.TestCase):
                          'Other': 0.02, 'A': 0.01}
         self.assertTrue(locDict == list(locDict_ideal.items()))
 
+    def test_constellation_matrix(self):
+        mapDict = buildLineageMap('-1')
+        strains = ['B.1.617.2', 'Q.3', 'B.1.427', 'A.2.5', 'B.1.1', 'B.1.1.7']
+        boots = [[0.1, 0.5, 0.31, 0.01, 0.02, 0.01],
+                 [0., 0.6, 0.2, 0.1, 0.1, 0.]]
+        codes, names = constellation_codes(strains, mapDict)
+        sums = summarize_constellations(codes, names, boots)
+        # replicates summarized at once match one at a time
+        for k in range(len(boots)):
+            locDict = dict(map_to_constellation(strains, boots[k], mapDict))
+            for j, name in enumerate(names):
+                self.assertAlmostEqual(sums[k, j], locDict[name])
+
     def test_demixing(self):
         df_barcodes = pd.read_csv('freyja/data/usher_barcodes.csv',
                                   index_col=0)
@@ -86,6 +104,32 @@ class DeconvTests(unittest.TestCase):
         self.assertAlmostEqual(lin_out.loc[0.5, 'B.1.1.7'], 0.4, delta=0.1)
         self.assertAlmostEqual(constell_out.loc[0.5, 'Alpha'], 0.4, delta=0.1)
 
+    def test_compressed_inputs(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            fns = {}
+            for fn in ['mixture.tsv', 'mixture.depth', 'test.vcf']:
+                fns[fn] = os.path.join(tmpDir, fn + '.gz')
+                with open(os.path.join('freyja/data', fn), 'rb') as f, \
+                        gzip.open(fns[fn], 'wb') as out:
+                    shutil.copyfileobj(f, out)
+            # bgzip output is gzip compatible, so a copy will do
+            shutil.copy(fns['mixture.depth'],
+                        os.path.join(tmpDir, 'mixture.depth.bgz'))
+            freqs, depths, cov = read_site_table('freyja/data/mixture.tsv',
+                                                 'freyja/data/mixture.depth',
+                                                 10)
+            freqs_, depths_, cov_ = read_site_table(
+                fns['mixture.tsv'], os.path.join(tmpDir, 'mixture.depth.bgz'),
+                10)
+            pdt.assert_series_equal(freqs, freqs_)
+            pdt.assert_series_equal(depths, depths_)
+            self.assertEqual(cov, cov_)
+            pdt.assert_frame_equal(read_variants('freyja/data/test.vcf'),
+                                   read_variants(fns['test.vcf']))
+        finally:
+            shutil.rmtree(tmpDir)
+
 
 if __name__ == '__main__':
     unittest.main()
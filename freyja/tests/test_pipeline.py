@@ -0,0 +1,83 @@
+import unittest
+import os
+import shutil
+import tempfile
+from unittest import mock
+import pandas as pd
+from freyja.pipeline import read_manifest, run_manifest, pileup_command
+from freyja.sample_deconv import read_site_table
+from freyja.session import Session
+
+
+class PipelineTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.varFn = os.path.abspath('freyja/data/mixture.tsv')
+        self.depthFn = os.path.abspath('freyja/data/mixture.depth')
+        # small barcode set from substitutions observed in the mixture
+        freqs, _, _ = read_site_table(self.varFn, self.depthFn, 10)
+        muts = list(freqs.index[freqs.index.str.fullmatch(
+            r'[ACGT]\d+[ACGT]')][:30])
+        df_barcodes = pd.DataFrame(0., index=['B.1.1.7', 'AY.4', 'Q.3'],
+                                   columns=muts)
+        for j, lin in enumerate(df_barcodes.index):
+            df_barcodes.loc[lin, muts[j::3]] = 1.
+        self.session = Session(df_barcodes)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_run_manifest(self):
+        manifest = os.path.join(self.tmpDir, 'manifest.tsv')
+        with open(manifest, 'w') as f:
+            f.write('sample\tvariants\tdepths\n')
+            for name in ['a', 'b', 'c']:
+                f.write(f'{name}\t{self.varFn}\t{self.depthFn}\n')
+            f.write('d\tmissing.tsv\tmissing.depth\n')
+        samples = read_manifest(manifest)
+        self.assertEqual(samples[3]['variants'],
+                         os.path.join(self.tmpDir, 'missing.tsv'))
+
+        outdir = os.path.join(self.tmpDir, 'results')
+        failed = run_manifest(samples, self.session, outdir, ref=None,
+                              n_jobs=2, nb=2)
+        self.assertEqual(list(failed), ['d'])
+        sols = self.session.demix((self.varFn, self.depthFn),
+                                  structured=False)
+        for name in ['a', 'b', 'c']:
+            out = pd.read_csv(os.path.join(outdir, name + '.tsv'), sep='\t',
+                              index_col=0)[name]
+            self.assertEqual(out['lineages'], sols['lineages'])
+            self.assertTrue(os.path.exists(
+                os.path.join(outdir, 'boot', name + '_lineages.csv')))
+
+    def test_bam_samples(self):
+        # pileups are mocked, returning the mixture's ivar/depth outputs
+        with open(self.varFn, 'rb') as f:
+            varData = f.read()
+        with open(self.depthFn, 'rb') as f:
+            depthData = f.read()
+        samples = [{'sample': 'a', 'bam': 'a.bam'}]
+        outdir = os.path.join(self.tmpDir, 'results')
+        with mock.patch('freyja.pipeline._pileup',
+                        return_value=(varData, depthData)) as pileup:
+            failed = run_manifest(samples, self.session, outdir,
+                                  ref='ref.fa', keep_intermediates=True)
+        self.assertEqual(failed, {})
+        pileup.assert_called_once_with('a.bam', 'ref.fa', '', 20)
+        sols = self.session.demix((self.varFn, self.depthFn),
+                                  structured=False)
+        out = pd.read_csv(os.path.join(outdir, 'a.tsv'), sep='\t',
+                          index_col=0)['a']
+        self.assertEqual(out['lineages'], sols['lineages'])
+        with open(os.path.join(outdir, 'variants', 'a.depth'), 'rb') as f:
+            self.assertEqual(f.read(), depthData)
+
+    def test_pileup_command(self):
+        cmd = pileup_command('my sample.bam', 'ref.fa', 'v.tsv', 'd.depth')
+        self.assertIn("'my sample.bam'", cmd)
+        self.assertIn('ivar variants -p v.tsv -q 20', cmd)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+import numpy as np
+import pysam
+from freyja.read_events import ReadEvents, as_bases
+
+
+class ReadEventsTests(unittest.TestCase):
+    def setUp(self):
+        self.ref = 'ACGTACGTACGTACGTACGT'
+        # 2S 4M 2I 3M 2D 4M: GTAC at 2-5, TT inserted before 6, then GTA,
+        # then 9-10 deleted and TACC at 11-14
+        self.read = pysam.AlignedSegment()
+        self.read.query_name = 'r1'
+        self.read.query_sequence = 'NNGTACTTGTATACC'
+        self.read.reference_start = 2
+        self.read.cigartuples = [(4, 2), (0, 4), (1, 2), (0, 3), (2, 2),
+                                 (0, 4)]
+        self.read.query_qualities = pysam.qualitystring_to_array(
+            'IIIIIII#IIIIIII')
+
+    def test_events(self):
+        events = ReadEvents(self.read)
+        self.assertEqual((events.start, events.end), (2, 15))
+        self.assertTrue(events.clipped)
+        self.assertEqual(events.insertions, [(6, 'TT')])
+        self.assertEqual(events.deletions, [(9, 2)])
+        bases = events.bases_at([1, 2, 6, 9, 10, 13, 15])
+        self.assertEqual(bases.tobytes(), b'\0GG\0\0C\0')
+
+        sites, alts = events.mismatches(as_bases(self.ref))
+        self.assertEqual(list(sites), [14])
+        self.assertEqual(alts.tobytes(), b'C')
+
+    def test_quality_mask(self):
+        events = ReadEvents(self.read, min_quality=20)
+        self.assertEqual(events.insertions, [(6, 'TN')])
+        self.assertEqual(events.bases_at(np.arange(6, 9)).tobytes(), b'GTA')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import unittest
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import pandas as pd
+from freyja.redemix import diff_barcodes, needs_resolve, save_site_table,\
+    load_site_table, barcode_hash, load_barcode_snapshot
+from freyja.sample_deconv import read_site_table
+
+
+class RedemixTests(unittest.TestCase):
+    def setUp(self):
+        self.old = pd.DataFrame({'A1C': [1., 1., 0.],
+                                 'G5T': [0., 1., 0.],
+                                 'T9A': [0., 0., 1.]},
+                                index=['X', 'X.1', 'Y'])
+        self.cacheDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cacheDir)
+
+    def test_diff_barcodes(self):
+        new = self.old.copy()
+        # X.2 only adds C12G on top of X.1
+        new.loc['X.2'] = [1., 1., 0.]
+        new['C12G'] = [0., 0., 0., 1.]
+        sensitive, touched = diff_barcodes(self.old, new)
+        self.assertEqual(sensitive, {'C12G'})
+        self.assertEqual(touched, {'X.1'})
+
+        # a changed barcode marks the lineage and the flipped site
+        new = self.old.copy()
+        new.loc['Y', 'G5T'] = 1.
+        sensitive, touched = diff_barcodes(self.old, new)
+        self.assertEqual(sensitive, {'G5T'})
+        self.assertEqual(touched, {'Y'})
+
+    def test_site_cache_roundtrip(self):
+        freqs, siteDepths, cov = read_site_table('freyja/data/mixture.tsv',
+                                                 'freyja/data/mixture.depth',
+                                                 10)
+        fn = save_site_table(self.cacheDir, freqs, siteDepths, ['X'], [1.],
+                             0.5, cov, 1e-3, self.old, 'mixture.output',
+                             'freyja/data/mixture.tsv')
+        entry = load_site_table(fn)
+        pd.testing.assert_series_equal(entry['freqs'], freqs,
+                                       check_names=False,
+                                       check_index_type=False)
+        self.assertEqual(entry['barcodes'], barcode_hash(self.old))
+        snapshot = load_barcode_snapshot(self.cacheDir, entry['barcodes'])
+        pd.testing.assert_frame_equal(snapshot, self.old)
+        self.assertTrue(os.path.isabs(entry['output']))
+        # the same sample from another run directory gets its own entry
+        fn2 = save_site_table(self.cacheDir, freqs, siteDepths, ['X'], [1.],
+                              0.5, cov, 1e-3, self.old, 'run2/mixture.output',
+                              'freyja/data/mixture.tsv')
+        self.assertNotEqual(fn, fn2)
+        self.assertEqual(load_site_table(fn)['output'], entry['output'])
+
+        # only samples covering a sensitive site are re-solved, whether or
+        # not they show the mutation
+        uncovered = siteDepths.index[siteDepths == 0][0]
+        mutated = set(freqs.index.str.extract(r'(\d+)')[0].astype(int))
+        covered = [p for p in siteDepths.index[siteDepths > 0]
+                   if p not in mutated][0]
+        self.assertFalse(needs_resolve(entry, ({f'C{uncovered}G'}, {'Y'})))
+        self.assertTrue(needs_resolve(entry, ({f'C{uncovered}G'}, {'X'})))
+        observed = freqs.index[freqs > 0][0]
+        self.assertTrue(needs_resolve(entry, ({observed}, set())))
+        self.assertTrue(needs_resolve(entry, ({f'A{covered}C'}, set())))
+
+
+class RedemixRunTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.cacheDir = os.path.join(self.tmpDir, 'cache')
+        self.varFn = 'freyja/data/mixture.tsv'
+        self.depthFn = 'freyja/data/mixture.depth'
+        freqs, siteDepths, _ = read_site_table(self.varFn, self.depthFn, 10)
+        subs = freqs[freqs.index.str.fullmatch(r'[ACGT]\d+[ACGT]')]
+        muts = list(subs.sort_values(ascending=False).index[:22])
+        mutated = set(freqs.index.str.extract(r'(\d+)')[0].astype(int))
+        # mutations at covered sites where the sample has none, and at a
+        # site without any coverage
+        covered = [p for p in siteDepths.index[siteDepths > 0]
+                   if p > 100 and p not in mutated][:20]
+        self.absent = [f'A{p}T' for p in covered]
+        self.uncovered = f'A{siteDepths.index[siteDepths == 0][-1]}T'
+        self.barcodes = pd.DataFrame(0., index=['B.1.1.7', 'AY.4', 'Q.3'],
+                                     columns=muts + self.absent)
+        self.barcodes.loc['B.1.1.7', muts[:10]] = 1.
+        self.barcodes.loc['AY.4', muts[10:20]] = 1.
+        # Q.3 would fit better than AY.4, but for the absent mutations
+        self.barcodes.loc['Q.3', muts[10:] + self.absent] = 1.
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _demix(self, barcodes, output, sitecache=None, outformat='tsv'):
+        bcFn = os.path.join(self.tmpDir, 'barcodes.csv')
+        barcodes.to_csv(bcFn)
+        cmd = ['freyja', 'demix', self.varFn, self.depthFn,
+               '--barcodes', bcFn, '--output', output,
+               '--outformat', outformat]
+        if sitecache is not None:
+            cmd += ['--sitecache', sitecache]
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+
+    def _redemix(self, barcodes, outdir=None):
+        bcFn = os.path.join(self.tmpDir, 'barcodes.csv')
+        barcodes.to_csv(bcFn)
+        cmd = ['freyja', 'redemix', self.cacheDir, '--barcodes', bcFn]
+        if outdir is not None:
+            cmd += ['--outdir', outdir]
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+
+    def _read(self, fn):
+        sols = pd.read_csv(fn, sep='\t', index_col=0).iloc[:, 0]
+        return sols['lineages'], sols['abundances']
+
+    def test_redemix_matches_demix(self):
+        output = os.path.join(self.tmpDir, 'mixture.output')
+        self._demix(self.barcodes, output, self.cacheDir)
+        self.assertNotIn('Q.3', self._read(output)[0].split(' '))
+
+        # Q.3 loses the mutations the sample doesn't carry
+        new = self.barcodes.copy()
+        new.loc['Q.3', self.absent] = 0.
+        outDir = os.path.join(self.tmpDir, 'redemixed')
+        self._redemix(new, outDir)
+        fresh = os.path.join(self.tmpDir, 'fresh.output')
+        self._demix(new, fresh)
+        lineages, abundances = self._read(fresh)
+        self.assertIn('Q.3', lineages.split(' '))
+        self.assertEqual(self._read(os.path.join(outDir, 'mixture.output')),
+                         (lineages, abundances))
+
+    def test_redemix_keeps_jsonl(self):
+        output = os.path.join(self.tmpDir, 'mixture.jsonl')
+        self._demix(self.barcodes, output, self.cacheDir, 'jsonl')
+        new = self.barcodes.copy()
+        new.loc['Q.3', self.absent] = 0.
+        outDir = os.path.join(self.tmpDir, 'redemixed')
+        self._redemix(new, outDir)
+        # written in place as well
+        self._redemix(new.drop(index='AY.4'))
+        fresh = os.path.join(self.tmpDir, 'fresh.jsonl')
+        self._demix(new, fresh, outformat='jsonl')
+        with open(fresh) as f:
+            expected = json.loads(f.read())
+        with open(os.path.join(outDir, 'mixture.jsonl')) as f:
+            self.assertEqual(json.loads(f.read()), expected)
+        with open(output) as f:
+            record = json.loads(f.read())
+        self.assertNotIn('AY.4', record['lineages'])
+        self.assertEqual(record['sample'], expected['sample'])
+
+    def test_unchanged_samples_left_alone(self):
+        output = os.path.join(self.tmpDir, 'mixture.output')
+        self._demix(self.barcodes, output, self.cacheDir)
+        cacheFn = [fn for fn in os.listdir(self.cacheDir)
+                   if not fn.startswith('barcodes_')][0]
+        cacheFn = os.path.join(self.cacheDir, cacheFn)
+        mtimes = (os.stat(output).st_mtime_ns, os.stat(cacheFn).st_mtime_ns)
+
+        # Q.3 is not in the solution, and its new site isn't covered
+        new = self.barcodes.copy()
+        new[self.uncovered] = 0.
+        new.loc['Q.3', self.uncovered] = 1.
+        self._redemix(new)
+        self.assertEqual((os.stat(output).st_mtime_ns,
+                          os.stat(cacheFn).st_mtime_ns), mtimes)
+
+
+if __name__ == '__main__':
+    unittest.main()
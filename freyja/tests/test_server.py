@@ -0,0 +1,104 @@
+import unittest
+import os
+import signal
+import stat
+import shutil
+import tempfile
+import threading
+import pandas as pd
+from freyja.server import make_server, close_server, reference_config,\
+    request
+from freyja.sample_deconv import read_site_table
+from freyja.session import Session
+
+
+class ServerTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        # small barcode set from mutations observed in the mixture
+        freqs, _, _ = read_site_table('freyja/data/mixture.tsv',
+                                      'freyja/data/mixture.depth', 10)
+        muts = list(freqs.index[:30])
+        df_barcodes = pd.DataFrame(0., index=['B.1.1.7', 'AY.4', 'Q.3'],
+                                   columns=muts)
+        for j, lin in enumerate(df_barcodes.index):
+            df_barcodes.loc[lin, muts[j::3]] = 1.
+        self.barcodes = os.path.join(self.tmpDir, 'barcodes.csv')
+        df_barcodes.to_csv(self.barcodes)
+        self.config = reference_config(self.barcodes, '-1', False, False)
+        self.socket = os.path.join(self.tmpDir, 'freyja.sock')
+        self.server = make_server(Session(self.barcodes), self.config,
+                                  socketPath=self.socket, n_jobs=2,
+                                  outdir=self.tmpDir)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        close_server(self.server)
+        shutil.rmtree(self.tmpDir)
+
+    def test_demix_request(self):
+        output = os.path.join(self.tmpDir, 'mixture.output')
+        req = {'variants': os.path.abspath('freyja/data/mixture.tsv'),
+               'depths': os.path.abspath('freyja/data/mixture.depth'),
+               'name': 'mixture.tsv', 'output': output, 'eps': 1e-3,
+               'covcut': 10, 'outformat': 'tsv',
+               'reference': self.config}
+        request(self.socket, '/demix', req)
+        sols = pd.read_csv(output, sep='\t', index_col=0)
+        self.assertEqual(sols.columns[0], 'mixture.tsv')
+        abundances = [float(a) for a in
+                      sols.loc['abundances'].iloc[0].split(' ')]
+        self.assertAlmostEqual(sum(abundances), 1., places=4)
+
+        # requests for other reference data are refused
+        req['reference'] = reference_config('-1', '-1', False, False)
+        with self.assertRaises(RuntimeError):
+            request(self.socket, '/demix', req)
+        # as are requests that leave it out
+        del req['reference']
+        with self.assertRaisesRegex(RuntimeError, 'different reference'):
+            request(self.socket, '/demix', req)
+        stats = request(self.socket, '/stats')['endpoints']['/demix']
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['errors'], 2)
+
+    def _demix_request(self, output):
+        return {'variants': os.path.abspath('freyja/data/mixture.tsv'),
+                'depths': os.path.abspath('freyja/data/mixture.depth'),
+                'name': 'mixture.tsv', 'output': output, 'eps': 1e-3,
+                'covcut': 10, 'outformat': 'tsv', 'reference': self.config}
+
+    def test_outputs_confined(self):
+        mode = os.stat(self.socket).st_mode
+        self.assertEqual(stat.S_IMODE(mode) & 0o077, 0)
+        outside = tempfile.mkdtemp()
+        for req in [self._demix_request(os.path.join(outside, 'out.tsv')),
+                    self._demix_request(os.path.join(self.tmpDir, '..',
+                                                     'out.tsv'))]:
+            with self.assertRaises(RuntimeError):
+                request(self.socket, '/demix', req)
+        req = self._demix_request(os.path.join(self.tmpDir, 'out.tsv'))
+        req['sitecache'] = outside
+        with self.assertRaises(RuntimeError):
+            request(self.socket, '/demix', req)
+        self.assertEqual(os.listdir(outside), [])
+        shutil.rmtree(outside)
+
+    def test_worker_crash(self):
+        for pid in list(self.server.pool._processes):
+            os.kill(pid, signal.SIGKILL)
+        output = os.path.join(self.tmpDir, 'mixture.output')
+        # the request caught by the crash fails, the next ones get a new pool
+        try:
+            request(self.socket, '/demix', self._demix_request(output))
+        except RuntimeError:
+            pass
+        request(self.socket, '/demix', self._demix_request(output))
+        self.assertTrue(os.path.exists(output))
+
+
+if __name__ == '__main__':
+    unittest.main()
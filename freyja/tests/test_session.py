@@ -0,0 +1,48 @@
+import unittest
+import pandas as pd
+from freyja import Session
+from freyja.sample_deconv import read_site_table
+
+
+class SessionTests(unittest.TestCase):
+    def setUp(self):
+        self.varFn = 'freyja/data/mixture.tsv'
+        self.depthFn = 'freyja/data/mixture.depth'
+        # small barcode set from mutations observed in the mixture
+        freqs, _, _ = read_site_table(self.varFn, self.depthFn, 10)
+        muts = list(freqs.index[:30])
+        df_barcodes = pd.DataFrame(0., index=['B.1.1.7', 'AY.4', 'Q.3'],
+                                   columns=muts)
+        for j, lin in enumerate(df_barcodes.index):
+            df_barcodes.loc[lin, muts[j::3]] = 1.
+        self.session = Session(df_barcodes)
+
+    def test_in_memory_samples(self):
+        sols = self.session.demix((self.varFn, self.depthFn))
+        self.assertEqual(sols.name, self.varFn)
+        self.assertAlmostEqual(sum(sols['abundances']), 1., places=4)
+
+        df = pd.read_csv(self.varFn, sep='\t')
+        df_depth = pd.read_csv(self.depthFn, sep='\t', header=None)
+        freqs, siteDepths, cov = read_site_table(self.varFn, self.depthFn,
+                                                 10)
+        for sample in [(df, df_depth), (freqs, siteDepths)]:
+            sols_mem = self.session.demix(sample, name=self.varFn)
+            self.assertEqual(sols_mem['lineages'], sols['lineages'])
+            self.assertEqual(sols_mem['abundances'], sols['abundances'])
+            self.assertAlmostEqual(sols_mem['coverage'], sols['coverage'])
+
+    def test_demix_many(self):
+        samples = {'a': (self.varFn, self.depthFn),
+                   'b': (self.varFn, self.depthFn),
+                   'c': (self.varFn, self.depthFn)}
+        sols = self.session.demix((self.varFn, self.depthFn))
+        for n_jobs in [1, 2]:
+            agg = self.session.demix_many(samples, n_jobs=n_jobs)
+            self.assertEqual(list(agg.index), ['a', 'b', 'c'])
+            for name in agg.index:
+                self.assertEqual(agg.loc[name, 'lineages'], sols['lineages'])
+
+
+if __name__ == '__main__':
+    unittest.main()
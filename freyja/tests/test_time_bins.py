@@ -0,0 +1,51 @@
+import unittest
+import numpy as np
+import pandas as pd
+from epiweeks import Week
+from freyja.time_bins import bin_labels, bin_means, epiweeks, TimeBins
+
+
+class TimeBinsTests(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        days = pd.date_range('2021-12-01', '2023-02-01', freq='D')
+        self.df = pd.DataFrame(rng.random((200, 3)),
+                               index=pd.DatetimeIndex(rng.choice(days, 200)),
+                               columns=['A', 'B', 'C'])
+
+    def test_epiweeks(self):
+        sats = bin_labels(pd.date_range('2019-12-20', '2027-01-10'), 'W')
+        self.assertTrue((sats.dayofweek == 5).all())
+        years, weeks = epiweeks(sats)
+        self.assertEqual(list(zip(years, weeks)),
+                         [Week.fromdate(d).weektuple() for d in sats])
+
+    def test_bin_means(self):
+        for interval, freq in [('D', 'D'), ('W', 'W-SAT'), ('MS', 'MS')]:
+            pd.testing.assert_frame_equal(
+                bin_means(self.df, interval),
+                self.df.groupby(pd.Grouper(freq=freq)).mean(),
+                check_freq=False)
+        # weighted means, rows without a weight are dropped
+        w = np.arange(self.df.shape[0], dtype=float)
+        w[::7] = np.nan
+        keep = ~np.isnan(w)
+        expected = self.df[keep].multiply(w[keep], axis=0)\
+            .groupby(level=0).sum()\
+            .divide(pd.Series(w[keep], index=self.df.index[keep])
+                    .groupby(level=0).sum(), axis=0)
+        pd.testing.assert_frame_equal(
+            bin_means(self.df, weights=w).dropna(), expected,
+            check_freq=False)
+
+    def test_time_bins_cache(self):
+        bins = TimeBins(self.df)
+        weekly = bins.get('W')
+        self.assertIs(bins.get('W'), weekly)
+        pd.testing.assert_frame_equal(
+            bins.get('D', 14),
+            bins.get('D').rolling(14, center=True, min_periods=0).mean())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,20 @@
 import unittest
+import numpy as np
 import pandas as pd
-from freyja.utils import agg, checkConfig, prepLineageDict, prepSummaryDict,\
-    get_color_scheme, get_abundance, calc_rel_growth_rates
+from freyja.utils import agg, agg_incremental, read_demix_output,\
+    read_agg, write_agg, checkConfig, prepLineageDict, prepSummaryDict,\
+    get_color_scheme, get_abundance, calc_rel_growth_rates, lineage_long,\
+    long_to_matrix, long_to_wide, compile_lineage_groups, load_lineage_info,\
+    load_lineage_index, write_lineage_index, logistic_growth,\
+    fit_logistic_growth, fit_multinomial_growth, fit_growth_tasks,\
+    make_dashboard, make_site_dashboards, make_plots, drop_empty_samples
+import json
 import os
+import shutil
+import tempfile
 import plotly.express as px
 import yaml
+from scipy.optimize import curve_fit
 
 
 class UtilsTests(unittest.TestCase):
@@ -161,6 +171,67 @@ class UtilsTests(unittest.TestCase):
         self.assertTrue('mixture.tsv' in agg_df.index)
         self.assertTrue('summarized' in agg_df.columns)
 
+    def test_agg_incremental(self):
+        tmpDir = tempfile.mkdtemp()
+        store = os.path.join(tmpDir, 'store.tsv')
+        shutil.copy('freyja/data/outputs/mixture.output', tmpDir)
+        fns = [os.path.join(tmpDir, 'mixture.output')]
+        df, nParsed = agg_incremental(fns, store)
+        self.assertEqual(nParsed, 1)
+        # nothing new, nothing parsed
+        df, nParsed = agg_incremental(fns, store)
+        self.assertEqual(nParsed, 0)
+        # new samples are appended to the store
+        shutil.copy('freyja/data/outputs/test.output', tmpDir)
+        fns.append(os.path.join(tmpDir, 'test.output'))
+        df, nParsed = agg_incremental(fns, store)
+        self.assertEqual(nParsed, 1)
+        df = pd.read_csv(store, sep='\t', index_col=0)
+        self.assertListEqual(list(df.index), ['mixture.tsv', 'test.tsv'])
+        self.assertTrue('result_mtime' in df.columns)
+        self.assertListEqual(list(df['summarized']),
+                             list(agg(fns)['summarized']))
+        self.assertListEqual(list(df['result_file']),
+                             ['mixture.output', 'test.output'])
+        # the same file name in two subdirectories gives two rows
+        for sub in ['a', 'b']:
+            os.makedirs(os.path.join(tmpDir, sub))
+            fns.append(os.path.join(tmpDir, sub, 'mixture.output'))
+            shutil.copy('freyja/data/outputs/mixture.output', fns[-1])
+        df, nParsed = agg_incremental(fns, store)
+        self.assertEqual(nParsed, 2)
+        df, nParsed = agg_incremental(fns, store)
+        self.assertEqual(nParsed, 0)
+        self.assertListEqual(list(df['result_file']),
+                             ['mixture.output', 'test.output',
+                              'a/mixture.output', 'b/mixture.output'])
+        # deleted and renamed result files lose their rows
+        os.remove(fns[1])
+        renamed = os.path.join(tmpDir, 'b', 'rerun.output')
+        os.rename(fns[3], renamed)
+        fns = [fns[0], fns[2], renamed]
+        df, nParsed = agg_incremental(fns, store)
+        self.assertEqual(nParsed, 1)
+        df = pd.read_csv(store, sep='\t', index_col=0)
+        self.assertListEqual(list(df['result_file']),
+                             ['mixture.output', 'a/mixture.output',
+                              'b/rerun.output'])
+        # and with nothing new to parse
+        os.remove(renamed)
+        df, nParsed = agg_incremental(fns[:2], store)
+        self.assertEqual(nParsed, 0)
+        df = pd.read_csv(store, sep='\t', index_col=0)
+        self.assertListEqual(list(df['result_file']),
+                             ['mixture.output', 'a/mixture.output'])
+        shutil.rmtree(tmpDir)
+
+    def test_read_demix_output(self):
+        fn = 'freyja/data/outputs/mixture.output'
+        name, values = read_demix_output(fn)
+        df = pd.read_csv(fn, skipinitialspace=True, sep='\t', index_col=0)
+        self.assertEqual(name, df.columns[0])
+        self.assertDictEqual(values, df.iloc[:, 0].to_dict())
+
     def test_prep(self):
         agg_df = pd.read_csv('freyja/data/agg_outputs.tsv',
                              skipinitialspace=True,
@@ -178,6 +249,72 @@ class UtilsTests(unittest.TestCase):
                         (agg_df['summarized'][1]['A'] > 0))
         self.assertTrue(agg_df['summarized'][1]['Delta'] > 0)
 
+    def test_long_format(self):
+        agg_df = pd.read_csv('freyja/data/agg_outputs.tsv',
+                             skipinitialspace=True,
+                             sep='\t', index_col=0)
+        long_df = lineage_long(agg_df)
+        self.assertEqual(long_df['abundance'].dtype, 'float32')
+        self.assertEqual(str(long_df['lineage'].dtype), 'category')
+        # duplicated sample names are reported, not left to pandas
+        with self.assertRaisesRegex(ValueError, 'more than once'):
+            lineage_long(pd.concat([agg_df, agg_df.iloc[:1]]))
+        mat = long_to_matrix(long_df)
+        # samples without lineages are dropped
+        self.assertEqual(mat.shape,
+                         (agg_df.shape[0] - 1,
+                          len(long_df['lineage'].cat.categories)))
+        self.assertEqual(mat.nnz, long_df.shape[0])
+        # wide frame matches the per-sample dicts
+        wide = long_to_wide(long_df)
+        linDict = prepLineageDict(agg_df, thresh=0.)['linDict']
+        for samp, d in zip(wide.index, linDict):
+            self.assertListEqual(list(wide.loc[samp, list(d)]),
+                                 list(d.values()))
+            self.assertAlmostEqual(wide.loc[samp].sum(), sum(d.values()))
+
+    def test_structured_agg(self):
+        agg_df = pd.read_csv('freyja/data/agg_outputs.tsv',
+                             skipinitialspace=True,
+                             sep='\t', index_col=0)
+        tmpDir = tempfile.mkdtemp()
+        fn = os.path.join(tmpDir, 'agg.jsonl')
+        write_agg(agg_df, fn, 'jsonl')
+        agg_js = read_agg(fn)
+        self.assertTrue(isinstance(agg_js['lineages'][0], list))
+        self.assertTrue(isinstance(agg_js['summarized'][0], dict))
+        # structured and stringified inputs prepare identically
+        lin_str = prepLineageDict(agg_df, thresh=0.001)
+        lin_js = prepLineageDict(agg_js, thresh=0.001)
+        self.assertListEqual(list(lin_str['linDict']),
+                             list(lin_js['linDict']))
+        self.assertListEqual(list(prepSummaryDict(agg_df)['summarized']),
+                             list(prepSummaryDict(agg_js)['summarized']))
+        shutil.rmtree(tmpDir)
+
+    def test_jsonl_from_outputs(self):
+        # demix outputs aggregate as strings, the jsonl store keeps numbers
+        outDir = tempfile.mkdtemp()
+        output = os.path.join(outDir, 'mixture.output')
+        with open('freyja/data/outputs/mixture.output') as f:
+            demix = f.read()
+        with open(output, 'w') as f:
+            f.write(demix + 'coverage\t98.5\n')
+        fn = os.path.join(outDir, 'agg.jsonl')
+        write_agg(agg([output]), fn, 'jsonl')
+        with open(fn) as f:
+            record = json.loads(f.readline())
+        self.assertIsInstance(record['coverage'], float)
+        self.assertIsInstance(record['resid'], float)
+        agg_df = read_agg(fn)
+        agg_df = drop_empty_samples(agg_df[agg_df['coverage'] > 60.])
+        self.assertGreater(agg_df.shape[0], 0)
+        plotFn = os.path.join(outDir, 'plot.png')
+        make_plots(agg_df, [(plotFn, 'D', True)], {},
+                   load_lineage_info('freyja/data/lineages.yml'))
+        self.assertGreater(os.path.getsize(plotFn), 0)
+        shutil.rmtree(outDir)
+
     def test_checkConfig(self):
         # config dictionaries whose format is valid.
         valid_configs = [
@@ -339,6 +476,43 @@ class UtilsTests(unittest.TestCase):
         dates = [str(i) for i in list(dates)]
         self.assertListEqual(dates, self.dates_to_keep)
 
+    def test_compile_lineage_groups(self):
+        config = {'grp_1': {'name': 'grp_1', 'members': ['B.1.1.7*']},
+                  'grp_2': {'name': 'grp_2', 'members': ['Q.3', 'AY.48']}}
+        groups = compile_lineage_groups(config, self.lineage_info)
+        self.assertEqual(groups['B.1.1.7'], 'grp_1')
+        # first group in the config wins for overlapping members
+        self.assertEqual(groups['Q.3'], 'grp_1')
+        self.assertEqual(groups['AY.48'], 'grp_2')
+        self.assertNotIn('B.1.617.2', groups)
+        # the config itself is left untouched
+        self.assertListEqual(config['grp_1']['members'], ['B.1.1.7*'])
+
+    def test_lineage_index(self):
+        self.assertDictEqual(load_lineage_info('freyja/data/lineages.yml'),
+                             self.lineage_info)
+        tmpDir = tempfile.mkdtemp()
+        fn = os.path.join(tmpDir, 'lineages.yml')
+        with open(fn, 'w') as f:
+            f.write('- name: B\n  alias: B\n  children: [B, B.1, C.1]\n'
+                    '- name: B.1\n  alias: B.1\n  children: [B.1, C.1]\n'
+                    '  parent: B\n'
+                    '- name: C.1\n  alias: B.1.1\n  children: [C.1]\n'
+                    '  parent: B.1\n')
+        write_lineage_index(fn)
+        index = load_lineage_index(fn)
+        ids = {name: i for i, name in enumerate(index['names'])}
+        self.assertListEqual(index['ancestors'][ids['C.1']],
+                             [ids['B.1'], ids['B']])
+        self.assertListEqual(sorted(index['descendants'][ids['B']]),
+                             [ids['B.1'], ids['C.1']])
+        # a stale index is ignored
+        with open(fn, 'a') as f:
+            f.write('- name: C.2\n  alias: B.1.2\n  children: [C.2]\n'
+                    '  parent: B.1\n')
+        self.assertIn('C.2', load_lineage_info(fn))
+        shutil.rmtree(tmpDir)
+
     def test_get_color_scheme(self):
         self.df_ab_lin.index = pd.to_datetime(self.df_ab_lin.index)
         default_color_scheme = {
@@ -373,6 +547,47 @@ class UtilsTests(unittest.TestCase):
                 self.config.get('Lineages')
             ), color_scheme_with_config)
 
+    def test_fit_logistic_growth(self):
+        rng = np.random.default_rng(0)
+        days = np.arange(0, 56, 4)
+        data = []
+        for b, r in [(50., 0.08), (5., -0.05), (900., 0.12), (1., 0.01)]:
+            data.append(np.clip(logistic_growth(days, b, r) +
+                                rng.normal(0, 0.02, len(days)), 0, 1))
+        # batched fits agree with fitting one at a time
+        fits = fit_logistic_growth(days, np.array(data))
+        for k, dat in enumerate(data):
+            fit, _ = curve_fit(logistic_growth, days, dat, p0=[100, 0.1],
+                               bounds=([0, -10], [1000, 10]))
+            self.assertAlmostEqual(fits[k, 1], fit[1], delta=1e-4)
+            self.assertAlmostEqual(fits[k, 0], fit[0],
+                                   delta=1e-3 * fit[0])
+
+    def test_fit_multinomial_growth(self):
+        rng = np.random.default_rng(0)
+        days = np.arange(0, 56, 2)
+        rates = np.array([0., 0.08, 0.15, -0.05])
+        z = np.array([0., -2., -4., 1.]) + np.outer(days - days.mean(), rates)
+        p = np.exp(z) / np.exp(z).sum(axis=1, keepdims=True)
+        # exact prevalences give back the rates relative to the reference
+        fit, se = fit_multinomial_growth(days, p, ref=0)
+        np.testing.assert_allclose(fit, rates, atol=1e-6)
+        # and sampled ones land within their intervals
+        data = np.array([rng.multinomial(500, pp) / 500 for pp in p])
+        fit, se = fit_multinomial_growth(days, data, ref=0)
+        self.assertEqual(se[0], 0)
+        self.assertTrue(np.all(np.abs(fit - rates) <= 3 * se + 1e-12))
+
+    def test_fit_growth_tasks(self):
+        days = np.arange(0, 56, 4)
+        tasks = [(days, logistic_growth(days, b, r))
+                 for b, r in [(50., 0.08), (5., -0.05), (900., 0.12)]]
+        serial = fit_growth_tasks(tasks, 50, seed=7, n_jobs=1)
+        # the same seed gives identical intervals on any number of workers
+        self.assertEqual(serial, fit_growth_tasks(tasks, 50, seed=7,
+                                                  n_jobs=2))
+        self.assertAlmostEqual(serial[0][0], 0.08, places=4)
+
     def test_calc_rel_growth_rates(self):
         df_rel_growth_rates_expected = pd.read_csv(
             'freyja/data/rel_growth_rates.csv')
@@ -380,6 +595,7 @@ class UtilsTests(unittest.TestCase):
         nboots = 1000
         serial_interval = 5.5
         daysIncluded = 56
+        df_ab_lin = self.df_ab_lin.copy()
 
         calc_rel_growth_rates(
             self.df_ab_lin,
@@ -395,9 +611,112 @@ class UtilsTests(unittest.TestCase):
             df_rel_growth_rates[['Lineage', 'Estimated Advantage']],
             df_rel_growth_rates_expected[['Lineage', 'Estimated Advantage']]
         )
+        # same table layout from the multinomial fit
+        calc_rel_growth_rates(df_ab_lin, nboots, serial_interval,
+                              'rel_growth_rates.csv', daysIncluded,
+                              grThresh=0.01, method='multinomial')
+        self.assertListEqual(list(pd.read_csv('rel_growth_rates.csv').columns),
+                             list(df_rel_growth_rates_expected.columns))
         # Clean up
         os.remove('rel_growth_rates.csv')
 
+    def test_growth_rate_cache(self):
+        self.df_ab_lin.index = pd.to_datetime(self.df_ab_lin.index)
+        cacheDir = tempfile.mkdtemp()
+        cacheFn = os.path.join(cacheDir, 'growth.json')
+        outs = []
+        for k in range(2):
+            outFn = os.path.join(cacheDir, f'rates{k}.csv')
+            calc_rel_growth_rates(self.df_ab_lin.copy(), 100, 5.5, outFn,
+                                  56, grThresh=0.01, seed=1,
+                                  cacheFn=cacheFn)
+            outs.append(pd.read_csv(outFn))
+        with open(cacheFn) as f:
+            cache = json.load(f)
+        self.assertEqual(len(cache), outs[0].shape[0])
+        pd.testing.assert_frame_equal(outs[0], outs[1])
+        # a different nboots misses the cache
+        calc_rel_growth_rates(self.df_ab_lin.copy(), 50, 5.5,
+                              os.path.join(cacheDir, 'rates.csv'), 56,
+                              grThresh=0.01, seed=1, cacheFn=cacheFn)
+        with open(cacheFn) as f:
+            self.assertTrue(set(json.load(f)).isdisjoint(cache))
+        shutil.rmtree(cacheDir)
+
+    def test_make_dashboard_datafile(self):
+        agg_df = read_agg('freyja/data/test_sweep.tsv')
+        meta_df = pd.read_csv('freyja/data/sweep_metadata.csv', index_col=0)
+        meta_df['sample_collection_datetime'] = \
+            pd.to_datetime(meta_df['sample_collection_datetime'])
+        lineage_info = load_lineage_info('freyja/data/lineages.yml')
+        outDir = tempfile.mkdtemp()
+        outputFn = os.path.join(outDir, 'dash.html')
+        dataFn = os.path.join(outDir, 'plot.json')
+        make_dashboard(agg_df, meta_df, 0.01, 'title', 'intro', outputFn,
+                       '#ffffff', '#ffffff', False, {}, lineage_info, 10,
+                       5.5, 56, 0.01, seed=1, dataFn=dataFn)
+        with open(dataFn) as f:
+            payload = json.load(f)
+        with open(outputFn) as f:
+            page = f.read()
+        self.assertIn('fetch("plot.json")', page)
+        self.assertIn('AY.48', page)
+        self.assertIn('cdn.plot.ly', page)
+        # every sample has a viral load, so all traces share one date axis
+        self.assertEqual(len(payload['x']), 1)
+        self.assertEqual(len(payload['xi']), len(payload['y']))
+        self.assertFalse(os.path.exists('div-plot.html'))
+        # plotly.js is only included for offline use
+        make_dashboard(agg_df, meta_df, 0.01, 'title', 'intro', outputFn,
+                       '#ffffff', '#ffffff', False, {}, lineage_info, 10,
+                       5.5, 56, 0.01, seed=1)
+        small = os.path.getsize(outputFn)
+        self.assertLess(small, 100000)
+        make_dashboard(agg_df, meta_df, 0.01, 'title', 'intro', outputFn,
+                       '#ffffff', '#ffffff', False, {}, lineage_info, 10,
+                       5.5, 56, 0.01, seed=1, offline=True)
+        self.assertGreater(os.path.getsize(outputFn), small + 1000000)
+        shutil.rmtree(outDir)
+
+    def test_make_site_dashboards(self):
+        agg_df = read_agg('freyja/data/test_sweep.tsv')
+        meta_df = pd.read_csv('freyja/data/sweep_metadata.csv', index_col=0)
+        meta_df['sample_collection_datetime'] = \
+            pd.to_datetime(meta_df['sample_collection_datetime'])
+        # South/East and South_East sanitize to the same file name
+        sites = ['North', 'South/East', 'South_East']
+        meta_df['site'] = [sites[k % 3] for k in range(meta_df.shape[0])]
+        lineage_info = load_lineage_info('freyja/data/lineages.yml')
+        outDir = tempfile.mkdtemp()
+        indexFn = make_site_dashboards(agg_df, meta_df, 'site', outDir, 0.01,
+                                       'A & B', 'intro', '#ffffff',
+                                       '#ffffff', False, {}, lineage_info,
+                                       10, 5.5, 56, 0.01, seed=1, n_jobs=2)
+        with open(indexFn) as f:
+            index = f.read()
+        for fn in ['North.html', 'South_East.html', 'South_East_2.html']:
+            self.assertIn(fn, index)
+            self.assertTrue(os.path.exists(os.path.join(outDir, fn)))
+        self.assertIn('<h1>A &amp; B</h1>', index)
+        shutil.rmtree(outDir)
+
+    def test_make_plots(self):
+        agg_df = drop_empty_samples(read_agg('freyja/data/test_sweep.tsv'))
+        times_df = pd.read_csv('freyja/data/sweep_metadata.csv', index_col=0)
+        times_df['sample_collection_datetime'] = \
+            pd.to_datetime(times_df['sample_collection_datetime'])
+        lineage_info = load_lineage_info('freyja/data/lineages.yml')
+        outDir = tempfile.mkdtemp()
+        plots = [(os.path.join(outDir, fn), interval, lineages)
+                 for fn, interval, lineages in [('lin_D.png', 'D', True),
+                                                ('lin_W.pdf', 'W', True),
+                                                ('sum_MS.png', 'MS', False)]]
+        make_plots(agg_df, plots, {}, lineage_info, times_df=times_df,
+                   n_jobs=2)
+        for fn, _, _ in plots:
+            self.assertGreater(os.path.getsize(fn), 0)
+        shutil.rmtree(outDir)
+
 
 if __name__ == '__main__':
     unittest.main()
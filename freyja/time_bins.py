@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+
+# Time binning shared by the plots, dashboard and growth rate estimates.
+# Bins are labelled the way pandas' resampling labels them: the day itself
+# for 'D', the closing Saturday of the epiweek for 'W' (epiweeks run Sunday
+# to Saturday) and the first of the month for 'MS'. An interval of None
+# groups on the exact timestamps.
+
+INTERVALS = ('D', 'W', 'MS')
+
+
+def bin_labels(dates, interval):
+    dates = pd.DatetimeIndex(dates)
+    if interval is None:
+        return dates
+    days = dates.values.astype('datetime64[D]')
+    if interval == 'D':
+        return pd.DatetimeIndex(days)
+    if interval == 'W':
+        # numpy day 0 (1970-01-01) was a thursday, so saturday is 2
+        toSat = (2 - days.astype(np.int64)) % 7
+        return pd.DatetimeIndex(days + toSat.astype('timedelta64[D]'))
+    if interval == 'MS':
+        return pd.DatetimeIndex(days.astype('datetime64[M]')
+                                .astype('datetime64[D]'))
+    raise ValueError('Unknown interval ' + str(interval) +
+                     ', use one of ' + ', '.join(INTERVALS))
+
+
+def bin_range(labels, interval):
+    # every bin from the first to the last label, including empty ones
+    freq = {'D': 'D', 'W': 'W-SAT', 'MS': 'MS'}[interval]
+    return pd.date_range(labels.min(), labels.max(), freq=freq)
+
+
+def epiweeks(labels):
+    # (year, week) of the epiweeks closing on the given saturdays. Week 1 is
+    # the first week with at least four days in the new year, so a week
+    # belongs to the year its wednesday falls in.
+    wed = pd.DatetimeIndex(labels) - pd.Timedelta(days=3)
+    return wed.year.to_numpy(), (wed.dayofyear.to_numpy() - 1) // 7 + 1
+
+
+def bin_means(df, interval=None, weights=None, fill=True):
+    # Mean of the rows of df in each bin, skipping missing values as pandas
+    # does. With weights (e.g. viral loads, one per row) the mean is
+    # weighted, rows without a weight are left out. With fill, empty bins
+    # between the first and last one are kept as missing rows.
+    labels = bin_labels(df.index, interval)
+    binIndex, inv = np.unique(labels.values, return_inverse=True)
+    vals = df.to_numpy(dtype=float)
+    w = np.ones(len(vals)) if weights is None \
+        else np.asarray(weights, dtype=float)
+    w = np.where(np.isnan(w), 0., w)[:, None] * ~np.isnan(vals)
+    sums = np.zeros((len(binIndex), vals.shape[1]))
+    norm = np.zeros((len(binIndex), vals.shape[1]))
+    np.add.at(sums, inv, np.where(np.isnan(vals), 0., vals) * w)
+    np.add.at(norm, inv, w)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / norm
+    out = pd.DataFrame(means, index=pd.DatetimeIndex(binIndex),
+                       columns=df.columns)
+    if fill and interval is not None and out.shape[0] > 0:
+        out = out.reindex(bin_range(out.index, interval))
+    return out
+
+
+def rolling_mean(df, windowSize):
+    # centered moving average, ignoring empty bins
+    return df.rolling(windowSize, center=True, min_periods=0).mean()
+
+
+class TimeBins:
+    # Binned views of one dataset, computed once per (interval, window) so
+    # several outputs can share them.
+
+    def __init__(self, df, weights=None):
+        self.df = df
+        self.weights = weights
+        self._cache = {}
+
+    def get(self, interval, windowSize=None):
+        key = (interval, windowSize)
+        if key not in self._cache:
+            if windowSize is None:
+                self._cache[key] = bin_means(self.df, interval,
+                                             weights=self.weights)
+            else:
+                self._cache[key] = rolling_mean(self.get(interval),
+                                                windowSize)
+        return self._cache[key]
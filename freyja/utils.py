@@ -1,27 +1,235 @@
-import copy
+import csv
+import hashlib
+import html
+import json
 import os
 import re
+from itertools import chain
 import tqdm
 
-import matplotlib.dates as mdates
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
 from datetime import datetime
 import yaml
-from scipy.optimize import curve_fit
+from joblib import Parallel, delayed
 
+from freyja.time_bins import INTERVALS, TimeBins, bin_means, epiweeks
 
-def agg(results):
-    allResults = [pd.read_csv(fn, skipinitialspace=True, sep='\t',
-                              index_col=0) for fn in results]
-    df_demix = pd.concat(allResults, axis=1).T
-    df_demix.index = [x.split('/')[-1] for x in df_demix.index]
+
+def read_demix_output(fn):
+    if is_structured(fn):
+        with open(fn) as f:
+            values = json.loads(f.readline())
+        return values.pop('sample'), values
+    # demix outputs are small two-column tables with a fixed layout, so
+    # skip the full pandas parser and read the fields directly
+    with open(fn, newline='') as f:
+        rows = [row for row in csv.reader(f, delimiter='\t',
+                                          skipinitialspace=True)
+                if len(row) > 0]
+    values = {row[0]: (row[1] if len(row) > 1 and len(row[1]) > 0
+                       else np.nan) for row in rows[1:]}
+    return rows[0][1], values
+
+
+def is_structured(fn):
+    # structured (JSON lines) outputs start with a json object
+    with open(fn) as f:
+        return f.read(1) == '{'
+
+
+def _strip_brackets(x):
+    return x.replace("'", "")\
+            .replace("]", "")\
+            .replace("[", "")\
+            .replace(")", "")\
+            .replace("(", "")\
+            .replace("\n", "")
+
+
+def parse_lineages(x):
+    x = _strip_brackets(x)
+    if len(x) == 0:
+        return []
+    return re.sub(' +', ' ', x).split(' ')
+
+
+def parse_abundances(x):
+    return [float(ab) for ab in parse_lineages(x)]
+
+
+def parse_summarized(x):
+    x = _strip_brackets(x).split(', ')
+    if len(x) <= 1:
+        return {}
+    return {k: float(v) for k, v in zip(x[0::2], x[1::2])}
+
+
+PARSERS = {'lineages': parse_lineages,
+           'abundances': parse_abundances,
+           'summarized': parse_summarized}
+
+
+# numeric fields, read as strings from the demix outputs
+NUMERIC_COLS = ('resid', 'coverage')
+
+
+def _numeric_agg(agg_df):
+    for col in NUMERIC_COLS:
+        if col in agg_df.columns:
+            agg_df[col] = pd.to_numeric(agg_df[col], errors='coerce')
+    return agg_df
+
+
+def structure_agg(agg_df, cols=('summarized', 'lineages', 'abundances')):
+    # convert stringified demix fields into lists/dicts, leaving any
+    # already structured values untouched
+    for col in cols:
+        agg_df[col] = [PARSERS[col](x) if isinstance(x, str) else x
+                       for x in agg_df[col]]
+    return agg_df
+
+
+def stringify_agg(agg_df):
+    # inverse of structure_agg, matching the demix tsv layout
+    agg_df['summarized'] = [str(list(x.items())) if isinstance(x, dict)
+                            else x for x in agg_df['summarized']]
+    agg_df['lineages'] = [' '.join(x) if isinstance(x, list) else x
+                          for x in agg_df['lineages']]
+    agg_df['abundances'] = [' '.join(['%.8f' % ab for ab in x])
+                            if isinstance(x, list) else x
+                            for x in agg_df['abundances']]
+    return agg_df
+
+
+def read_agg(agg_results):
+    if is_structured(agg_results):
+        with open(agg_results) as f:
+            records = [json.loads(line) for line in f if len(line.strip())]
+        agg_df = pd.DataFrame.from_records(records, index='sample')
+        agg_df.index.name = None
+        return _numeric_agg(agg_df)
+    agg_df = pd.read_csv(agg_results, skipinitialspace=True, sep='\t',
+                         index_col=0)
+    agg_df['abundances'] = agg_df['abundances'].astype(str)
+    agg_df['summarized'] = agg_df['summarized'].astype(str)
+    return agg_df
+
+
+def write_agg(agg_df, output, outformat='tsv', mode='w'):
+    if outformat == 'jsonl':
+        agg_df = _numeric_agg(structure_agg(agg_df.copy()))
+        with open(output, mode) as f:
+            for sample, row in zip(agg_df.index, agg_df.to_dict('records')):
+                record = {'sample': sample}
+                record.update({k: (None if isinstance(v, float) and
+                                   np.isnan(v) else v)
+                               for k, v in row.items()})
+                f.write(json.dumps(record) + '\n')
+    else:
+        stringify_agg(agg_df.copy()).to_csv(output, sep='\t', mode=mode,
+                                            header=(mode == 'w'))
+
+
+def drop_empty_samples(agg_df):
+    # drop samples with no lineages identified
+    return agg_df[[len(x) > 0 if not isinstance(x, str) else x != '[]'
+                   for x in agg_df['summarized']]]
+
+
+def agg(results, n_jobs=1):
+    allResults = Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(read_demix_output)(fn) for fn in results)
+    # union of fields, in order of first appearance
+    cols = list(dict.fromkeys(k for _, vals in allResults for k in vals))
+    df_demix = pd.DataFrame([[vals.get(c, np.nan) for c in cols]
+                             for _, vals in allResults],
+                            index=[name.split('/')[-1]
+                                   for name, _ in allResults],
+                            columns=cols, dtype=object)
     return df_demix
 
 
+# provenance columns recorded by incremental aggregation
+STORE_COLS = ['result_file', 'result_size', 'result_mtime']
+
+
+def agg_incremental(results, store, n_jobs=1, outformat='tsv'):
+    # Update an aggregated store in place, parsing only the result files
+    # that are new or have changed (by size/mtime) since the last update.
+    # Rows are keyed on the result file's path relative to the store, so
+    # samples of the same name from different subdirectories are kept apart,
+    # and rows whose result file is no longer listed are dropped.
+    storeDir = os.path.dirname(os.path.abspath(store))
+
+    def key(fn):
+        # relative paths recorded in the store start from its directory,
+        # absolute ones are from stores written before keys were relative
+        return os.path.relpath(os.path.join(storeDir, fn), storeDir)
+
+    stats = {}
+    files = {}
+    for fn in results:
+        st = os.stat(fn)
+        k = key(os.path.abspath(fn))
+        stats[k] = (str(st.st_size), str(st.st_mtime_ns))
+        files[k] = fn
+    df_store = None
+    known = {}
+    stale = np.zeros(0, dtype=bool)
+    if os.path.exists(store):
+        if is_structured(store):
+            outformat = 'jsonl'
+            df_store = read_agg(store)
+        else:
+            outformat = 'tsv'
+            df_store = pd.read_csv(store, sep='\t', index_col=0, dtype=str,
+                                   keep_default_na=False)
+        if all(c in df_store.columns for c in STORE_COLS):
+            df_store['result_file'] = [key(fn) if isinstance(fn, str) and
+                                       len(fn) > 0 else fn
+                                       for fn in df_store['result_file']]
+            known = {fn: (size, mtime) for fn, size, mtime
+                     in df_store[STORE_COLS].itertuples(index=False)}
+            # files deleted or renamed since the last update (rows carried
+            # over from a plain aggregate have no file to check)
+            recorded = df_store['result_file'].map(
+                lambda fn: isinstance(fn, str) and len(fn) > 0)
+            stale = (recorded & ~df_store['result_file'].isin(list(stats))
+                     ).to_numpy()
+    todo = [k for k in stats if known.get(k) != stats[k]]
+    if len(todo) == 0 and not stale.any():
+        return df_store, 0
+    if stale.any():
+        df_store = df_store[~stale]
+    if len(todo) > 0:
+        df_new = agg([files[k] for k in todo], n_jobs=n_jobs)
+        df_new['result_file'] = todo
+        df_new['result_size'] = [stats[k][0] for k in todo]
+        df_new['result_mtime'] = [stats[k][1] for k in todo]
+    if df_store is None:
+        df_store = df_new
+    elif len(todo) > 0:
+        if 'result_file' in df_store.columns:
+            replaced = df_store['result_file'].isin(todo).to_numpy()
+        else:
+            # rows of a plain aggregate, matched on sample names
+            replaced = df_store.index.isin(df_new.index)
+        newCols = [c for c in df_new.columns if c not in df_store.columns]
+        if not (replaced.any() or stale.any()) and len(newCols) == 0:
+            # only new samples, so append rows instead of rewriting
+            df_new = df_new.reindex(columns=df_store.columns)
+            write_agg(df_new, store, outformat, mode='a')
+            return pd.concat([df_store, df_new]), len(todo)
+        df_store = pd.concat([df_store[~replaced], df_new])
+    cols = [c for c in df_store.columns if c not in STORE_COLS] + STORE_COLS
+    df_store = df_store[cols]
+    tmp = store + '.tmp'
+    write_agg(df_store, tmp, outformat)
+    os.replace(tmp, store)
+    return df_store, len(todo)
+
+
 # Check the format of the config file and correct if necessary.
 def checkConfig(config):
     """
@@ -47,10 +255,222 @@ def logistic_growth(ndays, b, r):
     return 1 / (1 + (b * np.exp(-1 * r * ndays)))
 
 
+def _fit_sigmoid(X, offset, data, p, lo, hi, maxiter=500, tol=1e-12):
+    # Batched Levenberg-Marquardt fit of data ~ 1/(1 + exp(-(X @ p + offset)))
+    # with p kept within [lo, hi], one least squares problem per row.
+    k = p.shape[1]
+    eye = np.eye(k)
+
+    def model(idx, p):
+        z = np.einsum('ntk,nk->nt', X[idx], p) + offset[idx]
+        return 0.5 * (1 + np.tanh(0.5 * z))
+
+    f = model(slice(None), p)
+    cost = ((f - data) ** 2).sum(axis=1)
+    lam = np.full(p.shape[0], 1e-2)
+    active = np.arange(p.shape[0])
+    for _ in range(maxiter):
+        if len(active) == 0:
+            break
+        fa, ea = f[active], f[active] - data[active]
+        J = X[active] * (fa * (1 - fa))[:, :, None]
+        g = np.einsum('ntk,nt->nk', J, ea)
+        H = np.einsum('ntk,ntl->nkl', J, J)
+        pa, la, ha = p[active], lo[active], hi[active]
+        # parameters pushed against a bound stay there
+        fixed = ((pa <= la) & (g > 0)) | ((pa >= ha) & (g < 0))
+        g = np.where(fixed, 0., g)
+        H = np.where(fixed[:, :, None] | fixed[:, None, :], 0., H)
+        diag = np.diagonal(H, axis1=1, axis2=2)
+        H = H + eye * (lam[active, None] * diag + 1e-12 + fixed)[:, :, None]
+        pNew = np.clip(pa - np.linalg.solve(H, g[:, :, None])[:, :, 0],
+                       la, ha)
+        fNew = model(active, pNew)
+        costNew = ((fNew - data[active]) ** 2).sum(axis=1)
+        better = costNew < cost[active]
+        converged = (better & (cost[active] - costNew <=
+                               tol * (cost[active] + tol))) | \
+            (lam[active] > 1e10)
+        upd = active[better]
+        p[upd], f[upd], cost[upd] = pNew[better], fNew[better], \
+            costNew[better]
+        lam[active] = np.where(better, lam[active] / 3, lam[active] * 10)
+        active = active[~converged]
+    return p, cost
+
+
+def fit_logistic_growth(days, data, p0=(100, 0.1),
+                        bounds=([0, -10], [1000, 10])):
+    # Least squares fits of logistic_growth to each row of data (days may
+    # differ by row, as for bootstrap resamples), all solved together.
+    # The rate is fit jointly with the intercept of the centred days,
+    # which decouples the two, starting from p0 and from a line through
+    # the logit of the data. The best fits on the faces of the bounds are
+    # also computed and the lowest in-bounds residual wins.
+    data = np.atleast_2d(np.asarray(data, dtype=float))
+    days = np.broadcast_to(np.asarray(days, dtype=float), data.shape)
+    n = data.shape[0]
+    (bLo, rLo), (bHi, rHi) = bounds
+    inf = np.full((n, 1), np.inf)
+    tm = days.mean(axis=1)
+    s = days - tm[:, None]
+    ones = np.ones_like(days)
+    fits = []
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        logBLo, logBHi = np.log(bLo), np.log(bHi)
+        yc = np.clip(data, 1e-3, 1 - 1e-3)
+        y = np.log(yc / (1 - yc))
+        rLin = (y * s).sum(axis=1) / np.maximum((s * s).sum(axis=1), 1e-12)
+        # log b = r * tm - c
+        for p in [np.column_stack([p0[1] * tm - np.log(p0[0]),
+                                   np.full(n, p0[1])]),
+                  np.column_stack([y.mean(axis=1), rLin])]:
+            p, cost = _fit_sigmoid(np.stack([ones, s], axis=2), 0. * s, data,
+                                   p, np.hstack([-inf, -inf]),
+                                   np.hstack([inf, inf]))
+            logb = p[:, 1] * tm - p[:, 0]
+            ok = (logb >= logBLo) & (logb <= logBHi) & (p[:, 1] >= rLo) & \
+                (p[:, 1] <= rHi)
+            fits.append((np.where(ok, cost, np.inf), logb, p[:, 1]))
+        for logB in [logBLo, logBHi]:
+            if np.isfinite(logB):
+                p, cost = _fit_sigmoid(days[:, :, None],
+                                       np.full_like(s, -logB), data,
+                                       np.full((n, 1), np.clip(p0[1], rLo,
+                                                               rHi)),
+                                       np.full((n, 1), rLo),
+                                       np.full((n, 1), rHi))
+                fits.append((cost, np.full(n, logB), p[:, 0]))
+        for r in [rLo, rHi]:
+            cLo, cHi = (r * tm - logBHi)[:, None], (r * tm - logBLo)[:, None]
+            p, cost = _fit_sigmoid(ones[:, :, None], r * s, data,
+                                   np.clip((r * tm - np.log(p0[0]))[:, None],
+                                           cLo, cHi), cLo, cHi)
+            fits.append((cost, r * tm - p[:, 0], np.full(n, r)))
+    costs = np.column_stack([fit[0] for fit in fits])
+    best = np.argmin(np.where(np.isnan(costs), np.inf, costs), axis=1)
+    rows = np.arange(n)
+    logb = np.column_stack([fit[1] for fit in fits])[rows, best]
+    r = np.column_stack([fit[2] for fit in fits])[rows, best]
+    return np.column_stack([np.exp(logb), r])
+
+
+def fit_multinomial_growth(days, data, ref=0, maxiter=100, tol=1e-10):
+    # Fits p_k(t) = softmax(a_k + r_k*t) to the (days x lineages) prevalence
+    # matrix by Newton's method on the multinomial quasi-likelihood, with
+    # the reference lineage's coefficients fixed at zero. Returns the rates
+    # relative to the reference and their standard errors, from the observed
+    # information scaled by the Pearson dispersion.
+    data = np.asarray(data, dtype=float)
+    nDays, nLin = data.shape
+    X = np.column_stack([np.ones(nDays), days - np.mean(days)])
+    others = np.array([k for k in range(nLin) if k != ref])
+    nPar = 2 * len(others)
+    tot = data.sum(axis=1)
+    theta = np.zeros((nLin, 2))
+
+    def probs(theta):
+        z = X @ theta.T
+        z -= z.max(axis=1, keepdims=True)
+        ez = np.exp(z)
+        return ez / ez.sum(axis=1, keepdims=True)
+
+    def loglik(p):
+        return np.sum(data * np.log(np.maximum(p, 1e-300)))
+
+    def information(p):
+        w = p[:, others] * tot[:, None]
+        W = np.einsum('tk,kl->tkl', w, np.eye(len(others))) -\
+            np.einsum('tk,tl->tkl', w, p[:, others])
+        return np.einsum('tkl,td,te->kdle', W, X, X).reshape(nPar, nPar)
+
+    p = probs(theta)
+    ll = loglik(p)
+    for _ in range(maxiter):
+        grad = ((data - tot[:, None] * p)[:, others].T @ X).ravel()
+        # small ridge keeps lineages absent from part of the window finite
+        info = information(p) + 1e-8 * np.eye(nPar)
+        step = np.linalg.solve(info, grad).reshape(len(others), 2)
+        t = 1.
+        while t > 1e-8:
+            trial = theta.copy()
+            trial[others] += t * step
+            pTrial = probs(trial)
+            llTrial = loglik(pTrial)
+            if llTrial >= ll:
+                break
+            t /= 2
+        else:
+            break
+        theta, p, llOld, ll = trial, pTrial, ll, llTrial
+        if abs(ll - llOld) <= tol * (1 + abs(ll)):
+            break
+    resDf = nDays * (nLin - 1) - nPar
+    expected = np.maximum(tot[:, None] * p, 1e-12)
+    phi = np.sum((data - expected)**2 / expected) / resDf if resDf > 0 \
+        else 1.
+    cov = phi * np.linalg.pinv(information(p))
+    se = np.zeros(nLin)
+    se[others] = np.sqrt(np.maximum(np.diag(cov)[1::2], 0))
+    return theta[:, 1], se
+
+
+def _bootstrap_growth(days, data, nboots, seedSeq):
+    # build 95% CI by bootstrapping, all resamples fit at once along with
+    # the data itself
+    rng = np.random.default_rng(seedSeq)
+    bootInds = rng.integers(0, len(days), (nboots, len(days)))
+    fits = fit_logistic_growth(np.vstack([days, days[bootInds]]),
+                               np.vstack([data, data[bootInds]]))
+    return (fits[0, 1], np.percentile(fits[1:, 1], 2.5),
+            np.percentile(fits[1:, 1], 97.5))
+
+
+def fit_growth_tasks(tasks, nboots, seed=None, n_jobs=1, seeds=None):
+    # Fits a list of (days, data) series, returning the growth rate and its
+    # bootstrap interval for each. Every task draws from its own stream
+    # spawned off the seed, so results don't depend on the number of
+    # workers.
+    if seeds is None:
+        seeds = np.random.SeedSequence(seed).spawn(len(tasks))
+    return Parallel(n_jobs=n_jobs)(
+        delayed(_bootstrap_growth)(days, data, nboots, seedSeq)
+        for (days, data), seedSeq in tqdm.tqdm(
+            zip(tasks, seeds), total=len(tasks),
+            desc='Rate calculations for lineages/groups'))
+
+
+def growth_cache_key(lineage, days, data, params):
+    # a lineage's fit is reused while its windowed series (to 1e-6) and the
+    # fitting parameters are unchanged
+    h = hashlib.sha1(json.dumps([lineage, [str(p) for p in params]])
+                     .encode())
+    h.update(np.ascontiguousarray(days, dtype=np.int64).tobytes())
+    h.update(np.ascontiguousarray(np.round(data, 6),
+                                  dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def load_growth_cache(fn):
+    if not os.path.exists(fn):
+        return {}
+    with open(fn) as f:
+        return json.load(f)
+
+
+def write_growth_cache(fn, cache):
+    # write then rename, so an interrupted run leaves the old cache intact
+    tmp = fn + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp, fn)
+
+
 # Calcualate the relative growth rates of the lineages and return a dataFrame.
 def calc_rel_growth_rates(df, nboots=1000, serial_interval=5.5,
                           outputFn='rel_growth_rates.csv', daysIncluded=56,
-                          grThresh=0.05):
+                          grThresh=0.05, method='logistic', seed=None,
+                          n_jobs=1, cacheFn=None):
     df.index.name = 'Date'
     df.reset_index(inplace=True)
     df['Date'] = pd.to_datetime(df['Date'])
@@ -66,71 +486,166 @@ def calc_rel_growth_rates(df, nboots=1000, serial_interval=5.5,
     # go as far back as we can, within daysIncluded limit
     nBack = next((x[0] + 1 for x in enumerate(df.index[::-1])
                  if (df.index[-1] - x[1]).days > daysIncluded), 0)
+    # get all lineages present at >0.1% average over last 8 weeks
+    lineages = df.columns[df.iloc[-nBack:].mean(axis=0) > 0.001]
+    days = np.array([(dfi - df.index[-nBack]).days
+                     for j, dfi in enumerate(df.index[-nBack:])])
+    # same columns whatever the method, so the csv and dash table keep
+    # their layout
+    interval = 'Bootstrap 95% interval'
     rel_growth_rate = {
         'Lineage': [],
         'Estimated Advantage': [],
-        'Bootstrap 95% interval': [],
+        interval: [],
     }
-    # get all lineages present at >0.1% average over last 8 weeks
-    lineages = df.columns[df.iloc[-nBack:].mean(axis=0) > 0.001]
-    rate_cal = tqdm.tqdm(enumerate(lineages), total=len(lineages),
-                         desc='Rate calculations for lineages/groups')
-    for k, lineage in rate_cal:
-        # print(f"\nCalculating relative rate for {lineage}")
-        rate_cal.set_postfix({"Calculating relative rate for": lineage})
-        days = np.array([(dfi - df.index[-nBack]).days
-                         for j, dfi in enumerate(df.index[-nBack:])])
-        data = df[lineage][-len(days):]
-        fit, covar = curve_fit(
-            f=logistic_growth,
-            xdata=days,
-            ydata=data,
-            p0=[100, 0.1],
-            bounds=([0, -10], [1000, 10])
-        )
-        # build 95% CI by bootstrapping.
-        bootSims = []
-        coef_ests = []
-        for j in range(nboots):
-            bootInds = np.random.randint(0, len(days), len(days))
-            daysBoot = days[bootInds]
-            dataBoot = data[bootInds]
-            try:
-                fitBoot, covarBoot = curve_fit(
-                    f=logistic_growth,
-                    xdata=daysBoot,
-                    ydata=dataBoot,
-                    p0=[100, 0.1],
-                    bounds=([0, -10], [1000, 10])
-                )
-            except RuntimeError:
-                print('WARNING: Optimal parameters not found: The maximum' +
-                      ' number of function evaluations is exceeded.')
-
-            bootSims.append([logistic_growth(i, *fitBoot) for i in days])
-            coef_ests.append(fitBoot[1])
-
-        bootSims = np.array(bootSims)
-
-        coef_lower = np.percentile(coef_ests, 2.5)
-        coef_upper = np.percentile(coef_ests, 97.5)
-
-        rate0 = fit[1]
-
-        trans_increase = serial_interval * rate0
-        rel_growth_rate['Lineage'].append(lineage)
-        rel_growth_rate['Estimated Advantage'].append(f'{trans_increase:.1%}')
-        rel_growth_rate['Bootstrap 95% interval'].append(
-            f'[{serial_interval*coef_lower:0.2%} ' +
-            f', {serial_interval*coef_upper:0.2%}]')
+    if method == 'multinomial':
+        window = df[lineages].iloc[-len(days):]
+        # growth is relative to the most prevalent lineage in the window
+        ref = int(np.argmax(window.mean(axis=0).to_numpy()))
+        data = window.to_numpy()
+        rest = np.clip(1. - data.sum(axis=1), 0, None)
+        if rest.max() > 1e-6:
+            # whatever isn't retained is its own (unreported) category
+            data = np.column_stack([data, rest])
+        print(f'Fitting multinomial growth model for {len(lineages)} '
+              f'lineages/groups, relative to {lineages[ref]}')
+        rates, se = fit_multinomial_growth(days, data, ref=ref)
+        for k, lineage in enumerate(lineages):
+            rel_growth_rate['Lineage'].append(lineage)
+            rel_growth_rate['Estimated Advantage'].append(
+                f'{serial_interval*rates[k]:.1%}')
+            if k == ref:
+                rel_growth_rate[interval].append('reference')
+                continue
+            rel_growth_rate[interval].append(
+                f'[{serial_interval*(rates[k] - 1.96*se[k]):0.2%} ' +
+                f', {serial_interval*(rates[k] + 1.96*se[k]):0.2%}]')
+    else:
+        tasks = [(days, df[lineage][-len(days):].to_numpy())
+                 for lineage in lineages]
+        params = (nboots, serial_interval, daysIncluded, grThresh, seed)
+        keys = [growth_cache_key(lineage, days, data, params)
+                for lineage, (days, data) in zip(lineages, tasks)]
+        cache = load_growth_cache(cacheFn) if cacheFn is not None else {}
+        todo = [k for k, key in enumerate(keys) if key not in cache]
+        if cacheFn is not None:
+            print(f'Reusing cached growth rates for '
+                  f'{len(keys) - len(todo)} of {len(keys)} lineages/groups')
+        # streams are spawned for every lineage, so a partly cached run
+        # fits the rest exactly as a fresh run would
+        seeds = np.random.SeedSequence(seed).spawn(len(tasks))
+        fitted = fit_growth_tasks([tasks[k] for k in todo], nboots,
+                                  n_jobs=n_jobs,
+                                  seeds=[seeds[k] for k in todo])
+        for k, fit in zip(todo, fitted):
+            cache[keys[k]] = [float(x) for x in fit]
+        fits = [cache[key] for key in keys]
+        if cacheFn is not None:
+            write_growth_cache(cacheFn, {key: cache[key] for key in keys})
+        for lineage, (rate0, coef_lower, coef_upper) in zip(lineages, fits):
+            trans_increase = serial_interval * rate0
+            rel_growth_rate['Lineage'].append(lineage)
+            rel_growth_rate['Estimated Advantage'].append(
+                f'{trans_increase:.1%}')
+            rel_growth_rate[interval].append(
+                f'[{serial_interval*coef_lower:0.2%} ' +
+                f', {serial_interval*coef_upper:0.2%}]')
     if outputFn.endswith('.html'):
         outputFn = outputFn.replace('.html', '_rel_growth_rates.csv')
-    pd.DataFrame.from_dict(
+    growth_df = pd.DataFrame.from_dict(
         rel_growth_rate,
         orient='columns').sort_values(
             by='Estimated Advantage',
-            ascending=False).to_csv(outputFn, index=False)
+            ascending=False)
+    growth_df.to_csv(outputFn, index=False)
     print("CSV file saved to " + outputFn)
+    return growth_df
+
+
+def read_lineages_yml(fn):
+    # use the C loader where libyaml is available
+    with open(fn, 'r') as f:
+        try:
+            return yaml.load(f, Loader=getattr(yaml, 'CSafeLoader',
+                                               yaml.SafeLoader))
+        except yaml.YAMLError as exc:
+            raise ValueError('lineages.yml error, run update: ' + str(exc))
+
+
+def _file_hash(fn):
+    with open(fn, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def compile_lineage_index(lineages_yml, source=None):
+    # Compiles the lineage hierarchy into integer ids, keeping the children
+    # lists of lineages.yml along with the ancestor/descendant closure of
+    # the parent links.
+    names = [lineage['name'] for lineage in lineages_yml]
+    ids = {name: i for i, name in enumerate(names)}
+    for lineage in lineages_yml:
+        for child in lineage['children']:
+            if child not in ids:
+                ids[child] = len(names)
+                names.append(child)
+    parent = [ids.get(lineage.get('parent'), -1)
+              for lineage in lineages_yml]
+    parent += [-1] * (len(names) - len(parent))
+    children = [[ids[child] for child in lineage['children']]
+                for lineage in lineages_yml]
+    children += [[] for _ in range(len(names) - len(children))]
+    ancestors = []
+    for i in range(len(names)):
+        anc = []
+        j = parent[i]
+        while j >= 0 and j != i and j not in anc:
+            anc.append(j)
+            j = parent[j]
+        ancestors.append(anc)
+    descendants = [[] for _ in names]
+    for i, anc in enumerate(ancestors):
+        for j in anc:
+            descendants[j].append(i)
+    return {'source': source, 'names': names, 'parent': parent,
+            'children': children, 'ancestors': ancestors,
+            'descendants': descendants}
+
+
+def lineage_index_path(ymlFn):
+    # lineages.yml -> lineages_index.json, next to it
+    return os.path.splitext(ymlFn)[0] + '_index.json'
+
+
+def write_lineage_index(ymlFn):
+    index = compile_lineage_index(read_lineages_yml(ymlFn),
+                                  source=_file_hash(ymlFn))
+    fn = lineage_index_path(ymlFn)
+    with open(fn, 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+    return fn
+
+
+def load_lineage_index(ymlFn):
+    # the compiled index is used while it matches the yml, otherwise the
+    # yml is parsed again
+    fn = lineage_index_path(ymlFn)
+    source = _file_hash(ymlFn)
+    if os.path.exists(fn):
+        with open(fn) as f:
+            index = json.load(f)
+        if index.get('source') == source:
+            return index
+    return compile_lineage_index(read_lineages_yml(ymlFn), source=source)
+
+
+def load_lineage_info(ymlFn):
+    # converts the lineage index to a dictionary where the lineage names
+    # are the keys.
+    index = load_lineage_index(ymlFn)
+    names = index['names']
+    return {name: {'name': name,
+                   'children': [names[j] for j in index['children'][i]]}
+            for i, name in enumerate(names)}
 
 
 # Get value from the config dictionary.
@@ -177,167 +692,229 @@ def get_color_scheme(df, default_color_scheme, config=None):
     return color_scheme
 
 
-def prepLineageDict(agg_d0, thresh=0.001, config=None, lineage_info=None):
-    agg_d0.loc[:, 'lineages'] = agg_d0['lineages']\
-          .apply(lambda x:
-                 x.replace("'", "")
-                  .replace("]", "")
-                  .replace("[", "")
-                  .replace(")", "")
-                  .replace("(", "")
-                  .replace("\n", "")).copy()
-    agg_d0 = agg_d0[agg_d0['lineages'].apply(lambda x: len(x) > 0)].copy()
-    agg_d0.loc[:, 'lineages'] = agg_d0['lineages'].apply(lambda x:
-                                                         re.sub(' +', ' ', x)
-                                                           .split(' ')).copy()
-    agg_d0.loc[:, 'abundances'] = agg_d0['abundances']\
-          .apply(lambda x:
-                 x.replace("'", "")
-                  .replace("]", "")
-                  .replace("[", "")
-                  .replace(")", "")
-                  .replace("(", "")
-                  .replace("\n", "")).copy()
-    agg_d0.loc[:, 'abundances'] = agg_d0['abundances']\
-          .apply(lambda x:
-                 re.sub(' +', ' ', x)
-                   .split(' ')).copy()
-    # print([float(abund) for abund in agg_d0.iloc[0].loc['abundances']])
-    agg_d0.loc[:, 'linDict'] = [{lin: float(abund) for lin, abund in
-                                zip(agg_d0.loc[samp, 'lineages'],
-                                    agg_d0.loc[samp, 'abundances'])}
-                                for samp in agg_d0.index]
-
-    # get most common lineages in our dataset
-    from collections import Counter
-    counter_summary = Counter()
-    for line in agg_d0.index:
-        counter_summary += Counter(agg_d0.loc[line, 'linDict'])
+# Aggregated results are held as a long table with one row per sample and
+# lineage: categorical sample/lineage codes and float32 abundances. Rows of
+# a sample stay in the order they were reported, which sets the stacking
+# and color order of the plots.
+def to_long(samples, names, values):
+    samples = pd.Index(samples)
+    if samples.has_duplicates:
+        dups = list(samples[samples.duplicated()].unique())
+        raise ValueError('the aggregated results list some samples more '
+                         'than once (e.g. the same file name from different '
+                         'directories): ' + ', '.join(map(str, dups[:10])))
+    counts = np.fromiter((len(n) for n in names), dtype=np.int64,
+                         count=len(samples))
+    codes = np.repeat(np.arange(len(samples)), counts)
+    return pd.DataFrame({
+        'sample': pd.Categorical.from_codes(codes, categories=samples),
+        'lineage': pd.Categorical(list(chain.from_iterable(names))),
+        'abundance': np.fromiter(chain.from_iterable(values),
+                                 dtype=np.float32, count=counts.sum())})
+
+
+def lineage_long(agg_df):
+    agg_df = structure_agg(agg_df[['lineages', 'abundances']].copy(),
+                           cols=('lineages', 'abundances'))
+    agg_df = agg_df[agg_df['lineages'].apply(len) > 0]
+    return to_long(agg_df.index, agg_df['lineages'], agg_df['abundances'])
+
+
+def summary_long(agg_df):
+    agg_df = structure_agg(agg_df[['summarized']].copy(),
+                           cols=('summarized',))
+    # drop any samples with NO lineages identified from analysis
+    agg_df = agg_df[agg_df['summarized'].apply(len) > 0]
+    return to_long(agg_df.index, [d.keys() for d in agg_df['summarized']],
+                   [d.values() for d in agg_df['summarized']])
+
+
+def compile_lineage_groups(config, lineage_info=None):
+    # Maps each config member to the name of its group, with '*' members
+    # expanded through their children. When groups overlap, the first
+    # one in the config wins, as with get_name.
+    groups = {}
+    for val in config.values():
+        for lin in val['members']:
+            groups.setdefault(lin, val['name'])
+            if '*' in lin:
+                for child in lineage_info[lin.replace('*', '')]['children']:
+                    groups.setdefault(child, val['name'])
+    return groups
+
+
+def _sum_entries(rows, cols, vals, order):
+    # sum matrix entries that share a cell, each cell keeping the smallest
+    # order of its entries, then sort cells by sample and order
+    key = rows.astype(np.int64) * (cols.max() + 1) + cols
+    idx = np.lexsort((order, key))
+    key = key[idx]
+    starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+    rows, cols = rows[idx][starts], cols[idx][starts]
+    vals = np.add.reduceat(vals[idx], starts)
+    order = order[idx][starts]
+    idx = np.lexsort((order, rows))
+    return rows[idx], cols[idx], vals[idx], order[idx]
+
+
+def group_lineage_long(long_df, thresh=0.001, config=None,
+                       lineage_info=None):
+    # Grouping and thresholding work on the nonzero entries of the sample x
+    # lineage matrix: config groups remap its columns and small entries are
+    # moved to an "Other" column, summing entries that land on one cell.
+    if long_df.shape[0] == 0:
+        return long_df
+    nSamples = len(long_df['sample'].cat.categories)
+    names = list(long_df['lineage'].cat.categories)
+    rows = long_df['sample'].cat.codes.to_numpy()
+    cols = long_df['lineage'].cat.codes.to_numpy().astype(np.int64)
+    vals = long_df['abundance'].to_numpy(dtype=float)
+    # rows are grouped by sample, so the row number orders a sample's
+    # lineages. Groups and "Other" come after the lineages kept as is.
+    order = np.arange(len(rows))
+    offset = len(rows) + 1
+    totals = np.bincount(cols, weights=vals, minlength=len(names))
+    totals = totals[np.bincount(cols, minlength=len(names)) > 0]
 
     # Aggregate the lineages specified in config file into a single
     # key/value pair.
     if config is not None:
-        # Returns the first name where the queried lineage is present in the
-        # config memebers.
-        for i, i_config in config.items():
-            for lin in i_config['members']:
-                if '*' in lin:
-                    config[i]['members'].extend(lineage_info
-                                                [lin.replace('*', '')]
-                                                ['children']
-                                                )
-        # aggregate all the members into 1ist
-        config_members = [lin for val in config.values() for lin in val[
-                          'members']]
-        # Aggregate lineages into a single dict key/value pair
-        processed_linDictMod = []
-        for j, sampLabel in enumerate(agg_d0.index):
-            # This list will contain the keys that have been created
-            # in the dict. This is used to ensure that the same key is
-            # not created twice or that value of the key is doubled.
-            created_keys = []
-            linDictMod = copy.deepcopy(agg_d0.loc[sampLabel, 'linDict'])
-            linDictModCopy = copy.deepcopy(
-                agg_d0.loc[sampLabel, 'linDict'])
-            for rInd in linDictModCopy.keys():
-                if rInd in config_members:
-                    if get_name(rInd, config) in created_keys:
-                        linDictMod[
-                            get_name(rInd, config)
-                            ] += linDictMod.pop(rInd)
-                    else:
-                        linDictMod[
-                            get_name(rInd, config)
-                            ] = linDictMod.pop(rInd)
-                        created_keys.append(get_name(rInd, config))
-            processed_linDictMod.append(linDictMod)
-        agg_d0.loc[:, 'linDict'] = processed_linDictMod
+        groups = compile_lineage_groups(config, lineage_info)
+        colMap, names = pd.factorize(pd.Index([groups.get(lin, lin)
+                                               for lin in names]))
+        names = list(names)
+        isMember = long_df['lineage'].isin(list(groups)).to_numpy()
+        rows, cols, vals, order = _sum_entries(
+            rows, colMap[cols], vals,
+            np.where(isMember, order + offset, order))
 
     # possibly switch to a max number of lineages
-    keepers = [x[0] for x in counter_summary.most_common()
-               if x[1] / agg_d0.shape[0] > thresh]
-    if len(keepers) < len(counter_summary):
-        for j, sampLabel in enumerate(agg_d0.index):
-            linDictMod = copy.deepcopy(agg_d0.loc[sampLabel, 'linDict'])
-            linDictModCopy = copy.deepcopy(
-                agg_d0.loc[sampLabel, 'linDict'])
-            for rInd in linDictModCopy.keys():
-                if linDictModCopy[rInd] < (thresh * agg_d0.shape[0]):
-                    if 'Other' in linDictMod.keys():
-                        linDictMod['Other'] += linDictMod[rInd]
-                    else:
-                        linDictMod['Other'] = linDictMod[rInd]
-                    del linDictMod[rInd]
-            agg_d0.loc[sampLabel, 'linDict'] = [linDictMod]
+    if (totals / nSamples > thresh).sum() < len(totals):
+        small = vals < thresh * nSamples
+        if 'Other' not in names:
+            names.append('Other')
+        cols = np.where(small, names.index('Other'), cols)
+        rows, cols, vals, order = _sum_entries(
+            rows, cols, vals, np.where(small, 2 * offset, order))
+
+    return pd.DataFrame({
+        'sample': pd.Categorical.from_codes(
+            rows, categories=long_df['sample'].cat.categories),
+        'lineage': pd.Categorical.from_codes(cols, categories=names)
+        .remove_unused_categories(),
+        'abundance': vals.astype(np.float32)})
+
+
+def long_to_matrix(long_df):
+    # sparse sample x lineage matrix, built on demand
+    from scipy.sparse import csr_matrix
+    return csr_matrix((long_df['abundance'].to_numpy(),
+                       (long_df['sample'].cat.codes.to_numpy(),
+                        long_df['lineage'].cat.codes.to_numpy())),
+                      shape=(len(long_df['sample'].cat.categories),
+                             len(long_df['lineage'].cat.categories)))
+
+
+def long_to_wide(long_df, index=None):
+    # dense sample x lineage frame, lineages in order of first appearance
+    codes = long_df['lineage'].cat.codes.to_numpy()
+    used, first = np.unique(codes, return_index=True)
+    cols = used[np.argsort(first)]
+    mat = long_to_matrix(long_df)[:, cols].toarray().astype(float)
+    if index is None:
+        index = long_df['sample'].cat.categories
+    return pd.DataFrame(mat, index=index,
+                        columns=long_df['lineage'].cat.categories[cols])
+
+
+def long_to_dicts(long_df):
+    return [dict(zip(grp['lineage'], grp['abundance'].astype(float)))
+            for _, grp in long_df.groupby('sample', observed=True)]
+
+
+def prepLineageDict(agg_d0, thresh=0.001, config=None, lineage_info=None):
+    agg_d0 = structure_agg(agg_d0.copy(), cols=('lineages', 'abundances'))
+    agg_d0 = agg_d0[agg_d0['lineages'].apply(lambda x: len(x) > 0)].copy()
+    long_df = group_lineage_long(lineage_long(agg_d0), thresh=thresh,
+                                 config=config, lineage_info=lineage_info)
+    agg_d0.loc[:, 'linDict'] = long_to_dicts(long_df)
     return agg_d0
 
 
 def prepSummaryDict(agg_d0):
-    agg_d0.loc[:, 'summarized'] = agg_d0['summarized']\
-          .apply(lambda x:
-                 x.replace("'", "")
-                  .replace("]", "")
-                  .replace("[", "")
-                  .replace(")", "")
-                  .replace("(", "")
-                  .replace("\n", "")
-                  .split(', ')).copy()
+    agg_d0 = structure_agg(agg_d0.copy(), cols=('summarized',))
     # drop any samples with NO lineages identified from analysis
-    agg_d0 = agg_d0[agg_d0['summarized'].apply(lambda x: len(x) > 1)].copy()
-    agg_d0.loc[:, 'summarized'] = agg_d0['summarized']\
-          .apply(lambda x:
-                 dict(zip(x[0::2],
-                          x[1::2]))).copy()
-    agg_d0.loc[:, 'summarized'] = agg_d0['summarized']\
-          .apply(lambda x:
-                 {k: float(v)
-                  for k, v
-                  in x.items()}).copy()
+    agg_d0 = agg_d0[agg_d0['summarized'].apply(lambda x: len(x) > 0)].copy()
     return agg_d0
 
 
-def makePlot_simple(agg_df, lineages, outputFn, config, lineage_info):
+def _plot_long(agg_df, lineages, config, lineage_info):
     if lineages:
-        queryType = 'linDict'
         config = config.get('Lineages')
-        agg_df = prepLineageDict(agg_df, config=config,
-                                 lineage_info=lineage_info)
-
+        long_df = group_lineage_long(lineage_long(agg_df), config=config,
+                                     lineage_info=lineage_info)
     else:
-        queryType = 'summarized'
         config = config.get('VOC')
-        agg_df = prepSummaryDict(agg_df)
+        long_df = summary_long(agg_df)
+    return long_df, config
+
+
+def _time_bins(long_df, times_df):
+    samples = long_df['sample'].cat.categories
+    return TimeBins(long_to_wide(
+        long_df,
+        index=times_df.loc[samples, 'sample_collection_datetime'].to_numpy()))
+
+
+def makePlot_simple(agg_df, lineages, outputFn, config, lineage_info):
+    long_df, config = _plot_long(agg_df, lineages, config, lineage_info)
+    # sample x lineage abundances, stacked in order of first appearance
+    _render_simple(long_to_wide(long_df), outputFn, config)
+
+
+def _render_simple(df_abundances, outputFn, config):
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import PolyCollection
+    import plotly.express as px
+
+    samples = df_abundances.index
+    vals = df_abundances.to_numpy()
+    bottoms = np.cumsum(vals, axis=1) - vals
+
+    # one color per lineage across all samples, cycling the default palette
+    # for lineages beyond its length
+    nCols = df_abundances.shape[1]
+    default_cmap_dict = {
+        max(nCols, 24): px.colors.qualitative.Dark24 * (nCols // 24 + 1)
+    }
+    cmap_dict = get_color_scheme(df_abundances, default_cmap_dict, config)
     fig, ax = plt.subplots()
-    # Make abundance fraction for all samples in aggregated dataset
-    for k in range(0, agg_df.shape[0]):
-        dat = agg_df.iloc[k][queryType]
-        # handle parsing differences across python versions
-        if isinstance(dat, list):
-            loc = pd.Series(dat[0])
-        else:
-            loc = pd.Series(dat)
-
-        default_cmap_dict = {
-            24: px.colors.qualitative.Dark24
-        }
-
-        cmap_dict = get_color_scheme(pd.DataFrame(loc).transpose(),
-                                     default_cmap_dict,
-                                     config)
-        for i, label in enumerate(loc.index):
-            ax.bar(k, loc[label],
-                   width=0.75,
-                   bottom=loc.iloc[0:i].sum(), label=label,
-                   color=cmap_dict[label])
+    # each lineage's bars are drawn as one collection of rectangles, rather
+    # than a patch per sample
+    x = np.arange(len(samples))
+    for i, label in enumerate(df_abundances.columns):
+        present = vals[:, i] > 0
+        left = x[present] - 0.375
+        lo = bottoms[present, i]
+        hi = lo + vals[present, i]
+        verts = np.stack([np.column_stack([left, lo]),
+                          np.column_stack([left, hi]),
+                          np.column_stack([left + 0.75, hi]),
+                          np.column_stack([left + 0.75, lo])], axis=1)
+        ax.add_collection(PolyCollection(verts, label=label,
+                                         facecolors=cmap_dict[label],
+                                         edgecolors='none'))
     handles, labels = ax.get_legend_handles_labels()
     ax.legend(handles[::-1], labels[::-1], loc='center left',
               bbox_to_anchor=(1, 0.5), prop={'size': 4})
     ax.set_ylabel('Variant Prevalence')
-    ax.set_xticks(range(0, agg_df.shape[0]))
-    ax.set_xticklabels([sd.split('_')[0] for sd in agg_df.index],
+    # label at most ~200 samples, beyond that the labels overlap anyway
+    ticks = np.arange(0, len(samples), -(-len(samples) // 200))
+    ax.set_xticks(ticks)
+    ax.set_xticklabels([samples[k].split('_')[0] for k in ticks],
                        rotation=90, fontsize=7)
     ax.set_ylim([0, 1])
-    ax.set_xlim([-0.5, agg_df.shape[0] - 0.5])
+    ax.set_xlim([-0.5, len(samples) - 0.5])
     ax.set_aspect(6)
     fig.tight_layout()
     plt.savefig(outputFn)
@@ -346,35 +923,21 @@ def makePlot_simple(agg_df, lineages, outputFn, config, lineage_info):
 
 def makePlot_time(agg_df, lineages, times_df, interval, outputFn,
                   windowSize, config, lineage_info):
-    if lineages:
-        queryType = 'linDict'
-        config = config.get('Lineages')
-        agg_df = prepLineageDict(agg_df, config=config,
-                                 lineage_info=lineage_info)
+    long_df, config = _plot_long(agg_df, lineages, config, lineage_info)
+    if interval not in INTERVALS:
+        print('Error. Currently we only support Daily (D), Weekly (W), \
+               and Monthly (MS) time plots.')
+        return
+    bins = _time_bins(long_df, times_df)
+    _render_time(bins.get(interval, windowSize if interval == 'D' else None),
+                 interval, outputFn, config)
 
-    else:
-        queryType = 'summarized'
-        config = config.get('VOC')
-        agg_df = prepSummaryDict(agg_df)
-
-    df_abundances = pd.DataFrame()
-    for i, sampLabel in enumerate(agg_df.index):
-        dat = agg_df.loc[sampLabel, queryType]
-        if isinstance(dat, list):
-            df_abundances = df_abundances.append(
-                pd.Series(agg_df.loc[sampLabel, queryType][0],
-                          name=times_df.loc[sampLabel,
-                                            'sample_collection_datetime']))
-        else:
-            df_abundances = df_abundances.append(
-                pd.Series(agg_df.loc[sampLabel, queryType],
-                          name=times_df.loc[sampLabel,
-                                            'sample_collection_datetime']))
-    df_abundances = df_abundances.fillna(0)
-    if interval == 'W':
-        # epiweek ends on sat, starts on sun
-        interval = 'W-SAT'
-    df_abundances = df_abundances.groupby(pd.Grouper(freq=interval)).mean()
+
+def _render_time(df_abundances, interval, outputFn, config):
+    # daily abundances come in already smoothed
+    import matplotlib.dates as mdates
+    import matplotlib.pyplot as plt
+    import plotly.express as px
 
     default_cmap_dict = {
         24: px.colors.qualitative.Dark24
@@ -385,8 +948,6 @@ def makePlot_time(agg_df, lineages, times_df, interval, outputFn,
                                  config)
     fig, ax = plt.subplots()
     if interval == 'D':
-        df_abundances = df_abundances.rolling(windowSize, center=True,
-                                              min_periods=0).mean()
         ax.stackplot(df_abundances.index, df_abundances.to_numpy().T,
                      labels=df_abundances.columns, colors=cmap_dict.values())
         handles, labels = ax.get_legend_handles_labels()
@@ -416,11 +977,10 @@ def makePlot_time(agg_df, lineages, times_df, interval, outputFn,
         fig.tight_layout()
         plt.savefig(outputFn)
         plt.close()
-    elif interval == 'W-SAT':
-        from epiweeks import Week
-        weekInfo = [Week.fromdate(dfi).weektuple()
-                    for dfi in df_abundances.index]
-        df_abundances.index = [str(wi[0])+'-'+str(wi[1]) for wi in weekInfo]
+    elif interval == 'W':
+        df_abundances = df_abundances.copy()
+        df_abundances.index = [f'{y}-{w}'
+                               for y, w in zip(*epiweeks(df_abundances.index))]
         print(df_abundances)
         for i in range(0, df_abundances.shape[1]):
             label = df_abundances.columns[i]
@@ -440,120 +1000,159 @@ def makePlot_time(agg_df, lineages, times_df, interval, outputFn,
         fig.tight_layout()
         plt.savefig(outputFn)
         plt.close()
-    else:
-        print('Error. Currently we only support Daily (D), Weekly (W), \
-               and Monthly (MS) time plots.')
+
+
+def _render_agg(render, *args):
+    # workers render straight to file
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+    render(*args)
+
+
+def make_plots(agg_df, plots, config, lineage_info, times_df=None,
+               windowSize=14, n_jobs=1):
+    # Renders several (outputFn, interval, lineages) plots of one dataset.
+    # The aggregate is parsed and each lineage/summarized table binned once,
+    # then the figures are drawn in parallel.
+    agg_df = structure_agg(agg_df[['summarized', 'lineages',
+                                   'abundances']].copy())
+    prepared = {}
+    jobs = []
+    for outputFn, interval, lineages in plots:
+        if lineages not in prepared:
+            long_df, plotConfig = _plot_long(agg_df, lineages, config,
+                                             lineage_info)
+            if times_df is None:
+                prepared[lineages] = (long_to_wide(long_df), plotConfig)
+            else:
+                prepared[lineages] = (_time_bins(long_df, times_df),
+                                      plotConfig)
+        data, plotConfig = prepared[lineages]
+        if times_df is None:
+            jobs.append(delayed(_render_agg)(_render_simple, data, outputFn,
+                                             plotConfig))
+        elif interval in INTERVALS:
+            df = data.get(interval, windowSize if interval == 'D' else None)
+            jobs.append(delayed(_render_agg)(_render_time, df, interval,
+                                             outputFn, plotConfig))
+        else:
+            print('Error. Currently we only support Daily (D), Weekly (W), \
+                   and Monthly (MS) time plots.')
+    Parallel(n_jobs=n_jobs)(jobs)
+
+
+def fold_into_other(df, thresh):
+    # columns whose total is at most thresh are summed into "Other" in one
+    # masked reduction, "Other" is placed last
+    mat = df.to_numpy()
+    isOther = np.asarray(df.columns == 'Other')
+    small = (mat.sum(axis=0) <= thresh) & ~isOther
+    other = mat[:, small | isOther].sum(axis=1)
+    keep = ~(small | isOther)
+    return pd.DataFrame(np.column_stack([mat[:, keep], other]),
+                        index=df.index,
+                        columns=list(df.columns[keep]) + ['Other'])
 
 
 def get_abundance(agg_df, meta_df, thresh, scale_by_viral_load, config,
                   lineage_info):
-    agg_df = prepLineageDict(agg_df, config=config.get('Lineages'),
-                             lineage_info=lineage_info)
-    agg_df = prepSummaryDict(agg_df)
+    agg_df = structure_agg(agg_df[['summarized', 'lineages',
+                                   'abundances']].copy())
+    agg_df = agg_df[agg_df['lineages'].apply(len) > 0]
+    lin_long = group_lineage_long(lineage_long(agg_df),
+                                  config=config.get('Lineages'),
+                                  lineage_info=lineage_info)
+    sum_long = summary_long(agg_df)
+    samples = sum_long['sample'].cat.categories
+    lin_long = lin_long[lin_long['sample'].isin(samples)]
+    lin_long = lin_long.assign(
+        sample=lin_long['sample'].cat.remove_unused_categories())
+    dates = meta_df.loc[samples, 'sample_collection_datetime'].to_numpy()
 
     # collect lineage data
-    df_ab_lin = pd.DataFrame()
-    for i, sampLabel in enumerate(agg_df.index):
-        dat = agg_df.loc[sampLabel, 'linDict']
-        if isinstance(dat, list):
-            df_ab_lin = df_ab_lin.append(
-                pd.Series(agg_df.loc[sampLabel, 'linDict'][0],
-                          name=meta_df.loc[sampLabel,
-                                           'sample_collection_datetime']))
-        else:
-            df_ab_lin = df_ab_lin.append(
-                pd.Series(agg_df.loc[sampLabel, 'linDict'],
-                          name=meta_df.loc[sampLabel,
-                                           'sample_collection_datetime']))
-
-    df_ab_lin = df_ab_lin.fillna(0)
-    if 'Other' not in df_ab_lin.columns:
-        df_ab_lin['Other'] = 0.
-    for col in df_ab_lin.columns:
-        if col != 'Other':
-            if df_ab_lin[col].sum() <= thresh:
-                df_ab_lin['Other'] += df_ab_lin[col]
-                df_ab_lin = df_ab_lin.drop(labels=[col], axis=1)
-
-    cols0 = [c0 for c0 in df_ab_lin.columns
-             if c0 != 'Other'] + ['Other']
-    df_ab_lin = df_ab_lin[cols0]
-    df_ab_lin = 100. * df_ab_lin
+    df_ab_lin = 100. * fold_into_other(long_to_wide(lin_long, index=dates),
+                                       thresh)
 
     # collect VOC summarized data
-    df_ab_sum = pd.DataFrame()
-    for i, sampLabel in enumerate(agg_df.index):
-        dat = agg_df.loc[sampLabel, 'summarized']
-        if isinstance(dat, list):
-            df_ab_sum = df_ab_sum.append(
-                pd.Series(agg_df.loc[sampLabel, 'summarized'][0],
-                          name=meta_df.loc[sampLabel,
-                                           'sample_collection_datetime']))
-        else:
-            df_ab_sum = df_ab_sum.append(
-                pd.Series(agg_df.loc[sampLabel, 'summarized'],
-                          name=meta_df.loc[sampLabel,
-                                           'sample_collection_datetime']))
-
-    df_ab_sum = df_ab_sum.fillna(0)
-    if 'Other' not in df_ab_sum.columns:
-        df_ab_sum['Other'] = 0.
-    for col in df_ab_sum.columns:
-        # TODO: expand to sum values not in top N lineages, etc.
-        if col != 'Other':
-            if df_ab_sum[col].sum() <= thresh:
-                df_ab_sum['Other'] += 1.0 * df_ab_sum[col]
-                df_ab_sum = df_ab_sum.drop(labels=[col], axis=1)
-
-    cols0 = [c0 for c0 in df_ab_sum.columns
-             if c0 != 'Other'] + ['Other']
-    df_ab_sum = df_ab_sum[cols0]
-    df_ab_sum = 100. * df_ab_sum.fillna(0)
-    # df_abundances = df_abundances.groupby(pd.Grouper(freq=interval)).mean()
-    # fig, ax = plt.subplots()
-    # if interval == 'D':
-    #     df_abundances = df_abundances.rolling(windowSize, center=True,
-    #                                           min_periods=0).mean()
+    # TODO: expand to sum values not in top N lineages, etc.
+    df_ab_sum = 100. * fold_into_other(long_to_wide(sum_long, index=dates),
+                                       thresh)
+    viral_load = meta_df.loc[samples, 'viral_load'].to_numpy()
     meta_df = meta_df.set_index('sample_collection_datetime')
 
+    # samples taken at the same time are averaged
     if scale_by_viral_load:
-        df_ab_lin_rescale = df_ab_lin.multiply(meta_df.viral_load,
-                                               axis=0)
-        df_ab_lin_rescale = df_ab_lin_rescale.groupby(level=0).sum()
-        df_ab_lin_rescale = df_ab_lin_rescale.sort_index()
+        df_ab_lin = bin_means(df_ab_lin, weights=viral_load).fillna(0)
         meta_df = meta_df.groupby('sample_collection_datetime').sum()\
             .sort_index()
-        df_ab_lin = df_ab_lin_rescale.divide(meta_df.viral_load,
-                                             axis=0)
-        df_ab_lin = df_ab_lin.fillna(0).sort_index()
     else:
         meta_df = meta_df.groupby('sample_collection_datetime').mean()\
             .sort_index()
-        df_ab_lin = df_ab_lin.groupby(level=0).mean().sort_index()
+        df_ab_lin = bin_means(df_ab_lin)
 
     dates_to_keep = meta_df.index[~meta_df['viral_load'].isna()]
     dates_to_keep = dates_to_keep.intersection(df_ab_sum.index)
 
-    df_ab_sum = df_ab_sum.groupby(level=0).mean()
-    df_ab_sum = df_ab_sum.sort_index()
+    df_ab_sum = bin_means(df_ab_sum)
 
     return df_ab_lin, df_ab_sum, dates_to_keep
 
 
+def _date_strings(index):
+    # dates as ISO strings, without the time of day when it's always midnight
+    index = pd.DatetimeIndex(index)
+    fmt = '%Y-%m-%d' if (index == index.normalize()).all() \
+        else '%Y-%m-%dT%H:%M:%S'
+    return list(index.strftime(fmt))
+
+
+# Fills in the trace data after the (data-free) figure is drawn. Traces share
+# their x arrays through the xi indices into the payload's x list.
+_FILL_PLOT_JS = """
+var gd = document.getElementById('{plot_id}');
+function fillPlot(d) {
+    Plotly.restyle(gd, {x: d.xi.map(function(i) { return d.x[i]; }),
+                        y: d.y}, d.y.map(function(_, i) { return i; }));
+}
+"""
+
+
 def make_dashboard(agg_df, meta_df, thresh, title, introText,
                    outputFn, headerColor, bodyColor, scale_by_viral_load,
                    config, lineage_info, nboots, serial_interval, days,
-                   grThresh):
+                   grThresh, method='logistic', seed=None, n_jobs=1,
+                   cacheFn=None, dataFn=None, offline=False):
+    import plotly.express as px
+    import plotly.graph_objects as go
+
     df_ab_lin, df_ab_sum, dates_to_keep = get_abundance(agg_df, meta_df,
                                                         thresh,
                                                         scale_by_viral_load,
                                                         config, lineage_info)
 
-    calc_rel_growth_rates(df_ab_lin.copy(deep=True), nboots,
-                          serial_interval, outputFn,
-                          daysIncluded=days, grThresh=grThresh)
+    growth_df = calc_rel_growth_rates(df_ab_lin.copy(deep=True), nboots,
+                                      serial_interval, outputFn,
+                                      daysIncluded=days, grThresh=grThresh,
+                                      method=method, seed=seed,
+                                      n_jobs=n_jobs, cacheFn=cacheFn)
 
     fig = go.Figure()
+    # the trace data goes into one payload, filled in once the page loads
+    payload = {'x': [], 'xi': [], 'y': []}
+    xIds = {}
+
+    def add_trace(x, y, **kwargs):
+        key = tuple(x)
+        if key not in xIds:
+            xIds[key] = len(payload['x'])
+            payload['x'].append(_date_strings(x))
+        payload['xi'].append(xIds[key])
+        # values are only shown to one decimal place
+        payload['y'].append([None if np.isnan(v) else v
+                             for v in np.round(np.asarray(y, dtype=float),
+                                               1).tolist()])
+        fig.add_trace(go.Scatter(hoverinfo='x+y', mode='markers+lines',
+                                 **kwargs))
 
     default_color_lin = {
         11: px.colors.qualitative.Vivid,
@@ -563,17 +1162,12 @@ def make_dashboard(agg_df, meta_df, thresh, title, introText,
                                  default_color_lin,
                                  config.get('Lineages'))
     for j, col in enumerate(df_ab_lin.columns):
-
-        fig.add_trace(go.Scatter(
-            x=df_ab_lin.index, y=df_ab_lin[col],
-            hoverinfo='x+y',
-            name=col,
-            mode='markers+lines',
-            hovertemplate="%{y:.1f}%",
-            line=dict(width=0.5, color=color_lin[col]),
-            visible=False,
-            stackgroup='one'
-        ))
+        add_trace(df_ab_lin.index, df_ab_lin[col],
+                  name=col,
+                  hovertemplate="%{y:.1f}%",
+                  line=dict(width=0.5, color=color_lin[col]),
+                  visible=False,
+                  stackgroup='one')
 
     default_color_sum = {
         11: px.colors.qualitative.Pastel,
@@ -583,30 +1177,22 @@ def make_dashboard(agg_df, meta_df, thresh, title, introText,
                                  default_color_sum,
                                  config.get('VOC'))
     for j, col in enumerate(df_ab_sum.columns):
-        fig.add_trace(go.Scatter(
-            x=df_ab_sum.index, y=df_ab_sum[col],
-            hoverinfo='x+y',
-            name=col,
-            mode='markers+lines',
-            hovertemplate="%{y:.1f}%",
-            line=dict(width=0.5, color=color_sum[col]),
-            visible=True,
-            stackgroup='one',
-        ))
+        add_trace(df_ab_sum.index, df_ab_sum[col],
+                  name=col,
+                  hovertemplate="%{y:.1f}%",
+                  line=dict(width=0.5, color=color_sum[col]),
+                  visible=True,
+                  stackgroup='one')
     # if needed, drop dates with missing viral load metadata
     meta_df = meta_df.set_index('sample_collection_datetime')
     if len(dates_to_keep) < meta_df.shape[0]:
         meta_df = meta_df.loc[dates_to_keep]
         df_ab_sum = df_ab_sum.loc[dates_to_keep]
         df_ab_lin = df_ab_lin.loc[dates_to_keep]
-    fig.add_trace(go.Scatter(
-        x=meta_df.index, y=meta_df['viral_load'],
-        hoverinfo='x+y',
-        mode='markers+lines',
-        hovertemplate="%{y:.1f} copies/L",
-        line=dict(width=1.25, color='blue'),
-        visible=False,
-    ))
+    add_trace(meta_df.index, meta_df['viral_load'],
+              hovertemplate="%{y:.1f} copies/L",
+              line=dict(width=1.25, color='blue'),
+              visible=False)
 
     # load scaled abundances
     df_ab_lin_s = df_ab_lin.multiply(meta_df.viral_load,
@@ -620,17 +1206,12 @@ def make_dashboard(agg_df, meta_df, thresh, title, introText,
                                    default_color_lin_s,
                                    config.get('Lineages'))
     for j, col in enumerate(df_ab_lin_s.columns):
-
-        fig.add_trace(go.Scatter(
-            x=df_ab_lin_s.index, y=df_ab_lin_s[col],
-            hoverinfo='x+y',
-            name=col,
-            mode='markers+lines',
-            hovertemplate="%{y:.1f} copies/L",
-            line=dict(width=0.5, color=color_lin_s[col]),
-            visible=False,
-            stackgroup='one'
-        ))
+        add_trace(df_ab_lin_s.index, df_ab_lin_s[col],
+                  name=col,
+                  hovertemplate="%{y:.1f} copies/L",
+                  line=dict(width=0.5, color=color_lin_s[col]),
+                  visible=False,
+                  stackgroup='one')
 
     df_ab_sum_s = df_ab_sum.multiply(meta_df.viral_load,
                                      axis=0) / 100.
@@ -643,16 +1224,12 @@ def make_dashboard(agg_df, meta_df, thresh, title, introText,
                                    default_color_sum_s,
                                    config.get('VOC'))
     for j, col in enumerate(df_ab_sum_s.columns):
-        fig.add_trace(go.Scatter(
-            x=df_ab_sum_s.index, y=df_ab_sum_s[col],
-            hoverinfo='x+y',
-            name=col,
-            mode='markers+lines',
-            hovertemplate="%{y:.1f} copies/L",
-            line=dict(width=0.5, color=color_sum_s[col]),
-            visible=False,
-            stackgroup='one'
-        ))
+        add_trace(df_ab_sum_s.index, df_ab_sum_s[col],
+                  name=col,
+                  hovertemplate="%{y:.1f} copies/L",
+                  line=dict(width=0.5, color=color_sum_s[col]),
+                  visible=False,
+                  stackgroup='one')
     fig.update_layout(updatemenus=[dict(type="buttons",
                       direction='right',
                       active=0,
@@ -751,18 +1328,33 @@ def make_dashboard(agg_df, meta_df, thresh, title, introText,
 
     fig.update_xaxes(dtick="6.048e+8", tickformat="%b %d", mirror=True,
                      showline=False, ticks="", showgrid=False)
-    # generate plot as a div, to combine with additional html/css
-    fig.write_html("div-plot.html", full_html=False, default_width='50%',
-                   config={'displaylogo': False, 'displayModeBar': False})
+    # plotly.js (~4.7 MB) comes from its CDN unless the page has to work
+    # offline. The plot data is embedded in the page, or with a separate
+    # data file loaded from it, in which case the page has to be served.
+    if dataFn is not None:
+        with open(dataFn, 'w') as f:
+            json.dump(payload, f, separators=(',', ':'))
+        dataUrl = os.path.relpath(dataFn,
+                                  os.path.dirname(os.path.abspath(outputFn)))
+        dataUrl = dataUrl.replace(os.sep, '/')
+        fill = _FILL_PLOT_JS + "fetch(" + json.dumps(dataUrl) + \
+            ").then(function(r) { return r.json(); }).then(fillPlot);"
+    else:
+        fill = _FILL_PLOT_JS + "fillPlot(" + \
+            json.dumps(payload, separators=(',', ':')) + ");"
+    plot = fig.to_html(full_html=False, default_width='50%',
+                       include_plotlyjs=(True if offline else 'cdn'),
+                       post_script=fill,
+                       config={'displaylogo': False,
+                               'displayModeBar': False})
     # Generate a web page with the plot by placing it in the template.
     locDir = os.path.abspath(os.path.join(os.path.realpath(__file__),
                              os.pardir))
-    webpage = open(os.path.join(locDir,
-                                'data/dashboard_template.html'),
-                   "r").read()
+    with open(os.path.join(locDir, 'data/dashboard_template.html')) as f:
+        webpage = f.read()
     webpage = webpage.replace("{title}", title)
     webpage = webpage.replace("{introText}", introText)
-    webpage = webpage.replace("{plot}", open("div-plot.html", "r").read())
+    webpage = webpage.replace("{plot}", plot)
     webpage = webpage.replace("{lastUpdated}",
                               str(datetime.now().strftime("%b-%d-%Y %H:%M")))
     webpage = webpage.replace("{headerColor}",
@@ -770,21 +1362,106 @@ def make_dashboard(agg_df, meta_df, thresh, title, introText,
     webpage = webpage.replace("{bodyColor}",
                               bodyColor)
     webpage = webpage.replace("{table}",
-                              pd.read_csv(
-                                outputFn.replace('.html',
-                                                 '_rel_growth_rates.csv'))
-                                .to_html(index=False)
-                                .replace('dataframe',
-                                         'table table-bordered table-hover' +
-                                         ' table-striped table-light' +
-                                         ' table-bordered'))
+                              growth_df.to_html(index=False)
+                              .replace('dataframe',
+                                       'table table-bordered table-hover' +
+                                       ' table-striped table-light' +
+                                       ' table-bordered'))
 
     with open(outputFn, 'w') as outfile:
         outfile.write(webpage)
-    os.remove('div-plot.html')
     print("Dashboard html file saved to " + outputFn)
 
 
+def _site_file_name(site):
+    return re.sub(r'[^\w.-]+', '_', str(site))
+
+
+def _site_file_names(sites):
+    # file name stems of the sites, with a counter added where different
+    # sites sanitize to the same name (case-insensitively, and never the
+    # index page's)
+    used = {'index'}
+    names = {}
+    for site in sites:
+        base = _site_file_name(site)
+        name = base
+        k = 2
+        while name.lower() in used:
+            name = f'{base}_{k}'
+            k += 1
+        used.add(name.lower())
+        names[site] = name
+    return names
+
+
+def _site_dashboard(site, name, agg_df, meta_df, outDir, title, cacheFn,
+                    dataFn, kwargs):
+    outputFn = os.path.join(outDir, name + '.html')
+    if cacheFn is not None:
+        # each site keeps its own cache, the workers run concurrently
+        stem, ext = os.path.splitext(cacheFn)
+        cacheFn = stem + '_' + name + ext
+    if dataFn is not None:
+        dataFn = os.path.join(outDir, name + '_' + os.path.basename(dataFn))
+    make_dashboard(agg_df, meta_df,
+                   title=f'{title} - {html.escape(str(site))}',
+                   outputFn=outputFn, cacheFn=cacheFn, dataFn=dataFn,
+                   **kwargs)
+    return site, os.path.basename(outputFn)
+
+
+def make_site_dashboards(agg_df, meta_df, siteCol, outDir, thresh, title,
+                         introText, headerColor, bodyColor,
+                         scale_by_viral_load, config, lineage_info, nboots,
+                         serial_interval, days, grThresh, method='logistic',
+                         seed=None, n_jobs=1, cacheFn=None, dataFn=None,
+                         offline=False):
+    # One dashboard per site in the metadata, rendered in parallel from the
+    # already parsed aggregate, plus an index page linking them.
+    os.makedirs(outDir, exist_ok=True)
+    agg_df = structure_agg(agg_df[['summarized', 'lineages',
+                                   'abundances']].copy())
+    meta_df = meta_df[meta_df.index.isin(agg_df.index) &
+                      meta_df[siteCol].notna()]
+    sites = meta_df.groupby(siteCol, sort=True).groups
+    kwargs = dict(thresh=thresh, introText=introText,
+                  headerColor=headerColor, bodyColor=bodyColor,
+                  scale_by_viral_load=scale_by_viral_load, config=config,
+                  lineage_info=lineage_info, nboots=nboots,
+                  serial_interval=serial_interval, days=days,
+                  grThresh=grThresh, method=method, seed=seed,
+                  offline=offline)
+    names = _site_file_names(sites)
+    out = Parallel(n_jobs=n_jobs)(
+        delayed(_site_dashboard)(site, names[site], agg_df.loc[samples],
+                                 meta_df.loc[samples], outDir, title,
+                                 cacheFn, dataFn, kwargs)
+        for site, samples in sites.items())
+    links = '\n'.join(f'        <li><a href="{html.escape(fn)}">'
+                      f'{html.escape(str(site))}</a></li>'
+                      for site, fn in out)
+    indexFn = os.path.join(outDir, 'index.html')
+    title = html.escape(title)
+    with open(indexFn, 'w') as f:
+        f.write(f"""<!DOCTYPE html>
+<html lang='en'>
+<head>
+    <meta charset='UTF-8'>
+    <title>{title}</title>
+</head>
+<body>
+    <h1>{title}</h1>
+    <ul>
+{links}
+    </ul>
+</body>
+</html>
+""")
+    print("Dashboard index saved to " + indexFn)
+    return indexFn
+
+
 if __name__ == '__main__':
     agg_results = 'freyja/data/test_sweep.tsv'
     agg_df = pd.read_csv(agg_results, skipinitialspace=True, sep='\t',